@@ -0,0 +1,177 @@
+"""Time steeve commands end to end on synthetic packages.
+
+Every command is run as a separate process, so timings include interpreter
+startup and import time, just like running steeve from the shell.
+"""
+from __future__ import division, print_function
+
+from collections import OrderedDict
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STEEVE = os.path.join(ROOT, 'steeve.py')
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command(help="Run benchmarks and write results as JSON.")
+@click.option('--packages', type=click.IntRange(1), default=2,
+              show_default=True, help="Number of packages.")
+@click.option('--versions', type=click.IntRange(1), default=3,
+              show_default=True, help="Number of versions of each package.")
+@click.option('--files', type=click.IntRange(1), default=500,
+              show_default=True, help="Number of files in each version.")
+@click.option('--depth', type=click.IntRange(0), default=3,
+              show_default=True, help="Depth of directories in versions.")
+@click.option('--no-folding', is_flag=True,
+              help="Stow packages with --no-folding.")
+@click.option('--repeat', type=click.IntRange(1), default=3,
+              show_default=True, help="Number of rounds.")
+@click.option('-o', '--output', type=click.File('w'), default='-',
+              help="Write results to file instead of standard output.")
+def run(output, repeat, **params):
+    timings = OrderedDict()
+    for _ in range(repeat):
+        bench_round(timings, **params)
+    results = OrderedDict([
+        ('steeve', steeve_version()),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('params', params),
+        ('results', OrderedDict((command, summarize(samples))
+                                for command, samples in timings.items())),
+    ])
+    json.dump(results, output, indent=2)
+    output.write('\n')
+
+
+@cli.command(help="Compare median timings of two runs, fail if any command "
+                  "became slower than threshold.")
+@click.argument('baseline', type=click.File('r'))
+@click.argument('current', type=click.File('r'))
+@click.option('--threshold', type=float, default=0.1, show_default=True,
+              help="Allowed slowdown as a fraction of baseline.")
+def compare(baseline, current, threshold):
+    baseline = json.load(baseline)
+    current = json.load(current)
+    if baseline['params'] != current['params']:
+        click.echo('warning: runs have different parameters', err=True)
+    regressed = []
+    for command, result in current['results'].items():
+        before = baseline['results'].get(command)
+        if before is None:
+            continue
+        ratio = result['median'] / before['median']
+        click.echo('{:<16} {:>9.4f} {:>9.4f} {:>+7.1%}'.format(
+            command, before['median'], result['median'], ratio - 1))
+        if ratio > 1 + threshold:
+            regressed.append(command)
+    if regressed:
+        raise click.ClickException(
+            'regressions in: {}'.format(', '.join(regressed)))
+
+
+def bench_round(timings, packages, versions, files, depth, no_folding):
+    tmp = tempfile.mkdtemp(prefix='steeve-bench-')
+    try:
+        releases = os.path.join(tmp, 'releases')
+        env = dict(os.environ,
+                   STEEVE_DIR=os.path.join(tmp, 'stow'),
+                   STEEVE_TARGET=os.path.join(tmp, 'target'))
+        env.pop('STEEVE_GNU_STOW', None)
+        options = ['--no-folding'] if no_folding else []
+        os.makedirs(env['STEEVE_TARGET'])
+        devnull = open(os.devnull, 'w')
+
+        def steeve(*args):
+            start = timer()
+            subprocess.check_call([sys.executable, STEEVE] + options +
+                                  list(args), env=env, stdout=devnull)
+            # Name timings after command and its flags, e.g. 'ls --long'
+            name = ' '.join(arg for arg in args[1:] if arg.startswith('--')
+                            and arg != '--yes')
+            name = '{} {}'.format(args[0], name) if name else args[0]
+            timings.setdefault(name, []).append(timer() - start)
+
+        names = ['pkg{}'.format(i) for i in range(packages)]
+        numbers = ['{}.0'.format(i + 1) for i in range(versions)]
+
+        start = timer()
+        subprocess.check_call([sys.executable, '-c', 'import steeve'],
+                              cwd=ROOT)
+        timings.setdefault('import', []).append(timer() - start)
+
+        for name in names:
+            for number in numbers:
+                path = os.path.join(releases, name, number)
+                make_release(path, name, number, files, depth)
+                steeve('install', name, number, path)
+        steeve('ls')
+        steeve('ls', '--long')
+        for name in names:
+            steeve('stow', name, numbers[0])
+        for name in names:
+            steeve('unstow', name)
+        for name in names:
+            steeve('stow', name, numbers[-1])
+        for name in names:
+            for number in numbers:
+                steeve('uninstall', '--yes', name, number)
+        devnull.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def make_release(path, name, version, files, depth):
+    """Create version with *files* spread across directories *depth* levels
+    deep.  Every version has a few files of its own, so switching between
+    versions changes links.
+    """
+    for i in range(files):
+        parts = ['d{}'.format(i % (level + 2)) for level in range(depth)]
+        if i % 10 == 0:
+            parts.append(version)
+        dirpath = os.path.join(path, 'share', name, *parts)
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        with open(os.path.join(dirpath, 'f{}'.format(i)), 'w') as fp:
+            fp.write('{} {} {}\n'.format(name, version, i))
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    middle = len(samples) // 2
+    if len(samples) % 2:
+        median = samples[middle]
+    else:
+        median = (samples[middle - 1] + samples[middle]) / 2
+    return OrderedDict([
+        ('runs', len(samples)),
+        ('min', samples[0]),
+        ('median', median),
+        ('mean', sum(samples) / len(samples)),
+        ('max', samples[-1]),
+    ])
+
+
+def steeve_version():
+    output = subprocess.check_output([sys.executable, STEEVE, '--version'])
+    return output.decode().split()[-1]
+
+
+if __name__ == '__main__':
+    cli()
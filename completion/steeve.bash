@@ -1,4 +1,49 @@
+_steeve_cached() {
+    # Print packages, or versions of package $2, from the completion cache
+    # in dir $1. Fail if the cache is missing or older than the packages.
+    local cache=$1/.steeve/completion package versions
+    [[ -f $cache ]] || return 1
+    [[ $1 -nt $cache ]] && return 1
+    [[ -n $2 && $1/$2 -nt $cache ]] && return 1
+    while read -r package versions; do
+        if [[ -z $2 ]]; then
+            echo "$package"
+        elif [[ $package == "$2" ]]; then
+            echo "$versions"
+        fi
+    done < "$cache"
+}
+
 _steeve_completion() {
+    local cur=${COMP_WORDS[COMP_CWORD]} dir=${STEEVE_DIR:-/usr/local/stow}
+    local cmd= args=() words i
+    for ((i = 1; i < COMP_CWORD; i++)); do
+        case ${COMP_WORDS[i]} in
+            -d|--dir) dir=${COMP_WORDS[++i]} ;;
+            -t|--target|--targets-file|-j|--jobs|--copy-mode|\
+            --strip-components|--sort|--keep|--max-size|--sha256|\
+            --link-mode|--delay|-o|--output) ((i++)) ;;
+            -*) ;;
+            *) if [[ -z $cmd ]]; then cmd=${COMP_WORDS[i]}
+               else args+=("${COMP_WORDS[i]}"); fi ;;
+        esac
+    done
+
+    if [[ $cur != -* ]]; then
+        case $cmd:${#args[@]} in
+            install:0|uninstall:0|stow:0|files:0|dedup:0|watch:0|verify:0|\
+            pack:0|ls:*|unstow:*|gc:*)
+                words=$(_steeve_cached "$dir") ;;
+            install:1|uninstall:1|stow:1|files:1|dedup:1|watch:1|verify:1|\
+            pack:1)
+                words=$(_steeve_cached "$dir" "${args[0]}") ;;
+            *) false ;;
+        esac && {
+            COMPREPLY=( $(compgen -W "$words" -- "$cur") )
+            return 0
+        }
+    fi
+
     COMPREPLY=( $( env COMP_WORDS="${COMP_WORDS[*]}" \
                    COMP_CWORD=$COMP_CWORD \
                    _STEEVE_COMPLETE=complete $1 ) )
@@ -1,4 +1,4 @@
-set -g subcommands install ls reinstall restow stow uninstall unstow
+set -g subcommands apply dedup files gc install ls owns pack recover reinstall restow serve stow uninstall unstow verify watch
 
 function __steeve_seq -a upto
     seq 1 1 $upto ^ /dev/null
@@ -30,14 +30,36 @@ function __steeve_without_subcommand -d 'Strip all words starting from subcomman
     set -e steeve_without_subcommand
 end
 
+function __steeve_cached -d 'Read packages or package versions from completion cache'
+    set -l cmd (commandline -opc)
+    if contains -- -d $cmd; or contains -- --dir $cmd
+        return 1
+    end
+    set -l dir /usr/local/stow
+    set -q STEEVE_DIR; and set dir $STEEVE_DIR
+    set -l cache $dir/.steeve/completion
+    test -f $cache; or return 1
+    command test $dir -nt $cache; and return 1
+    if set -q argv[1]
+        command test $dir/$argv[1] -nt $cache; and return 1
+    end
+    while read -l package versions
+        if not set -q argv[1]
+            echo $package
+        else if test "$package" = "$argv[1]" -a -n "$versions"
+            string split ' ' -- $versions
+        end
+    end < $cache
+end
+
 function __steeve_packages -d 'List steeve packages'
-    __steeve_without_subcommand ls -q
+    __steeve_cached; or __steeve_without_subcommand ls -q
 end
 
 function __steeve_versions -d 'List package versions'
     set -l cmd (commandline -opc)
     set -l package $cmd[-1]
-    __steeve_without_subcommand ls -q $package
+    __steeve_cached $package; or __steeve_without_subcommand ls -q $package
 end
 
 function __steeve_await_package -a subcommand -d 'Test if steeve has yet to be given a package name'
@@ -74,3 +96,35 @@ complete -c steeve -A -f -n '__steeve_await_version uninstall'   -a '(__steeve_v
 
 complete -c steeve    -f -n '__steeve_no_subcommand'             -a unstow                -d 'Delete stowed symlinks'
 complete -c steeve -A -f -n '__fish_seen_subcommand_from unstow' -a '(__steeve_packages)' -d 'Package'
+
+complete -c steeve    -f -n '__steeve_no_subcommand'             -a files                 -d 'List files of package version'
+complete -c steeve -A -f -n '__steeve_await_package files'       -a '(__steeve_packages)' -d 'Package'
+complete -c steeve -A -f -n '__steeve_await_version files'       -a '(__steeve_versions)' -d 'Version'
+
+complete -c steeve    -f -n '__steeve_no_subcommand'             -a dedup                 -d 'Hard link identical files of installed versions'
+complete -c steeve -A -f -n '__steeve_await_package dedup'       -a '(__steeve_packages)' -d 'Package'
+complete -c steeve -A -f -n '__steeve_await_version dedup'       -a '(__steeve_versions)' -d 'Version'
+
+complete -c steeve    -f -n '__steeve_no_subcommand'             -a gc                    -d 'Delete uninstalled and old versions'
+complete -c steeve -A -f -n '__fish_seen_subcommand_from gc'     -a '(__steeve_packages)' -d 'Package'
+
+complete -c steeve    -f -n '__steeve_no_subcommand'             -a apply                 -d 'Stow versions of packages listed in manifest'
+complete -c steeve    -f -n '__steeve_no_subcommand'             -a owns                  -d 'Show which package owns given path'
+
+complete -c steeve    -f -n '__steeve_no_subcommand'             -a watch                 -d 'Link files that appear in version folder'
+complete -c steeve -A -f -n '__steeve_await_package watch'       -a '(__steeve_packages)' -d 'Package'
+complete -c steeve -A -f -n '__steeve_await_version watch'       -a '(__steeve_versions)' -d 'Version'
+complete -c steeve    -x -n '__fish_seen_subcommand_from watch'  -l delay                 -d 'Update links once changes settle'
+
+complete -c steeve    -f -n '__steeve_no_subcommand'             -a verify                -d 'Check that installed files and links did not change'
+complete -c steeve -A -f -n '__steeve_await_package verify'      -a '(__steeve_packages)' -d 'Package'
+complete -c steeve -A -f -n '__steeve_await_version verify'      -a '(__steeve_versions)' -d 'Version'
+complete -c steeve    -f -n '__fish_seen_subcommand_from verify' -l full                  -d 'Hash all files'
+
+complete -c steeve    -f -n '__steeve_no_subcommand'             -a pack                  -d 'Write installed version as tar.gz archive'
+complete -c steeve -A -f -n '__steeve_await_package pack'        -a '(__steeve_packages)' -d 'Package'
+complete -c steeve -A -f -n '__steeve_await_version pack'        -a '(__steeve_versions)' -d 'Version'
+complete -c steeve    -r -n '__fish_seen_subcommand_from pack'   -s o -l output           -d 'Write archive to file'
+
+complete -c steeve    -f -n '__steeve_no_subcommand'             -a recover               -d 'Finish or roll back interrupted operations'
+complete -c steeve    -f -n '__steeve_no_subcommand'             -a serve                 -d 'Keep running and execute commands of other processes'
@@ -17,11 +17,13 @@ setup(
     zip_safe=False,
     entry_points={
         'console_scripts': [
-            'steeve = steeve:cli',
+            'steeve = steeve:main',
         ],
     },
     install_requires=[
         'click>=5,<6',
+        'futures; python_version < "3"',
+        'scandir; python_version < "3.5"',
         'whichcraft',
     ],
     classifiers=[
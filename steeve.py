@@ -1,20 +1,70 @@
-from collections import namedtuple
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import closing, contextmanager
+import array
+import bz2
+import ctypes
+import ctypes.util
 import errno
+import fcntl
+import fnmatch
+import functools
+import hashlib
+import io
+import itertools
+import json
+import multiprocessing
 import os
+import re
+import select
 import shutil
+import signal
+import socket
+import sqlite3
+import stat
+import struct
 import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import traceback
+import zlib
 
 import click
 from whichcraft import which
 
 __version__ = '0.2'
 
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+try:
+    from urllib.error import HTTPError, URLError
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import HTTPError, Request, URLError, urlopen
+
+COPY_MODES = ('copy', 'reflink', 'hardlink', 'move')
+LINK_MODES = ('symlink', 'hardlink', 'reflink')
+
 
 def validate_dir(ctx, param, value):
-    if value is not None and (os.path.sep in value or '\0' in value):
-        raise click.BadParameter("must be a directory name.")
-    if param.name == 'version' and value == 'current':
-        raise click.BadParameter("must not be 'current'.")
+    for name in value if isinstance(value, tuple) else (value,):
+        if name is not None and (os.path.sep in name or '\0' in name):
+            raise click.BadParameter("must be a directory name.")
+        if name is not None and name.startswith('.'):
+            raise click.BadParameter("must not start with '.'.")
+        if param.name == 'version' and name == 'current':
+            raise click.BadParameter("must not be 'current'.")
     return value
 
 
@@ -25,9 +75,98 @@ def show_version(ctx, param, value):
     ctx.exit()
 
 
-def check_stow():
-    if which('stow') is None:
+def parse_size(ctx, param, value):
+    """Convert size like ``500M`` or ``2G`` to bytes."""
+    if value is None:
+        return
+    match = re.match(r'^(\d+(?:\.\d+)?)([KMGT]?)B?$', value.upper())
+    if match is None:
+        raise click.BadParameter("must be a size like 500M or 2G.")
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' KMGT'.index(unit or ' '))
+
+
+def validate_source(ctx, param, value):
+    if value != '-' and not is_url(value) and not os.path.exists(value):
+        raise click.BadParameter('Path "{}" does not exist.'.format(value))
+    return value
+
+
+def validate_sha256(ctx, param, value):
+    if value is not None and not re.match(r'^[0-9a-fA-F]{64}$', value):
+        raise click.BadParameter("must be 64 hexadecimal digits.")
+    return value and value.lower()
+
+
+def load_manifest(fileobj):
+    """Read mapping of packages to versions from TOML or JSON manifest.
+
+    Packages are listed in ``packages`` table, ``false`` or ``null`` version
+    means the package must be unstowed.
+    """
+    data = fileobj.read().decode('utf-8')
+    try:
+        if fileobj.name.endswith('.json') or data.lstrip().startswith('{'):
+            manifest = json.loads(data)
+        else:
+            manifest = load_toml(data)
+    except ValueError as err:
+        raise click.ClickException(
+            "cannot read manifest '{}': {}"
+            .format(fileobj.name, err))
+
+    packages = manifest.get('packages', {})
+    if not isinstance(packages, dict):
+        raise click.ClickException("manifest must have 'packages' table")
+    versions = {}
+    for package, version in packages.items():
+        if version is False:
+            version = None
+        if not is_name(package):
+            raise click.ClickException(
+                "invalid package '{}' in manifest"
+                .format(package))
+        if version is not None and (not is_name(version) or
+                                    version == 'current'):
+            raise click.ClickException(
+                "invalid version '{}' of package '{}' in manifest"
+                .format(version, package))
+        versions[package] = version
+    return versions
+
+
+def is_name(value):
+    return (isinstance(value, string_types) and value != '' and
+            not value.startswith('.') and
+            os.path.sep not in value and '\0' not in value)
+
+
+def load_toml(data):
+    try:
+        import tomllib as toml
+    except ImportError:
+        try:
+            import toml
+        except ImportError:
+            raise click.ClickException(
+                "TOML manifests require Python 3.11 or 'toml' package")
+    return toml.loads(data)
+
+
+def read_targets(fileobj):
+    """Read paths of targets from file, skip blank lines and comments."""
+    for line in fileobj:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+
+def check_stow(steeve):
+    """Prepare for changes: check that GNU Stow is installed if it's used
+    and recover operations that were interrupted."""
+    if steeve.gnu_stow and which('stow') is None:
         raise click.ClickException("GNU Stow is not installed")
+    steeve.recover(auto=True)
 
 
 required_package_argument = click.argument(
@@ -40,7 +179,7 @@ required_version_argument = click.argument(
     'version', callback=validate_dir)
 version_argument = click.argument(
     'version', required=False, callback=validate_dir)
-required_path_argument = click.argument('path', type=click.Path(exists=True))
+required_path_argument = click.argument('path', callback=validate_source)
 
 yes_option = click.option(
     '-y', '--yes', is_flag=True,
@@ -51,33 +190,101 @@ yes_option = click.option(
 @click.option('-d', '--dir', envvar='STEEVE_DIR', metavar='DIR',
               default='/usr/local/stow',
               help="Set location of packages to DIR.")
-@click.option('-t', '--target', envvar='STEEVE_TARGET', metavar='DIR',
-              default=None,
-              help="Set stow target to DIR (default is parent of stow dir).")
+@click.option('-t', '--target', 'targets', envvar='STEEVE_TARGET',
+              type=click.Path(), multiple=True, metavar='DIR',
+              help="Set stow target to DIR (default is parent of stow dir). "
+                   "Can be given several times.")
+@click.option('--targets-file', type=click.File('r'), metavar='FILE',
+              help="Read stow targets from FILE, one per line.")
 @click.option('--no-folding', envvar='STEEVE_NO_FOLDING', is_flag=True,
               help="Disable folding of newly stowed directories.")
 @click.option('-v', '--verbose', envvar='STEEVE_VERBOSE', count=True,
               help="Increase verbosity.")
+@click.option('--gnu-stow', envvar='STEEVE_GNU_STOW', is_flag=True,
+              help="Link packages with GNU Stow instead of built-in engine.")
+@click.option('-j', '--jobs', envvar='STEEVE_JOBS', type=click.IntRange(1),
+              default=None, metavar='N',
+              help="Run N parallel jobs (default is number of CPUs).")
+@click.option('-n', '--dry-run', is_flag=True,
+              help="Make changes in memory and print them instead of "
+                   "modifying packages and targets.")
+@click.option('--timings', is_flag=True,
+              help="Print how long every step took when done.")
+@click.option('--trace', envvar='STEEVE_TRACE', type=click.Path(),
+              metavar='FILE',
+              help="Write how long every step took to FILE in Chrome trace "
+                   "format.")
 @click.option('--version', is_flag=True, callback=show_version,
               expose_value=False,
               help="Show version and exit.")
 @click.pass_context
-def cli(ctx, dir, target, no_folding, verbose):
+def cli(ctx, dir, targets, targets_file, no_folding, verbose, gnu_stow,
+        jobs, dry_run, timings, trace):
+    if timings or trace:
+        TRACER.start()
+        ctx.call_on_close(lambda: TRACER.finish(
+            'steeve {}'.format(ctx.invoked_subcommand), timings, trace))
     dir = os.path.abspath(dir)
-    if target is None:
-        target = os.path.dirname(dir)
-    ctx.obj = Steeve(dir, target, no_folding, verbose)
+    targets = list(targets)
+    if targets_file is not None:
+        targets.extend(read_targets(targets_file))
+    if not targets:
+        targets = [os.path.dirname(dir)]
+    targets = tuple(sorted(set(os.path.abspath(target)
+                               for target in targets)))
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if dry_run and gnu_stow:
+        raise click.ClickException("--dry-run doesn't support --gnu-stow")
+    fs = MemoryFS(POSIX) if dry_run else POSIX
+    ctx.obj = Steeve(dir, targets, no_folding, verbose, gnu_stow, jobs, fs)
+    TRIGGERS.load(os.path.join(dir, '.steeve', 'triggers'))
+    if not dry_run:
+        # Triggers of changes made before a command failed still run
+        ctx.call_on_close(lambda: TRIGGERS.run(jobs))
+
+
+@cli.resultcallback()
+def report(result, dry_run, **params):
+    steeve = click.get_current_context().obj
+    if dry_run:
+        steeve.report()
+    else:
+        failed = TRIGGERS.run(steeve.jobs)
+        if failed:
+            raise click.ClickException(
+                '{} trigger{} failed'.format(failed,
+                                             's' if failed > 1 else ''))
 
 
-@cli.command(help="Install/reinstall package from given folder.")
+@cli.command(help="Install/reinstall package from given folder, tar "
+                  "archive or its URL ('-' reads archive from standard "
+                  "input).")
 @required_package_argument
 @required_version_argument
 @required_path_argument
 @yes_option
+@click.option('--copy-mode', envvar='STEEVE_COPY_MODE',
+              type=click.Choice(COPY_MODES), default='copy',
+              help="Copy files, clone them, hard link them or move the "
+                   "whole folder.  Falls back to copying when the mode is "
+                   "not supported.")
+@click.option('--strip-components', type=click.IntRange(0), default=0,
+              metavar='N',
+              help="Strip N leading components from archive file names.")
+@click.option('--dedup', envvar='STEEVE_DEDUP', is_flag=True,
+              help="Hard link files that other versions already have.")
+@click.option('--sha256', callback=validate_sha256, metavar='HEX',
+              help="Fail unless SHA-256 checksum of archive matches HEX.")
+@click.option('--checksum', is_flag=True,
+              help="When reinstalling from folder, compare contents of "
+                   "files instead of their size and modification time.")
 @click.pass_obj
-def install(steeve, package, version, path, yes):
-    check_stow()
-    steeve.install(package, version, path, yes)
+def install(steeve, package, version, path, yes, copy_mode,
+            strip_components, dedup, sha256, checksum):
+    check_stow(steeve)
+    steeve.install(package, version, path, yes, copy_mode, strip_components,
+                   dedup, sha256, checksum)
 
 
 @cli.command(help="Remove the whole package or specific version.")
@@ -86,230 +293,4704 @@ def install(steeve, package, version, path, yes):
 @version_argument
 @click.pass_obj
 def uninstall(steeve, package, version, yes):
-    check_stow()
+    check_stow(steeve)
     steeve.uninstall(package, version, yes)
 
 
 @cli.command(help="Stow/restow given version into target dir.")
 @required_package_argument
 @required_version_argument
+@click.option('--plan', is_flag=True,
+              help="Print links that would change and conflicts without "
+                   "modifying anything.")
+@click.option('--link-mode', envvar='STEEVE_LINK_MODE',
+              type=click.Choice(LINK_MODES),
+              help="Link files into target with symlinks, or put hard links "
+                   "or clones of them there instead.  Remembered for the "
+                   "package (default is the last mode or symlink).")
 @click.pass_obj
-def stow(steeve, package, version):
-    check_stow()
-    steeve.stow(package, version)
+def stow(steeve, package, version, plan, link_mode):
+    if not plan:
+        check_stow(steeve)
+    steeve.stow(package, version, plan, link_mode)
 
 
 @cli.command(help="Delete stowed symlinks.")
 @required_packages_argument
 @click.pass_obj
 def unstow(steeve, packages):
-    check_stow()
+    check_stow(steeve)
     for package in packages:
         steeve.unstow(package, strict=True)
 
 
+@cli.command(help="Watch version folder and add or remove links of files "
+                  "that appear or disappear in it (default is current "
+                  "version).")
+@required_package_argument
+@version_argument
+@click.option('--delay', type=float, default=0.2, show_default=True,
+              metavar='SECONDS',
+              help="Update links once changes settle for SECONDS.")
+@click.pass_obj
+def watch(steeve, package, version, delay):
+    check_stow(steeve)
+    steeve.watch(package, version, delay)
+
+
+@cli.command(help="Stow versions of packages listed in TOML or JSON "
+                  "manifest.")
+@click.argument('manifest', type=click.File('rb'))
+@click.pass_obj
+def apply(steeve, manifest):
+    check_stow(steeve)
+    steeve.apply(load_manifest(manifest))
+
+
+@cli.command(help="Hard link identical files of installed versions.")
+@package_argument
+@version_argument
+@click.pass_obj
+def dedup(steeve, package, version):
+    steeve.dedup(package, version)
+
+
+@cli.command(help="Delete uninstalled versions and old versions that don't "
+                  "fit retention policy.")
+@click.argument('packages', nargs=-1, callback=validate_dir)
+@click.option('--keep', type=click.IntRange(1), metavar='N',
+              help="Keep N most recently stowed versions of each package.")
+@click.option('--max-size', callback=parse_size, metavar='SIZE',
+              help="Remove least recently stowed versions until the rest "
+                   "fit in SIZE.")
+@yes_option
+@click.pass_obj
+def gc(steeve, packages, keep, max_size, yes):
+    check_stow(steeve)
+    steeve.gc(packages, keep, max_size, yes)
+
+
+@cli.command(help="Show which package owns given path.")
+@click.argument('path', type=click.Path())
+@click.pass_obj
+def owns(steeve, path):
+    steeve.owns(path)
+
+
+@cli.command(help="List files of package version (default is current).")
+@required_package_argument
+@version_argument
+@click.pass_obj
+def files(steeve, package, version):
+    steeve.files(package, version)
+
+
+@cli.command(help="Finish or roll back operations that were interrupted.")
+@click.pass_obj
+def recover(steeve):
+    if steeve.gnu_stow and which('stow') is None:
+        raise click.ClickException("GNU Stow is not installed")
+    if not steeve.recover():
+        click.echo('Nothing to recover')
+
+
+@cli.command(help="Check that files of installed versions and links in "
+                  "target didn't change since install.")
+@package_argument
+@version_argument
+@click.option('--full', is_flag=True,
+              help="Hash all files, even the ones whose size, modification "
+                   "time and inode didn't change.")
+@click.pass_obj
+def verify(steeve, package, version, full):
+    steeve.verify(package, version, full)
+
+
+@cli.command(help="Write installed version as reproducible tar.gz archive "
+                  "with its manifest.")
+@required_package_argument
+@required_version_argument
+@click.option('-o', '--output', type=click.File('wb'), default='-',
+              help="Write archive to file instead of standard output.")
+@click.pass_obj
+def pack(steeve, package, version, output):
+    steeve.pack(package, version, output)
+
+
+@cli.command(help="Keep running and execute commands of other steeve "
+                  "processes, so they don't have to start from scratch.")
+@click.pass_obj
+def serve(steeve):
+    if not hasattr(socket, 'CMSG_LEN'):
+        raise click.ClickException("serve is not supported on this platform")
+    Server(steeve, steeve.meta_path('serve.sock')).serve_forever()
+
+
 @cli.command(help="List packages or package versions.")
 @package_argument
 @click.option('-q', '--quiet', is_flag=True,
               help="Display packages or versions without formatting.")
+@click.option('-l', '--long', is_flag=True,
+              help="Display current version, install time and disk usage.")
+@click.option('--json', 'as_json', is_flag=True,
+              help="Display the same as --long, one JSON object per line.")
+@click.option('--sort', type=click.Choice(['name', 'time', 'size']),
+              default='name', help="Sort by name, install time or size.")
 @click.pass_obj
-def ls(steeve, package, quiet):
-    steeve.ls(package, quiet)
+def ls(steeve, package, quiet, long, as_json, sort):
+    steeve.ls(package, quiet, long, as_json, sort)
+
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class Tracer(object):
+    """Record how long steps of commands take.
+
+    Nothing is recorded until :meth:`start` is called.  Spans are kept as
+    tuples of name, start, duration, thread, depth and arguments, and are
+    printed as indented list or written in Chrome trace event format which
+    chrome://tracing and Perfetto load.
+    """
+
+    def __init__(self):
+        self.spans = None
+        self.local = threading.local()
+
+    def start(self):
+        self.spans = []
+        self.started = timer()
+        self.local.stack = self.main = [{}]
+
+    def _stack(self):
+        """Return open spans of the current thread.
 
+        Threads of pools start with the spans that were open in the main
+        thread when they first record one, so their spans are nested
+        under the span that started the pool.
+        """
+        if self.spans is None:
+            return None
+        stack = getattr(self.local, 'stack', None)
+        if stack is None or stack[0] is not self.main[0]:
+            stack = self.local.stack = list(self.main)
+        return stack
 
-class Steeve(namedtuple('Steeve', 'dir target no_folding verbose')):
-    def install(self, package, version, path, yes=False):
-        if self.package_exists(package, version):
-            self.uninstall_version(package, version, yes, reinstall=True)
+    @contextmanager
+    def span(self, name, **args):
+        """Record duration of the block.
 
+        Yield dict of arguments of the span, so the block can add counts to
+        it.
+        """
+        stack = self._stack()
+        if stack is None:
+            yield args
+            return
+        stack.append(args)
+        start = timer()
         try:
-            shutil.copytree(path, self.package_path(package, version))
-        except OSError as err:
+            yield args
+        finally:
+            stack.pop()
+            self.spans.append((name, start, timer() - start,
+                               threading.current_thread().ident,
+                               len(stack), args))
+
+    def annotate(self, **args):
+        """Add arguments to the innermost span."""
+        stack = self._stack()
+        if stack is not None:
+            stack[-1].update(args)
+
+    def finish(self, name, timings=False, path=None):
+        """Print spans if *timings* is true, write them to *path*."""
+        self.spans.append((name, self.started, timer() - self.started,
+                           threading.current_thread().ident, 0,
+                           self.main[0]))
+        spans = sorted(self.spans, key=lambda span: (span[1], span[4]))
+        self.spans = None
+        if timings:
+            for name, start, duration, thread, depth, args in spans:
+                click.echo('{:<32} {:>8.3f}s {}'.format(
+                    '  ' * depth + name, duration,
+                    ' '.join('{}={}'.format(key, value)
+                             for key, value in sorted(args.items())))
+                    .rstrip(), err=True)
+        if path:
+            events = [{
+                'name': name,
+                'ph': 'X',
+                'ts': (start - self.started) * 1e6,
+                'dur': duration * 1e6,
+                'pid': os.getpid(),
+                'tid': thread,
+                'args': args,
+            } for name, start, duration, thread, depth, args in spans]
+            with open(path, 'w') as fp:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'},
+                          fp)
+
+
+TRACER = Tracer()
+
+
+class Triggers(object):
+    """Shell commands that run when paths in target that match their
+    patterns change.
+
+    Triggers are read by :meth:`load`.  Changed paths are passed to
+    :meth:`add`, which queues every matching command once per target, and
+    :meth:`run` runs the queue at the end of the command, different
+    commands in parallel.
+    """
+
+    def __init__(self):
+        self.rules = []
+        self.pending = set()
+
+    def load(self, path):
+        """Read triggers from file, one per line: glob pattern of paths
+        relative to target and command.  Blank lines and comments are
+        skipped, missing file means no triggers."""
+        self.rules = []
+        self.pending = set()
+        try:
+            fileobj = open(path)
+        except IOError as err:
             if err.errno == errno.ENOENT:
-                raise click.ClickException(
-                    "source path '{}' does not exist"
-                    .format(path))
-            elif err.errno == errno.EEXIST and os.path.isdir(path):
-                raise click.ClickException(
-                    "the package '{}/{}' is already installed"
-                    .format(package, version))
-            else:
-                raise
+                return
+            raise
+        with fileobj:
+            for number, line in enumerate(fileobj, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                parts = line.split(None, 1)
+                if len(parts) < 2:
+                    raise click.ClickException(
+                        '{}:{}: trigger has no command'.format(path, number))
+                self.rules.append((parts[0].split('/'), parts[1]))
 
-        self.stow(package, version)
+    def add(self, target, paths):
+        """Queue commands of triggers that match *paths* relative to
+        *target*.
 
-    def uninstall(self, package, version=None, yes=False):
-        if not self.package_exists(package, version):
-            if version is not None:
-                raise click.ClickException(
-                    "the package '{}/{}' is not installed"
-                    .format(package, version))
+        Patterns are matched component by component, so a path matches if
+        it's inside a folder that matches, or if it's a folder or folded
+        link that could contain matching paths.
+        """
+        for rel in paths:
+            parts = rel.split(os.path.sep)
+            for pattern, command in self.rules:
+                if all(fnmatch.fnmatchcase(part, glob)
+                       for part, glob in zip(parts, pattern)):
+                    self.pending.add((target, command))
+
+    def take(self):
+        """Return queued pairs of targets and commands and clear the
+        queue."""
+        pending, self.pending = sorted(self.pending), set()
+        return pending
+
+    def run(self, jobs=1):
+        """Run queued commands in their targets, return number of the ones
+        that failed."""
+        pending = self.take()
+        if not pending:
+            return 0
+
+        def call(item):
+            target, command = item
+            with TRACER.span('trigger', target=target,
+                             command=command) as span:
+                status = subprocess.call(
+                    command, shell=True, cwd=target,
+                    env=dict(os.environ, STEEVE_TARGET=target))
+                span['status'] = status
+            if status:
+                click.echo("Trigger '{}' returned code {} in {}"
+                           .format(command, status, target), err=True)
+            return status
+
+        with ThreadPoolExecutor(jobs) as executor:
+            return sum(1 for status in executor.map(call, pending) if status)
+
+
+TRIGGERS = Triggers()
+
+
+def traced(name):
+    """Decorate method to record its calls as spans named *name*."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with TRACER.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Steeve(namedtuple('Steeve',
+                         'dir targets no_folding verbose gnu_stow jobs fs')):
+    """Packages in *dir* stowed into *targets*.
+
+    Packages and targets are changed through filesystem backend *fs*, see
+    :class:`FileSystem`.
+    """
+
+    @traced('install')
+    def install(self, package, version, path, yes=False, copy_mode='copy',
+                strip_components=0, dedup=False, sha256=None,
+                checksum=False, resume=None):
+        """Install version from folder or archive and stow it.
+
+        Existing version is replaced by a new copy that hard links files
+        that didn't change from it, see :meth:`staging`.  Files are
+        compared by size and modification time, or by contents if
+        *checksum* is true.  *resume* is a folder left by interrupted
+        install to hard link files from instead.
+        """
+        TRACER.annotate(package=package, version=version)
+        with self.lock([package]):
+            replace = self.package_exists(package, version)
+            known = {}
+            if replace and self.gnu_stow:
+                self.uninstall_version(package, version, yes, reinstall=True)
+                replace = False
+            elif replace:
+                if not yes:
+                    confirm("Are you sure you want to reinstall package "
+                            "'{}/{}'?".format(package, version))
+                with self.index() as index:
+                    known = index.manifest(package, version)
+            stowed = replace and version == self.current_version(package)
+            if resume is not None:
+                base = resume
+            elif replace:
+                base = self.package_path(package, version)
             else:
-                raise click.ClickException(
-                    "the package '{}' is not installed"
-                    .format(package))
+                base = None
+
+            with self.journal(
+                    'install', "installing '{}/{}'".format(package, version),
+                    package=package, version=version,
+                    path=path if path == '-' or is_url(path)
+                    else os.path.abspath(path),
+                    copy_mode=copy_mode, strip_components=strip_components,
+                    dedup=dedup, sha256=sha256, checksum=checksum,
+                    replace=replace) as journal:
+                moved = (copy_mode == 'move' and path != '-' and
+                         not is_url(path) and self.fs.isdir(path))
+                with self.staging(package, version, replace, journal,
+                                  os.path.abspath(path) if moved
+                                  else None) as staging:
+                    if (path != '-' and not is_url(path) and
+                            self.fs.isdir(path)):
+                        try:
+                            with TRACER.span('copy') as span:
+                                modes = self.fs.copytree(
+                                    path, staging, copy_mode, self.jobs, base,
+                                    known if checksum and resume is None
+                                    else None)
+                                span['modes'] = ', '.join(sorted(modes))
+                        except OSError as err:
+                            if err.errno == errno.ENOENT:
+                                raise click.ClickException(
+                                    "source path '{}' does not exist"
+                                    .format(path))
+                            else:
+                                raise
+                        if self.verbose > 0 or modes != set([copy_mode]):
+                            click.echo("Installed '{}/{}' with copy mode: {}"
+                                       .format(package, version,
+                                               ', '.join(sorted(modes))))
+                    elif self.fs.in_memory:
+                        raise click.ClickException(
+                            "installing archives doesn't support --dry-run")
+                    else:
+                        with TRACER.span('extract'):
+                            known = self.extract(path, staging,
+                                                 strip_components, sha256)
+                    if dedup and self.fs.in_memory:
+                        raise click.ClickException(
+                            "--dedup doesn't support --dry-run")
+                    elif dedup:
+                        with self.lock_objects(), \
+                                TRACER.span('dedup') as span:
+                            saved = dedup_tree(staging,
+                                               self.meta_path('objects'),
+                                               self.jobs)
+                            span['bytes_saved'] = saved
+                        if self.verbose > 0:
+                            click.echo("Deduplicated '{}/{}': saved {}"
+                                       .format(package, version,
+                                               format_size(saved)))
+
+                self.finish_install(package, version, known, stowed)
+        self.update_completion()
+        self.empty_trash(wait=False)
 
-        if version is not None:
-            self.uninstall_version(package, version, yes)
+    def finish_install(self, package, version, known=None, stowed=False):
+        """Record manifest of installed version and stow it, unless it's
+        already *stowed*."""
+        with TRACER.span('manifest') as span:
+            manifest = self.fs.manifest(self.package_path(package, version),
+                                        self.jobs, known)
+            span['files'] = len(manifest)
+            span['bytes'] = sum(entry.size for entry in manifest.values())
+        with self.index() as index:
+            old = index.manifest(package, version) if stowed else {}
+            index.set_files(package, version, manifest)
+            index.set_manifest(package, version, manifest)
+            index.set_installed(package, version, time.time())
+        if not stowed:
+            self.stow(package, version)
         else:
-            self.uninstall_package(package, yes)
+            # Links may stay the same while files behind them change
+            self.trigger(os.path.join(target, rel)
+                         for rel in set(old) | set(manifest)
+                         if old.get(rel, ())[:3] != manifest.get(rel, ())[:3]
+                         for target in self.targets)
 
-    def uninstall_package(self, package, yes=False):
-        if not yes:
-            click.echo("Uninstalling '{}' and all its versions:"
-                       .format(package))
-            self.ls(package)
-            click.confirm('Proceed?', abort=True)
+    @contextmanager
+    def staging(self, package, version, replace=False, journal=None,
+                source=None):
+        """Prepare version in a temporary folder and move it into place.
 
-        self.unstow(package)
+        If *replace* is true, installed version is atomically swapped with
+        the new one and moved to trash.  If it's the current version, only
+        links that differ between the two are changed.  Nothing is left
+        behind if preparation fails, except that the temporary folder is
+        moved back to *source* if it was moved from there.  Progress is
+        written to *journal*.
+        """
+        path = self.package_path(package, version)
+        if not self.fs.isdir(self.package_path(package)):
+            self.fs.makedirs(self.package_path(package))
+        # Leftovers of interrupted installs are kept, since they might be
+        # resumed from
+        for attempt in itertools.count():
+            staging = os.path.join(
+                self.package_path(package), '.{}.{}{}.steeve-tmp'.format(
+                    version, os.getpid(),
+                    '-{}'.format(attempt) if attempt else ''))
+            if not self.fs.lexists(staging):
+                break
+        inode = None
         try:
-            shutil.rmtree(self.package_path(package))
-        except OSError as err:
-            if err.errno == errno.ENOENT:
-                raise click.ClickException(
-                    "package '{}' does not exist"
-                    .format(package))
+            if journal is not None:
+                journal.write(phase='copy', staging=staging)
+            yield staging
+            inode = self.fs.lstat(staging).st_ino
+            if journal is not None:
+                journal.write(phase='staged', inode=inode)
+            if replace:
+                self.replace_version(package, version, staging)
             else:
-                raise
+                try:
+                    self.fs.rename(staging, path)
+                except OSError as err:
+                    if err.errno in (errno.EEXIST, errno.ENOTEMPTY):
+                        raise click.ClickException(
+                            "the package '{}/{}' is already installed"
+                            .format(package, version))
+                    else:
+                        raise
+            if journal is not None:
+                journal.write(phase='installed')
+        except BaseException:
+            if (source is not None and not self.fs.lexists(source) and
+                    self.fs.lexists(staging) and
+                    inode in (None, self.fs.lstat(staging).st_ino)):
+                # Source folder was moved here, it's the only copy
+                self.fs.rename(staging, source)
+            else:
+                self.fs.rmtree(staging, ignore_errors=True)
+            if not self.fs.listdir(self.package_path(package)):
+                self.fs.rmdir(self.package_path(package))
+            raise
+        if replace:
+            self.trash(staging)
 
-    def uninstall_version(self, package, version, yes=False, reinstall=False):
-        if not yes:
-            action = 'reinstall' if reinstall else 'uninstall'
-            click.confirm(
-                "Are you sure you want to {} package '{}/{}'?"
-                .format(action, package, version),
-                abort=True)
+    def replace_version(self, package, version, path):
+        """Swap installed version with folder *path*.
 
-        if version == self.current_version(package):
-            self.unstow(package)
+        If the version is current, links that only the new contents have
+        are created before the swap and links that only the old contents
+        have are removed after it.
+        """
+        dst = self.package_path(package, version)
+        if version == self.current_version(package) and not self.gnu_stow:
+            self.switch({package: version}, roots={package: path},
+                        swap=(path, dst))
+        else:
+            self.fs.exchange(path, dst)
+
+    def extract(self, path, dst, strip_components=0, sha256=None):
+        """Extract tar archive from file, URL or standard input.
+
+        Archive downloaded from scratch is extracted while it's downloaded
+        and saved to download cache once it's complete.  Return manifest of
+        extracted files, see :func:`extract_tar`.
+        """
+        if is_url(path):
+            with self.lock_download(path):
+                return self.extract_archive(path, dst, strip_components,
+                                            sha256)
+        else:
+            return self.extract_archive(path, dst, strip_components, sha256)
 
+    def extract_archive(self, path, dst, strip_components, sha256):
+        part = None
         try:
-            shutil.rmtree(self.package_path(package, version))
-        except OSError as err:
-            if err.errno == errno.ENOENT:
-                raise click.ClickException(
-                    "package '{}/{}' is not installed"
-                    .format(package, version))
+            if is_url(path):
+                fileobj, part = self.download(path, sha256)
+            elif path == '-':
+                fileobj = click.get_binary_stream('stdin')
             else:
+                fileobj = open(path, 'rb')
+        except EnvironmentError as err:
+            if not isinstance(err, (HTTPError, URLError)):
+                raise
+            raise click.ClickException(
+                "cannot download '{}': {}"
+                .format(path, getattr(err, 'reason', err)))
+        stream = Digesting(fileobj, part)
+        try:
+            with open_tar(stream) as tar:
+                manifest = extract_tar(tar, dst, strip_components)
+            digest = stream.hexdigest()
+            if part is not None:
+                part.close()
+                if sha256 is None or digest == sha256:
+                    self.save_download(path, [part.name], digest)
+            if sha256 is not None and digest != sha256:
+                raise click.ClickException(
+                    "checksum of '{}' doesn't match: {}"
+                    .format(path, digest))
+            return manifest
+        except ARCHIVE_ERRORS as err:
+            if isinstance(err, EnvironmentError) and err.errno is not None:
                 raise
+            raise click.ClickException(
+                "cannot extract '{}': {}"
+                .format(path, err))
+        finally:
+            if path != '-':
+                fileobj.close()
+            if part is not None:
+                part.close()
 
-        # Remove empty package folder
-        if not os.listdir(self.package_path(package)):
-            os.rmdir(self.package_path(package))
+    def download(self, url, sha256=None):
+        """Open archive at *url* through download cache.
 
-    def stow(self, package, version):
-        if not os.path.exists(self.package_path(package, version)):
-            raise click.ClickException(
-                "package '{}/{}' is not installed"
-                .format(package, version))
+        Return file object and partial file that it must be copied to, or
+        ``None`` if the file object reads from cache.  Cached archive is
+        revalidated with ETag or Last-Modified date, unless *sha256* pins
+        its contents.  Interrupted downloads are resumed and large archives
+        are downloaded in parallel chunks before they are opened.
+        """
+        downloads = self.meta_path('downloads')
+        if not os.path.isdir(downloads):
+            os.makedirs(downloads)
+        if sha256 is not None and os.path.exists(os.path.join(downloads,
+                                                              sha256)):
+            return open(os.path.join(downloads, sha256), 'rb'), None
+        with self.index() as index:
+            entry = index.download(url)
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        parts = download_parts(downloads, key)
+
+        headers = {}
+        cached = entry and entry['sha256'] and os.path.join(downloads,
+                                                            entry['sha256'])
+        if cached and os.path.exists(cached):
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['modified']:
+                headers['If-Modified-Since'] = entry['modified']
+        elif entry and parts and entry_validator(entry):
+            if self.verbose > 0:
+                click.echo("Resuming download of '{}'".format(url), err=True)
+            try:
+                self.fetch_parts(url, parts, entry)
+            except DownloadChanged:
+                pass
+            else:
+                return open(self.save_download(url, parts), 'rb'), None
 
-        self.unstow(package)
-        self.link_current(package, version)
-        options = []
-        if self.no_folding:
-            options.append('--no-folding')
+        try:
+            response = urlopen(Request(url, headers=headers), timeout=60)
+        except HTTPError as err:
+            if err.code != 304:
+                raise
+            if self.verbose > 0:
+                click.echo("Using cached '{}'".format(url), err=True)
+            return open(cached, 'rb'), None
+        for path in parts:
+            os.remove(path)
+        info = response.info()
+        size = info.get('Content-Length')
+        size = int(size) if size and size.isdigit() else None
+        entry = {'etag': info.get('ETag'),
+                 'modified': info.get('Last-Modified'),
+                 'size': size,
+                 'sha256': None}
+        with self.index() as index:
+            index.set_download(url, entry)
         if self.verbose > 0:
-            options.append('--verbose={}'.format(self.verbose))
-        status = subprocess.call([
-            'stow'
-        ] + options + [
-            '-t', self.target,
-            '-d', self.package_path(package),
-            'current',
-        ])
-        if status:
-            self.remove_current(package)
-            raise click.ClickException(
-                'stow returned code {}'
-                .format(status))
+            click.echo("Downloading '{}'".format(url), err=True)
 
-    def unstow(self, package, strict=False):
-        if self.current_version(package) is None:
-            if strict:
+        ranges = info.get('Accept-Ranges', '').lower() == 'bytes'
+        if (ranges and size is not None and size >= 2 * DOWNLOAD_CHUNK and
+                self.jobs > 1 and entry_validator(entry)):
+            response.close()
+            parts = [os.path.join(downloads, '{}.{}.part'.format(key, start))
+                     for start in range(0, size, DOWNLOAD_CHUNK)]
+            try:
+                self.fetch_parts(url, parts, entry)
+            except DownloadChanged:
+                for path in parts:
+                    if os.path.exists(path):
+                        os.remove(path)
                 raise click.ClickException(
-                    "package '{}' is not stowed"
-                    .format(package))
-            else:
-                return
+                    "'{}' changed while downloading it".format(url))
+            return open(self.save_download(url, parts), 'rb'), None
+        path = os.path.join(downloads, '{}.0.part'.format(key))
+        return response, open(path, 'wb')
 
-        status = subprocess.call([
-            'stow',
-            '-t', self.target,
-            '-d', self.package_path(package),
-            '-D',
-            'current',
-        ])
-        if status:
+    def fetch_parts(self, url, parts, entry):
+        """Download missing ranges of partial files in parallel."""
+        starts = [int(path.rsplit('.', 2)[1]) for path in parts]
+        ends = [start - 1 for start in starts[1:]]
+        ends.append(None if entry['size'] is None else entry['size'] - 1)
+        with ThreadPoolExecutor(self.jobs) as executor:
+            futures = [executor.submit(fetch_range, url, path, start, end,
+                                       entry_validator(entry))
+                       for path, start, end in zip(parts, starts, ends)]
+            for future in futures:
+                future.result()
+
+    def save_download(self, url, parts, digest=None):
+        """Join partial files into cached file named after its checksum."""
+        downloads = self.meta_path('downloads')
+        path = parts[0]
+        if len(parts) > 1:
+            path = os.path.join(downloads, '{}.{}.steeve-tmp'
+                                .format(os.path.basename(parts[0]),
+                                        os.getpid()))
+            with open(path, 'wb') as fdst:
+                for part in parts:
+                    with open(part, 'rb') as fsrc:
+                        shutil.copyfileobj(fsrc, fdst)
+        with self.index() as index:
+            entry = index.download(url)
+        size = os.path.getsize(path)
+        if entry['size'] is not None and size != entry['size']:
+            if path != parts[0]:
+                os.remove(path)
             raise click.ClickException(
-                'stow returned code {}'
-                .format(status))
-        self.remove_current(package)
+                "download of '{}' is incomplete: got {} of {} bytes"
+                .format(url, size, entry['size']))
+        if digest is None:
+            digest = file_digest(path)
+        cached = os.path.join(downloads, digest)
+        os.rename(path, cached)
+        for part in parts:
+            if os.path.exists(part):
+                os.remove(part)
+        entry['sha256'] = digest
+        with self.index() as index:
+            index.set_download(url, entry)
+        return cached
 
-    def ls(self, package=None, quiet=False):
-        if package is None:
+    def uninstall(self, package, version=None, yes=False):
+        with self.lock([package]):
+            if not self.package_exists(package, version):
+                if version is not None:
+                    raise click.ClickException(
+                        "the package '{}/{}' is not installed"
+                        .format(package, version))
+                else:
+                    raise click.ClickException(
+                        "the package '{}' is not installed"
+                        .format(package))
+
+            if version is not None:
+                self.uninstall_version(package, version, yes)
+            else:
+                self.uninstall_package(package, yes)
+        self.update_completion()
+        self.empty_trash(wait=False)
+
+    @traced('uninstall package')
+    def uninstall_package(self, package, yes=False):
+        TRACER.annotate(package=package)
+        if not yes:
+            click.echo("Uninstalling '{}' and all its versions:"
+                       .format(package))
+            self.ls(package)
+            confirm('Proceed?')
+
+        with self.journal('uninstall', "uninstalling '{}'".format(package),
+                          package=package, version=None):
+            self.unstow(package)
             try:
-                packages = os.listdir(self.dir)
+                with TRACER.span('trash'):
+                    self.trash(self.package_path(package))
             except OSError as err:
                 if err.errno == errno.ENOENT:
-                    return
+                    raise click.ClickException(
+                        "package '{}' does not exist"
+                        .format(package))
                 else:
                     raise
+            with self.index() as index:
+                index.remove_files(package)
+
+    @traced('uninstall version')
+    def uninstall_version(self, package, version, yes=False, reinstall=False):
+        TRACER.annotate(package=package, version=version)
+        if not yes:
+            action = 'reinstall' if reinstall else 'uninstall'
+            confirm("Are you sure you want to {} package '{}/{}'?"
+                    .format(action, package, version))
+
+        with self.journal('uninstall', "uninstalling '{}/{}'"
+                          .format(package, version),
+                          package=package, version=version):
+            if version == self.current_version(package):
+                self.unstow(package)
 
-            for package in packages:
-                click.echo(package)
-        else:
             try:
-                versions = os.listdir(self.package_path(package))
+                with TRACER.span('trash'):
+                    self.trash(self.package_path(package, version))
             except OSError as err:
                 if err.errno == errno.ENOENT:
                     raise click.ClickException(
-                        "no such package '{}'"
-                        .format(package))
+                        "package '{}/{}' is not installed"
+                        .format(package, version))
                 else:
                     raise
-            try:
-                versions.remove('current')
-            except ValueError:
-                pass
-            current = self.current_version(package)
-            for version in versions:
-                if not quiet:
-                    used = '* ' if current == version else '  '
-                else:
-                    used = ''
-                click.echo(used + version)
+            with self.index() as index:
+                index.remove_files(package, version)
 
-    def link_current(self, package, version):
-        current = self.package_path(package, 'current')
+            # Remove empty package folder
+            if not self.fs.listdir(self.package_path(package)):
+                self.fs.rmdir(self.package_path(package))
+
+    def dedup(self, package=None, version=None):
+        """Replace identical files of versions with links to shared ones."""
+        if package is None:
+            versions = [(package, version)
+                        for package in self.scan(self.dir)
+                        for version in self.scan(self.package_path(package))]
+        elif version is None:
+            versions = [(package, version)
+                        for version in self.scan(self.package_path(package))]
+        else:
+            versions = [(package, version)]
+
+        if self.fs.in_memory:
+            raise click.ClickException("dedup doesn't support --dry-run")
+        total = 0
+        for package, version in versions:
+            if not self.package_exists(package, version):
+                raise click.ClickException(
+                    "package '{}/{}' is not installed"
+                    .format(package, version))
+            with self.lock([package], shared=True), self.lock_objects():
+                saved = dedup_tree(self.package_path(package, version),
+                                   self.meta_path('objects'), self.jobs)
+            if self.verbose > 0:
+                click.echo("Deduplicated '{}/{}': saved {}"
+                           .format(package, version, format_size(saved)))
+            total += saved
+        click.echo('Saved {} ({} bytes)'.format(format_size(total), total))
+
+    def prune_objects(self):
+        """Remove shared files that no version links to anymore."""
+        objects = os.path.join(self.dir, '.steeve', 'objects')
+        if not os.path.isdir(objects):
+            return
+        with self.lock_objects():
+            for bucket in scandir(objects):
+                for entry in scandir(bucket.path):
+                    if entry.stat(follow_symlinks=False).st_nlink > 1:
+                        continue
+                    try:
+                        os.remove(entry.path)
+                    except OSError as err:
+                        if err.errno != errno.ENOENT:
+                            raise
+
+    def trash(self, path):
+        """Move folder out of the way to delete it later."""
+        trash = self.meta_path('trash')
+        if not self.fs.isdir(trash):
+            self.fs.makedirs(trash)
         try:
-            os.remove(current)
+            self.fs.rename(path, os.path.join(self.fs.mkdtemp(trash),
+                                              os.path.basename(path)))
         except OSError as err:
-            if err.errno != errno.ENOENT:
+            if err.errno != errno.EXDEV:
                 raise
-        os.symlink(self.package_path(package, version), current)
+            self.fs.rmtree(path)
 
-    def remove_current(self, package):
-        os.remove(self.package_path(package, 'current'))
+    def empty_trash(self, wait=True):
+        """Delete trashed folders and unused shared files.
 
-    def current_version(self, package):
-        try:
-            dst = os.readlink(self.package_path(package, 'current'))
-        except OSError as err:
-            if err.errno == errno.ENOENT:
+        Unless *wait* is true, deletion is left to a detached process and
+        this returns immediately.
+        """
+        trash = os.path.join(self.dir, '.steeve', 'trash')
+        if not self.fs.isdir(trash):
+            return
+        if self.fs.in_memory:
+            for name in self.fs.listdir(trash):
+                self.fs.rmtree(os.path.join(trash, name))
+            return
+        if not wait and hasattr(os, 'fork'):
+            pid = os.fork()
+            if pid:
+                os.waitpid(pid, 0)
+                return
+            try:
+                os.setsid()
+                if not os.fork():
+                    detach()
+                    self.empty_trash()
+            finally:
+                os._exit(0)
+
+        with TRACER.span('empty trash'):
+            with ThreadPoolExecutor(self.jobs) as executor:
+                for name in os.listdir(trash):
+                    executor.submit(shutil.rmtree, os.path.join(trash, name),
+                                    onerror=ignore_missing)
+            self.prune_objects()
+
+    def gc(self, packages=(), keep=None, max_size=None, yes=False):
+        """Uninstall old versions and delete trashed ones.
+
+        At most *keep* recently stowed versions of each package are kept,
+        then least recently stowed versions are removed until all versions
+        fit in *max_size* bytes.  Current versions are never removed.
+        """
+        if not packages:
+            try:
+                packages = self.scan(self.dir)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+        candidates = []
+        kept = []
+        size = 0
+        with self.index() as index:
+            for package in packages:
+                if not self.package_exists(package):
+                    raise click.ClickException(
+                        "the package '{}' is not installed"
+                        .format(package))
+                current = self.current_version(package)
+                infos = [self.version_info(index, package, version, current)
+                         for version in self.scan(self.package_path(package))]
+                others = sorted((info for info in infos
+                                 if not info['current']),
+                                key=lambda info: info['stowed'], reverse=True)
+                count = len(others)
+                if keep is not None:
+                    count = max(keep - (len(infos) - len(others)), 0)
+                kept.extend(others[:count])
+                candidates.extend(others[count:])
+                size += sum(info['size'] for info in infos
+                            if info['current'])
+
+        if max_size is not None:
+            kept.sort(key=lambda info: info['stowed'])
+            size += sum(info['size'] for info in kept)
+            while kept and size > max_size:
+                info = kept.pop(0)
+                size -= info['size']
+                candidates.append(info)
+
+        if candidates and not yes:
+            click.echo('Uninstalling:')
+            for info in candidates:
+                click.echo('  {}/{} ({})'.format(
+                    info['package'], info['version'],
+                    format_size(info['size'])))
+            confirm('Proceed?')
+        for info in candidates:
+            package, version = info['package'], info['version']
+            with self.lock([package]):
+                # Another process could stow the version in the meantime
+                if (self.package_exists(package, version) and
+                        version != self.current_version(package)):
+                    self.uninstall_version(package, version, yes=True)
+        if candidates:
+            self.update_completion()
+        self.empty_trash()
+
+    @traced('stow')
+    def stow(self, package, version, dry_run=False, link_mode=None):
+        TRACER.annotate(package=package, version=version)
+        link_modes = {package: link_mode} if link_mode else None
+        with self.lock([package]):
+            if not self.fs.exists(self.package_path(package, version)):
+                raise click.ClickException(
+                    "package '{}/{}' is not installed"
+                    .format(package, version))
+
+            if dry_run:
+                self.switch({package: version}, dry_run=True,
+                            link_modes=link_modes)
                 return
+
+            if self.gnu_stow:
+                if link_mode not in (None, 'symlink'):
+                    raise click.ClickException(
+                        "--gnu-stow doesn't support --link-mode {}"
+                        .format(link_mode))
+                self.unstow(package)
+                self.link_current(package, version)
+                options = []
+                if self.no_folding:
+                    options.append('--no-folding')
+                if self.verbose > 0:
+                    options.append('--verbose={}'.format(self.verbose))
+                try:
+                    self.call_stow(package, options)
+                except click.ClickException:
+                    self.remove_current(package)
+                    raise
+                finally:
+                    with self.index() as index:
+                        index.remove_links(package)
+                self.trigger_version(package, version)
             else:
-                raise
-        return os.path.basename(dst.rstrip(os.path.sep))
+                self.switch({package: version}, link_modes=link_modes)
+        self.update_completion()
 
-    def package_exists(self, package, version=None):
-        path = self.package_path(package, version)
-        return os.path.exists(path)
+    @traced('unstow')
+    def unstow(self, package, strict=False):
+        TRACER.annotate(package=package)
+        with self.lock([package]):
+            if self.current_version(package) is None:
+                if strict:
+                    raise click.ClickException(
+                        "package '{}' is not stowed"
+                        .format(package))
+                else:
+                    return
 
-    def package_path(self, package, version=None):
-        if version is None:
-            return os.path.join(self.dir, package)
-        else:
-            return os.path.join(self.dir, package, version)
+            if self.gnu_stow:
+                self.call_stow(package, ['-D'])
+                self.trigger_version(package, self.current_version(package))
+                self.remove_current(package)
+                with self.index() as index:
+                    index.remove_links(package)
+            else:
+                self.switch({package: None})
 
-if __name__ == '__main__':
-    cli()
+    def watch(self, package, version=None, delay=0.2):
+        """Keep links of version in sync with its folder until interrupted.
+
+        Folders of the version are watched with inotify(7).  Once changes
+        settle for *delay* seconds, links of nodes that appeared are added
+        and links of nodes that disappeared are removed, the rest of the
+        tree is not read.  Version is stowed first unless it's current.
+        """
+        if self.gnu_stow or self.fs.in_memory:
+            raise click.ClickException(
+                "watch doesn't support {}"
+                .format('--gnu-stow' if self.gnu_stow else '--dry-run'))
+        if version is None:
+            version = self.current_version(package)
+            if version is None:
+                raise click.ClickException(
+                    "package '{}' is not stowed"
+                    .format(package))
+        elif version != self.current_version(package):
+            self.stow(package, version)
+        root = self.package_path(package, version)
+        try:
+            inotify = Inotify()
+        except (AttributeError, OSError):
+            raise click.ClickException(
+                "watch is not supported on this platform")
+        try:
+            watch_tree(inotify, root)
+            click.echo("Watching '{}/{}'".format(package, version),
+                       err=True)
+            while True:
+                paths = set()
+                overflow = False
+                ready = select.select([inotify.fd], [], [])[0]
+                # Wait until the burst of changes is over
+                while ready:
+                    for path, mask, name in inotify.read():
+                        if path is None:
+                            overflow = True
+                        elif path == root and mask & (Inotify.IN_DELETE_SELF |
+                                                      Inotify.IN_MOVE_SELF):
+                            raise click.ClickException(
+                                "package '{}/{}' was removed"
+                                .format(package, version))
+                        elif name and mask & Inotify.ENTRIES:
+                            path = os.path.join(path, name)
+                            paths.add(os.path.relpath(path, root))
+                            if mask & Inotify.IN_ISDIR:
+                                watch_tree(inotify, path)
+                    ready = select.select([inotify.fd], [], [], delay)[0]
+
+                start = timer()
+                try:
+                    if overflow:
+                        # Events were lost, so everything is stowed again
+                        watch_tree(inotify, root)
+                        changes = self.restow(package, version)
+                    else:
+                        changes = self.update_links(package, version, paths)
+                except click.ClickException as err:
+                    click.echo('Error: {}'.format(err.format_message()),
+                               err=True)
+                    continue
+                click.echo('Linked {}, unlinked {} in {:.1f} ms'.format(
+                    sum(1 for path, old, new in changes
+                        if new[0] == 'link'),
+                    sum(1 for path, old, new in changes
+                        if old[0] == 'link'),
+                    (timer() - start) * 1000), err=True)
+                # Every batch of changes runs its triggers, not just the last
+                TRIGGERS.run(self.jobs)
+        finally:
+            inotify.close()
+
+    def update_links(self, package, version, paths):
+        """Add and remove links of *paths* in stowed version that appeared
+        or disappeared since it was stowed.
+
+        Only links of *paths* are planned, folders that became empty are
+        removed, but folders are not folded back.  Return list of changes.
+        """
+        source = self.package_path(package, 'current')
+        root = self.package_path(package, version)
+        action = "updating '{}/{}'".format(package, version)
+        with self.lock([package]), self.lock_targets():
+            if version != self.current_version(package):
+                raise click.ClickException(
+                    "package '{}/{}' is not stowed anymore"
+                    .format(package, version))
+            with self.index() as index:
+                if index.link_mode(package) != 'symlink':
+                    # Entries are planned from the index, not from paths
+                    return self.switch({package: version})
+
+            def plan_target(target):
+                stower = self.stower(target)
+                with self.index() as index:
+                    plan = Plan(target, index, self.fs)
+                    plan.roots[source] = root
+                    for rel in sorted(paths):
+                        if self.fs.lexists(os.path.join(root, rel)):
+                            stower.stow_path(plan, source, root, rel)
+                        else:
+                            stower.unstow_path(plan, source, rel)
+                    plan.index = None
+                return plan
+
+            plans = self.map_targets(plan_target)
+            with self.journal('switch', action, versions={package: version},
+                              swap=None) as journal:
+                changes, errors = self.execute(plans, action,
+                                               journal=journal)
+                self.record_links({package: version}, changes)
+            if errors:
+                raise click.ClickException(
+                    '{} failed in {} of {} targets'
+                    .format(action, len(errors), len(plans)))
+        return changes
+
+    def restow(self, package, version):
+        """Plan all links of stowed version again, return list of
+        changes."""
+        with self.lock([package]):
+            if version != self.current_version(package):
+                raise click.ClickException(
+                    "package '{}/{}' is not stowed anymore"
+                    .format(package, version))
+            return self.switch({package: version})
+
+    def apply(self, versions):
+        """Stow given versions of packages, ``None`` means unstowed.
+
+        Packages that already have the right version are left alone, the
+        rest are switched at once.
+        """
+        with self.lock(versions):
+            changes = {}
+            for package, version in sorted(versions.items()):
+                if version == self.current_version(package):
+                    continue
+                if version is not None and not self.package_exists(package,
+                                                                   version):
+                    raise click.ClickException(
+                        "package '{}/{}' is not installed"
+                        .format(package, version))
+                changes[package] = version
+            if not changes:
+                return
+
+            if self.gnu_stow:
+                for package, version in sorted(changes.items()):
+                    if version is None:
+                        self.unstow(package)
+                    else:
+                        self.stow(package, version)
+            else:
+                self.switch(changes)
+
+    def switch(self, versions, dry_run=False, roots=None, swap=None,
+               link_modes=None):
+        """Replace links of current versions with links of given versions.
+
+        *versions* maps packages to versions, ``None`` unstows the package.
+        *roots* maps packages to folders to read contents of new versions
+        from instead of their own ones.  *swap* is a pair of folders that
+        are exchanged once new links are created, right before ``current``
+        links are replaced.  *link_modes* maps packages to link modes to
+        stow them with instead of the ones they were stowed with before.
+        Entries of packages stowed with hard links or clones are found in
+        the index, so exactly those are removed or replaced.
+        If *dry_run* is true, print changes and conflicts instead.
+        Only links that differ between versions are touched.  Links point
+        into ``current``, so the ones shared by both versions are switched
+        all at once when ``current`` is replaced.  New links are created
+        before that and obsolete ones are removed after, so files that both
+        versions have are never missing from the target.  Every target is
+        planned and changed in parallel, contents of packages are read only
+        once for all of them.
+        """
+        with self.lock_targets():
+            currents = dict((package, self.current_version(package))
+                            for package in versions)
+            with self.index() as index:
+                old_modes = dict((package, index.link_mode(package))
+                                 for package in versions)
+                entries = dict((package, index.links(package))
+                               for package, mode in old_modes.items()
+                               if mode != 'symlink')
+            modes = dict(old_modes)
+            modes.update(link_modes or {})
+            actions = []
+            for package, version in sorted(versions.items()):
+                if version is not None:
+                    actions.append("stowing '{}/{}'".format(package, version))
+                else:
+                    actions.append("unstowing '{}'".format(package))
+            sources = {}
+            materialized = self.materialized(modes)
+
+            def plan_target(target):
+                stower = self.stower(target, sources, materialized)
+                with self.index() as index:
+                    plan = Plan(target, index, self.fs)
+                    for package, current in sorted(currents.items()):
+                        if current is None:
+                            continue
+                        elif package in entries:
+                            stower.remove_entries(plan, entries[package])
+                        else:
+                            stower.unstow(
+                                plan, self.package_path(package, 'current'),
+                                self.package_path(package, current))
+                    for package, version in sorted(versions.items()):
+                        if version is not None:
+                            stower.stow(
+                                plan, self.package_path(package, 'current'),
+                                (roots or {}).get(package) or
+                                self.package_path(package, version))
+                    plan.index = None
+                return plan
+
+            with TRACER.span('plan', targets=len(self.targets)):
+                plans = self.map_targets(plan_target)
+
+            if dry_run:
+                self.execute(plans, ', '.join(actions), dry_run=True)
+                return
+            if swap is not None:
+                # Inode tells whether folders were already swapped
+                swap = swap + (self.fs.lstat(swap[0]).st_ino,)
+            with self.journal('switch', ', '.join(actions),
+                              versions=versions, swap=swap,
+                              link_modes=link_modes) as journal:
+                with TRACER.span('execute') as span:
+                    changes, errors = self.execute(
+                        plans, ', '.join(actions),
+                        lambda: self.set_currents(versions, swap),
+                        journal=journal)
+                    span['changes'] = len(changes)
+                self.record_links(versions, changes, link_modes)
+            if errors:
+                raise click.ClickException(
+                    '{} failed in {} of {} targets'
+                    .format(', '.join(actions), len(errors), len(plans)))
+            return changes
+
+    def set_currents(self, versions, swap=None):
+        """Point ``current`` links to *versions*.
+
+        *swap* is a pair of folders to exchange before that and inode of
+        the first one, they aren't exchanged again if the second folder
+        already has it.
+        """
+        if swap is not None:
+            path, dst, inode = swap
+            if self.fs.lstat(dst).st_ino != inode:
+                self.fs.exchange(path, dst)
+        for package, version in sorted(versions.items()):
+            if version is not None:
+                self.link_current(package, version)
+            elif self.fs.lexists(self.package_path(package, 'current')):
+                self.remove_current(package)
+
+    def record_links(self, versions, changes, link_modes=None):
+        """Update index with links changed by switching to *versions* and
+        link modes of packages."""
+        with self.index() as index:
+            for package, version in versions.items():
+                index.set_links_version(package, version)
+                if version is not None:
+                    index.set_stowed(package, version, time.time())
+            for package, mode in (link_modes or {}).items():
+                index.set_link_mode(package, mode)
+            for path, old, new in changes:
+                if old[0] in ('link', 'file'):
+                    index.remove_link(path)
+                if new[0] in ('link', 'hardlink', 'reflink'):
+                    package = self.link_owner(path, new[1])
+                    if package in versions:
+                        version = versions[package]
+                    else:
+                        version = self.current_version(package)
+                    index.add_link(path, package, version)
+        self.trigger(path for path, old, new in changes)
+
+    def trigger(self, paths):
+        """Queue triggers of changed *paths* in targets."""
+        if not TRIGGERS.rules:
+            return
+        prefixes = sorted((os.path.join(target, ''), target)
+                          for target in self.targets)[::-1]
+        for path in paths:
+            for prefix, target in prefixes:
+                if path.startswith(prefix):
+                    TRIGGERS.add(target, [path[len(prefix):]])
+                    break
+
+    def trigger_version(self, package, version):
+        """Queue triggers of every file of version, for changes that GNU
+        Stow made."""
+        with self.index() as index:
+            files = index.files(package, version)
+        self.trigger(os.path.join(target, rel)
+                     for target in self.targets for rel in files)
+
+    def link_owner(self, path, dest):
+        """Return package that link points into, if any."""
+        dest = os.path.normpath(os.path.join(os.path.dirname(path), dest))
+        if dest.startswith(self.dir + os.path.sep):
+            return os.path.relpath(dest, self.dir).split(os.path.sep, 1)[0]
+
+    def call_stow(self, package, options):
+        with self.lock_targets():
+            for target in self.targets:
+                with TRACER.span('stow subprocess', target=target) as span:
+                    status = subprocess.call([
+                        'stow'
+                    ] + options + [
+                        '-t', target,
+                        '-d', self.package_path(package),
+                        'current',
+                    ])
+                    span['status'] = status
+                if status:
+                    raise click.ClickException(
+                        'stow returned code {} in {}'
+                        .format(status, target))
+
+    def stower(self, target, sources=None, modes=None):
+        return Stower(self.dir, target, self.no_folding,
+                      {} if sources is None else sources, self.fs,
+                      modes or {})
+
+    def materialized(self, modes):
+        """Map ``current`` links of packages that aren't stowed with
+        symlinks to their link modes."""
+        return dict((self.package_path(package, 'current'), mode)
+                    for package, mode in modes.items() if mode != 'symlink')
+
+    def execute(self, plans, action, between=None, dry_run=False,
+                journal=None):
+        """Apply plans of all targets.
+
+        Nothing is changed if any target has conflicts.  Targets are changed
+        in parallel, *between* is called once new links are created in all
+        of them.  If creating links fails in any target, links already
+        created in all of them are removed again.  Changes and progress are
+        written to *journal* before they are made, the journal is kept for
+        :meth:`recover` if removing fails too.  With several targets, or if
+        any of them fails, print summary of every target.  Return list of
+        changes in targets that succeeded and dict that maps targets that
+        failed to remove obsolete links to errors.
+        """
+        several = len(plans) > 1
+        if dry_run:
+            for plan in plans:
+                if several:
+                    click.echo('{}:'.format(plan.target))
+                plan.execute(dry_run=True)
+        conflicts = [('{}: '.format(plan.target) if several else '') + conflict
+                     for plan in plans for conflict in plan.conflicts]
+        if conflicts:
+            raise click.ClickException(
+                '{} would cause conflicts:\n{}\nAll operations aborted.'
+                .format(action, '\n'.join('  * ' + conflict
+                                          for conflict in conflicts)))
+        if dry_run:
+            return
+
+        changes = dict((plan.target, plan.changes()) for plan in plans)
+        if journal is not None:
+            journal.write(phase='additions', changes=changes)
+        errors = self.map_plans(
+            lambda plan: plan.execute_additions(changes[plan.target],
+                                                self.verbose),
+            plans)
+        aborted = bool(errors)
+        undo_errors = {}
+        if aborted:
+            undo_errors = self.map_plans(
+                lambda plan: plan.undo_additions(changes[plan.target],
+                                                 self.verbose),
+                plans)
+        else:
+            if journal is not None:
+                journal.write(phase='current')
+            if between is not None:
+                between()
+            if journal is not None:
+                journal.write(phase='removals')
+            errors = self.map_plans(
+                lambda plan: plan.execute_removals(changes[plan.target],
+                                                   self.verbose),
+                plans)
+        if several or errors or undo_errors:
+            for plan in plans:
+                error = errors.get(plan.target)
+                undo_error = undo_errors.get(plan.target)
+                if error is not None:
+                    click.echo('{}: failed: {}'.format(plan.target, error))
+                if undo_error is not None:
+                    click.echo('{}: changed, rollback failed: {}'
+                               .format(plan.target, undo_error))
+                elif aborted and error is None:
+                    click.echo('{}: aborted'.format(plan.target))
+                elif not aborted:
+                    click.echo('{}: ok'.format(plan.target))
+        if undo_errors:
+            if journal is not None:
+                journal.keep = True
+            raise click.ClickException(
+                "{} failed in {} of {} targets, {} targets were left "
+                "changed, run 'steeve recover' to finish"
+                .format(action, len(errors), len(plans), len(undo_errors)))
+        elif aborted:
+            raise click.ClickException(
+                '{} failed in {} of {} targets, all operations aborted'
+                .format(action, len(errors), len(plans)))
+        return [change for plan in plans if plan.target not in errors
+                for change in changes[plan.target]], errors
+
+    def map_targets(self, func):
+        """Call *func* with every target in parallel, return results."""
+        if len(self.targets) == 1:
+            return [func(self.targets[0])]
+        with ThreadPoolExecutor(self.jobs) as executor:
+            return list(executor.map(func, self.targets))
+
+    def map_plans(self, func, plans):
+        """Call *func* with every plan in parallel.
+
+        Return dict that maps targets that failed to errors.
+        """
+        errors = {}
+        if len(plans) == 1:
+            try:
+                func(plans[0])
+            except Exception as err:
+                errors[plans[0].target] = err
+            return errors
+        with ThreadPoolExecutor(self.jobs) as executor:
+            futures = [(plan.target, executor.submit(func, plan))
+                       for plan in plans]
+            for target, future in futures:
+                if future.exception() is not None:
+                    errors[target] = future.exception()
+        return errors
+
+    def owns(self, path):
+        path = os.path.abspath(path)
+        with self.index() as index:
+            owner = index.owner(path)
+        if owner is None:
+            owner = self.find_owner(path)
+        if owner is None:
+            raise click.ClickException(
+                "no package owns '{}'"
+                .format(path))
+        click.echo("{} is owned by {}/{}".format(path, *owner))
+
+    def find_owner(self, path):
+        """Find owner of *path* by reading links, for links not in index."""
+        while path != os.path.dirname(path):
+            kind, dest = self.fs.state(path)
+            package = kind == 'link' and self.link_owner(path, dest)
+            if package and self.current_version(package) is not None:
+                return package, self.current_version(package)
+            path = os.path.dirname(path)
+
+    def files(self, package, version=None):
+        if version is None:
+            version = self.current_version(package)
+            if version is None:
+                raise click.ClickException(
+                    "package '{}' is not stowed"
+                    .format(package))
+        if not self.package_exists(package, version):
+            raise click.ClickException(
+                "package '{}/{}' is not installed"
+                .format(package, version))
+        with self.lock([package], shared=True), self.index() as index:
+            paths = index.files(package, version)
+            if not paths:
+                paths = sorted(self.fs.walk_files(
+                    self.package_path(package, version)))
+                index.set_files(package, version, paths)
+        for path in paths:
+            click.echo(path)
+
+    def pack(self, package, version, output):
+        """Write version to *output* as tar archive compressed in parallel.
+
+        Archive starts with manifest of the version and is the same for the
+        same contents: entries are sorted, owners are dropped and
+        modification times are set to ``SOURCE_DATE_EPOCH`` or zero.
+        """
+        if not self.package_exists(package, version):
+            raise click.ClickException(
+                "package '{}/{}' is not installed"
+                .format(package, version))
+        path = self.package_path(package, version)
+        mtime = int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+        with self.lock([package], shared=True):
+            with self.index() as index:
+                known = index.manifest(package, version)
+            manifest = self.fs.manifest(path, self.jobs, known)
+            stream = GzipWriter(output, self.jobs)
+            with tarfile.open(fileobj=stream, mode='w|',
+                              format=tarfile.GNU_FORMAT) as tar:
+                write_tar(tar, path, manifest, self.fs, mtime)
+            stream.close()
+
+    def verify(self, package=None, version=None, full=False):
+        """Compare versions with manifests recorded at install and links in
+        targets with links that stowing current versions would create.
+
+        Files whose size, modification time and inode match the manifest
+        are not hashed again unless *full* is true.
+        """
+        if package is None:
+            packages = self.scan(self.dir)
+        elif not self.package_exists(package, version):
+            raise click.ClickException(
+                "package '{}' is not installed"
+                .format(package if version is None
+                        else '{}/{}'.format(package, version)))
+        else:
+            packages = [package]
+
+        problems = []
+        with self.lock(packages, shared=True):
+            stowed = {}
+            for package in packages:
+                if version is None:
+                    versions = self.scan(self.package_path(package))
+                else:
+                    versions = [version]
+                for name in versions:
+                    problems.extend(self.verify_version(package, name, full))
+                current = self.current_version(package)
+                if current is not None and current in versions:
+                    stowed[package] = current
+            if stowed:
+                problems.extend(self.verify_links(stowed))
+        for problem in problems:
+            click.echo(problem)
+        if problems:
+            raise click.ClickException(
+                'found {} problem{}'.format(len(problems),
+                                            's' if len(problems) > 1 else ''))
+
+    def verify_version(self, package, version, full=False):
+        """Return problems with files of version.
+
+        Versions installed before manifests were kept get their manifest
+        recorded.  Stat of files that didn't change is updated, so they are
+        not hashed next time.
+        """
+        path = self.package_path(package, version)
+        with self.index() as index:
+            recorded = index.manifest(package, version)
+        actual = self.fs.manifest(path, self.jobs,
+                                  None if full else recorded)
+        if not recorded:
+            if actual:
+                with self.index() as index:
+                    index.set_manifest(package, version, actual)
+                click.echo("No manifest of '{}/{}', recorded current files"
+                           .format(package, version), err=True)
+            return []
+
+        problems = []
+        unchanged = {}
+        for rel in sorted(set(recorded) | set(actual)):
+            problem = manifest_problem(recorded.get(rel), actual.get(rel))
+            if problem is not None:
+                problems.append('{}: {}'.format(os.path.join(path, rel),
+                                                problem))
+            elif actual[rel] != recorded[rel]:
+                unchanged[rel] = actual[rel]
+        if unchanged:
+            with self.index() as index:
+                index.update_manifest(package, version, unchanged)
+        return problems
+
+    def verify_links(self, versions):
+        """Return problems with links of stowed *versions* in targets.
+
+        Every target is planned in parallel as if the versions were stowed
+        again, any change or conflict means that links were modified.
+        """
+        sources = {}
+
+        def plan_target(target):
+            stower = self.stower(target, sources, materialized)
+            plan = Plan(target, fs=self.fs)
+            for package, version in sorted(versions.items()):
+                if package in entries:
+                    # Intact entries are kept when planned again
+                    stower.remove_entries(plan, entries[package])
+                stower.stow(plan, self.package_path(package, 'current'),
+                            self.package_path(package, version))
+            return plan
+
+        with self.lock_targets(shared=True):
+            with self.index() as index:
+                modes = dict((package, index.link_mode(package))
+                             for package in versions)
+                entries = dict((package, index.links(package))
+                               for package, mode in modes.items()
+                               if mode != 'symlink')
+            materialized = self.materialized(modes)
+            plans = self.map_targets(plan_target)
+
+        several = len(plans) > 1
+        problems = []
+        for plan in plans:
+            problems.extend(('{}: '.format(plan.target) if several else '') +
+                            conflict for conflict in plan.conflicts)
+            problems.extend('{}: {}'.format(path, link_problem(old, new))
+                            for path, old, new in plan.changes())
+        return problems
+
+    @traced('ls')
+    def ls(self, package=None, quiet=False, long=False, as_json=False,
+           sort='name'):
+        if package is None:
+            try:
+                names = self.scan(self.dir)
+            except OSError as err:
+                if err.errno == errno.ENOENT:
+                    return
+                else:
+                    raise
+            current = None
+        else:
+            try:
+                names = self.scan(self.package_path(package))
+            except OSError as err:
+                if err.errno == errno.ENOENT:
+                    raise click.ClickException(
+                        "no such package '{}'"
+                        .format(package))
+                else:
+                    raise
+            current = self.current_version(package)
+
+        if quiet or not (long or as_json):
+            for name in names:
+                if package is None or quiet:
+                    click.echo(name)
+                else:
+                    used = '* ' if current == name else '  '
+                    click.echo(used + name)
+            return
+
+        with self.index() as index:
+            if package is None:
+                entries = (self.package_info(index, name) for name in names)
+            else:
+                entries = (self.version_info(index, package, name, current)
+                           for name in names)
+            if sort != 'name':
+                entries = sorted(entries, key=lambda entry: entry[sort],
+                                 reverse=True)
+            for entry in entries:
+                if as_json:
+                    click.echo(json.dumps(entry, sort_keys=True))
+                elif package is None:
+                    click.echo('{:<24} {:<16} {:>4} {:>7}'.format(
+                        entry['package'], entry['current'] or '-',
+                        entry['versions'], format_size(entry['size'])))
+                else:
+                    click.echo('{}{:<20} {} {:>7}'.format(
+                        '* ' if entry['current'] else '  ',
+                        entry['version'],
+                        time.strftime('%Y-%m-%d %H:%M',
+                                      time.localtime(entry['time'])),
+                        format_size(entry['size'])))
+
+    def scan(self, path):
+        """Return sorted names of packages or versions in *path*."""
+        names = [name for name in self.fs.dirnames(path)
+                 if not name.startswith('.') and
+                 not (path != self.dir and name == 'current')]
+        names.sort(key=version_key)
+        return names
+
+    def package_info(self, index, package):
+        versions = self.scan(self.package_path(package))
+        infos = [self.version_info(index, package, version)
+                 for version in versions]
+        return {
+            'package': package,
+            'current': self.current_version(package),
+            'versions': len(versions),
+            'time': max([info['time'] for info in infos] or [0]),
+            'size': sum(info['size'] for info in infos),
+        }
+
+    def version_info(self, index, package, version, current=None):
+        path = self.package_path(package, version)
+        st = self.fs.stat(path)
+        size = index.size(package, version, st)
+        if size is None:
+            with TRACER.span('disk usage', package=package,
+                             version=version):
+                size = self.fs.disk_usage(path, self.jobs)
+            index.set_size(package, version, st, size)
+        installed = index.installed(package, version) or st.st_mtime
+        return {
+            'package': package,
+            'version': version,
+            'current': version == current,
+            'time': installed,
+            'stowed': index.stowed(package, version) or installed,
+            'size': size,
+        }
+
+    def update_completion(self):
+        """Rewrite list of packages and versions read by shell completion.
+
+        Every line has package name followed by its versions.
+        """
+        if self.fs.in_memory:
+            return
+        path = self.meta_path('completion')
+        tmp = '{}.{}.steeve-tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as fp:
+            for package in self.scan(self.dir):
+                versions = self.scan(self.package_path(package))
+                fp.write(' '.join([package] + versions) + '\n')
+        os.rename(tmp, path)
+
+    def report(self):
+        """Print changes that were made in memory instead of disk."""
+        meta = os.path.join(self.dir, '.steeve')
+        for path, old, new in self.fs.changes(exclude=[meta]):
+            rel = os.path.relpath(path)
+            if rel == os.pardir or rel.startswith(os.pardir + os.path.sep):
+                rel = path
+            if old != ABSENT and (new == ABSENT or new[0] != old[0]):
+                click.echo('{}: {}'.format('RMDIR' if old == DIR else 'UNLINK',
+                                           rel))
+            if new[0] == 'link':
+                click.echo('LINK: {} => {}'.format(rel, new[1]))
+            elif new == DIR:
+                click.echo('MKDIR: {}'.format(rel))
+            elif new == FILE:
+                click.echo('CREATE: {}'.format(rel))
+        for target, command in TRIGGERS.take():
+            if len(self.targets) > 1:
+                click.echo('TRIGGER: {}: {}'.format(target, command))
+            else:
+                click.echo('TRIGGER: {}'.format(command))
+
+    def link_current(self, package, version):
+        self.fs.symlink(self.package_path(package, version),
+                        self.package_path(package, 'current'))
+
+    def remove_current(self, package):
+        self.fs.remove(self.package_path(package, 'current'))
+
+    def current_version(self, package):
+        try:
+            dst = self.fs.readlink(self.package_path(package, 'current'))
+        except OSError as err:
+            if err.errno == errno.ENOENT:
+                return
+            else:
+                raise
+        return os.path.basename(dst.rstrip(os.path.sep))
+
+    @contextmanager
+    def journal(self, operation, action, **fields):
+        """Keep journal of operation for the duration of the block.
+
+        Journal is removed when the operation completes or fails with an
+        error that leaves things consistent, and is kept for
+        :meth:`recover` if the process is interrupted.  Changes in memory
+        are not journaled.
+        """
+        if self.fs.in_memory:
+            yield None
+            return
+        journal = Journal.create(self.meta_path('journal'),
+                                 dict(fields, operation=operation,
+                                      action=action))
+        try:
+            yield journal
+        except (click.ClickException, click.Abort):
+            if journal.keep:
+                journal.close()
+            else:
+                journal.remove()
+            raise
+        except BaseException:
+            journal.close()
+            raise
+        journal.remove()
+
+    def recover(self, auto=False):
+        """Finish or roll back operations that were interrupted.
+
+        Journals of operations that still run are locked by them and
+        skipped.  Nested operations are recovered first.  If *auto* is
+        true, failures are reported without stopping.  Return number of
+        recovered operations.
+        """
+        folder = os.path.join(self.dir, '.steeve', 'journal')
+        if not os.path.isdir(folder):
+            return 0
+        count = 0
+        for journal in Journal.interrupted(folder):
+            entry = journal.entry
+            click.echo('Recovering interrupted {}'.format(entry['action']),
+                       err=True)
+            try:
+                getattr(self, 'recover_' + entry['operation'])(entry)
+            except click.ClickException as err:
+                journal.close()
+                if not auto:
+                    raise
+                click.echo("Cannot recover {}: {}, run 'steeve recover' "
+                           "to retry".format(entry['action'],
+                                             err.format_message()),
+                           err=True)
+                continue
+            if self.fs.in_memory:
+                journal.close()
+            else:
+                journal.remove()
+            count += 1
+        return count
+
+    def recover_install(self, entry):
+        """Finish interrupted install.
+
+        Copying is resumed from the files that were already copied, the
+        rest of install is done again.  Install from standard input or
+        from source that's gone is rolled back, folder that was moved
+        with copy mode ``move`` is moved back to its source.
+        """
+        package, version = entry['package'], entry['version']
+        staging = entry.get('staging')
+        path = self.package_path(package, version)
+        with self.lock([package]):
+            phase = entry.get('phase')
+            if phase == 'staged':
+                moved = (self.fs.lexists(path) and
+                         self.fs.lstat(path).st_ino == entry['inode'])
+                if not moved and not self.fs.isdir(staging):
+                    phase = 'copy'
+                elif not moved and entry['replace']:
+                    self.replace_version(package, version, staging)
+                elif not moved:
+                    self.fs.rename(staging, path)
+            if phase in (None, 'copy'):
+                source = entry['path']
+                if source == '-' or (not is_url(source) and
+                                     not self.fs.exists(source)):
+                    if (entry['copy_mode'] == 'move' and source != '-' and
+                            staging is not None and self.fs.isdir(staging)):
+                        # Source folder was moved here, it's the only copy
+                        self.fs.rename(staging, source)
+                    elif staging is not None:
+                        self.fs.rmtree(staging, ignore_errors=True)
+                    if (self.fs.isdir(self.package_path(package)) and
+                            not self.fs.listdir(self.package_path(package))):
+                        self.fs.rmdir(self.package_path(package))
+                    click.echo("Rolled back installing '{}/{}'"
+                               .format(package, version), err=True)
+                    return
+                self.install(package, version, source, True,
+                             entry['copy_mode'], entry['strip_components'],
+                             entry['dedup'], entry['sha256'],
+                             entry['checksum'], resume=staging)
+                if staging is not None:
+                    self.fs.rmtree(staging, ignore_errors=True)
+                return
+            if entry['replace'] and self.fs.lexists(staging):
+                self.trash(staging)
+            self.finish_install(package, version)
+
+    def recover_switch(self, entry):
+        """Finish interrupted switch of versions.
+
+        Links that are already in place are skipped, links that were
+        changed by other means since are reported and left alone.
+        """
+        versions = entry['versions']
+        swap = entry.get('swap')
+        with self.lock(versions), self.lock_targets():
+            plans = []
+            changes = []
+            for target, target_changes in sorted(
+                    entry.get('changes', {}).items()):
+                target_changes = [(path, tuple(old), tuple(new))
+                                  for path, old, new in target_changes]
+                pending, changed = pending_changes(target_changes, self.fs)
+                for path in changed:
+                    click.echo("Cannot recover '{}': changed since"
+                               .format(path), err=True)
+                plans.append((Plan(target, fs=self.fs), pending))
+                changes.extend(target_changes)
+            if entry.get('phase') == 'additions':
+                for plan, pending in plans:
+                    plan.execute_additions(pending, self.verbose)
+            self.set_currents(versions, swap and tuple(swap))
+            for plan, pending in plans:
+                plan.execute_removals(pending, self.verbose)
+            self.record_links(versions, changes, entry.get('link_modes'))
+
+    def recover_uninstall(self, entry):
+        """Finish interrupted uninstall."""
+        package, version = entry['package'], entry['version']
+        with self.lock([package]):
+            if self.package_exists(package, version):
+                if version is None:
+                    self.uninstall_package(package, yes=True)
+                else:
+                    self.uninstall_version(package, version, yes=True)
+            else:
+                with self.index() as index:
+                    index.remove_files(package, version)
+
+    def lock(self, packages, shared=False):
+        """Hold locks of *packages* for the duration of the block."""
+        if self.fs.in_memory:
+            # Nobody else sees changes in memory
+            return file_locks([])
+        return file_locks([(self.lock_path(package),
+                            "package '{}'".format(package))
+                           for package in packages], shared)
+
+    def lock_targets(self, shared=False):
+        """Lock targets while links are planned and changed."""
+        if self.fs.in_memory:
+            return file_locks([])
+        locks = []
+        for target in self.targets:
+            digest = hashlib.sha1(target.encode('utf-8')).hexdigest()
+            locks.append((self.lock_path('.target-' + digest[:16]),
+                          "target '{}'".format(target)))
+        return file_locks(locks, shared)
+
+    def lock_download(self, url):
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return file_lock(self.lock_path('.download-' + digest[:16]),
+                         description="download '{}'".format(url))
+
+    def lock_objects(self):
+        return file_lock(self.lock_path('.objects'),
+                         description='shared files')
+
+    def lock_path(self, name):
+        locks = self.meta_path('locks')
+        if not os.path.isdir(locks):
+            os.makedirs(locks)
+        return os.path.join(locks, name)
+
+    def index(self):
+        return self.fs.index(self.meta_path('index.sqlite'))
+
+    def meta_path(self, *names):
+        """Return path in folder where steeve keeps its own data."""
+        meta = os.path.join(self.dir, '.steeve')
+        if not self.fs.isdir(meta):
+            self.fs.makedirs(meta)
+        return os.path.join(meta, *names)
+
+    def package_exists(self, package, version=None):
+        path = self.package_path(package, version)
+        return self.fs.exists(path)
+
+    def package_path(self, package, version=None):
+        if version is None:
+            return os.path.join(self.dir, package)
+        else:
+            return os.path.join(self.dir, package, version)
+
+
+def symlink(dest, path):
+    """Atomically create or replace symlink *path* pointing to *dest*."""
+    tmp = os.path.join(os.path.dirname(path), '.{}.{}.steeve-tmp'
+                       .format(os.path.basename(path), os.getpid()))
+    try:
+        os.remove(tmp)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+    os.symlink(dest, tmp)
+    os.rename(tmp, path)
+
+
+def link_file(src, path, mode='hardlink'):
+    """Atomically create or replace *path* with hard link or clone of file
+    *src*, or copy of it if the mode is not supported.  Symlinks are
+    copied as they are."""
+    if os.path.islink(src):
+        symlink(os.readlink(src), path)
+        return
+    tmp = os.path.join(os.path.dirname(path), '.{}.{}.steeve-tmp'
+                       .format(os.path.basename(path), os.getpid()))
+    try:
+        os.remove(tmp)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+    copy_file(src, tmp, mode)
+    os.rename(tmp, path)
+
+
+# Linux renameat2(2) flag that swaps two paths
+RENAME_EXCHANGE = 2
+AT_FDCWD = -100
+
+
+def exchange(path, other):
+    """Swap *path* and *other*, atomically where renameat2(2) supports it."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        renameat2 = libc.renameat2
+    except (AttributeError, OSError):
+        renameat2 = None
+    if renameat2 is not None:
+        encoding = sys.getfilesystemencoding()
+        if renameat2(AT_FDCWD, path.encode(encoding), AT_FDCWD,
+                     other.encode(encoding), RENAME_EXCHANGE) == 0:
+            return
+        err = ctypes.get_errno()
+        if err not in (errno.EINVAL, errno.ENOSYS):
+            raise OSError(err, os.strerror(err), path)
+    tmp = os.path.join(os.path.dirname(other), '.{}.{}.steeve-tmp'
+                       .format(os.path.basename(other), os.getpid()))
+    os.rename(other, tmp)
+    os.rename(path, other)
+    os.rename(tmp, path)
+
+
+# Linux ioctl that shares extents of one file with another
+FICLONE = 0x40049409
+
+# Errors meaning that requested way of copying isn't supported
+UNSUPPORTED = set([errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EINVAL,
+                   errno.ENOTTY, errno.ENOSYS, errno.EOPNOTSUPP,
+                   errno.EBADF])
+
+
+def copy_tree(src, dst, mode='copy', jobs=1, base=None, checksums=None):
+    """Copy directory *src* to *dst* which must not exist.
+
+    Return set of copy modes that were actually used, since unsupported
+    modes fall back to copying.  Files are copied by a pool of *jobs*
+    threads.  Files that folder *base* has with the same size, mode and
+    modification time are hard linked from it instead.  If *checksums* is
+    given, contents are compared instead of modification time, manifest
+    entries of *base* in *checksums* save hashing its files.  Number of
+    files and bytes copied are added to the current trace span.
+    """
+    parent = os.path.dirname(dst)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+
+    if mode == 'move':
+        try:
+            os.rename(src, dst)
+            return set(['move'])
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+        mode = 'copy'
+
+    os.mkdir(dst)
+    dirs = []
+    futures = []
+    files = size = 0
+    with ThreadPoolExecutor(jobs) as executor:
+        for root, dirnames, filenames in os.walk(src, onerror=reraise):
+            droot = os.path.join(dst, os.path.relpath(root, src))
+            dirs.append((root, droot))
+            for name in list(dirnames):
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    dirnames.remove(name)
+                    filenames.append(name)
+                else:
+                    os.mkdir(os.path.join(droot, name))
+            for name in filenames:
+                path = os.path.join(root, name)
+                dpath = os.path.join(droot, name)
+                st = os.lstat(path)
+                if stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(path), dpath)
+                    continue
+                elif not stat.S_ISREG(st.st_mode):
+                    continue
+                files += 1
+                size += st.st_size
+                if base is not None:
+                    rel = os.path.relpath(path, src)
+                    futures.append(executor.submit(
+                        sync_file, path, dpath, mode,
+                        os.path.join(base, rel), checksums, rel))
+                else:
+                    futures.append(
+                        executor.submit(copy_file, path, dpath, mode))
+    TRACER.annotate(files=files, bytes=size)
+    modes = set(future.result() for future in futures) - set([None])
+    for root, droot in reversed(dirs):
+        shutil.copystat(root, droot)
+    return modes or set([mode])
+
+
+class Journal(object):
+    """Write-ahead log of operation in progress.
+
+    Journal is a file of JSON lines, each line updates fields of the entry,
+    a torn last line is ignored.  The file is locked while the operation
+    runs, so journals that aren't locked belong to operations that were
+    interrupted.
+    """
+
+    def __init__(self, path, fd, entry):
+        self.path = path
+        self.fd = fd
+        self.entry = entry
+        # Kept for recovery even if the operation fails with an error
+        self.keep = False
+
+    @classmethod
+    def create(cls, folder, entry):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        # Names sort by creation time.  Journal gets its name only once
+        # it's locked and written, so recover never sees it empty
+        fd, tmp = tempfile.mkstemp(prefix='{:017.6f}.'.format(time.time()),
+                                   suffix='.journal.tmp', dir=folder)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        journal = cls(tmp[:-len('.tmp')], fd, {})
+        try:
+            journal.write(**entry)
+            os.rename(tmp, journal.path)
+        except BaseException:
+            os.remove(tmp)
+            journal.close()
+            raise
+        return journal
+
+    @classmethod
+    def interrupted(cls, folder):
+        """Yield locked journals of interrupted operations, newest first."""
+        for name in sorted(os.listdir(folder), reverse=True):
+            if not name.endswith('.journal'):
+                continue
+            path = os.path.join(folder, name)
+            try:
+                fd = os.open(path, os.O_RDWR)
+            except OSError as err:
+                if err.errno == errno.ENOENT:
+                    continue
+                raise
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as err:
+                os.close(fd)
+                if err.errno in (errno.EAGAIN, errno.EACCES):
+                    continue
+                raise
+            if not os.path.exists(path):
+                # Operation completed while the journal was opened
+                os.close(fd)
+                continue
+            entry = {}
+            with os.fdopen(os.dup(fd), 'rb') as fp:
+                for line in fp:
+                    try:
+                        entry.update(json.loads(line.decode('utf-8')))
+                    except ValueError:
+                        break
+            if 'operation' in entry:
+                yield cls(path, fd, entry)
+            else:
+                os.remove(path)
+                os.close(fd)
+
+    def write(self, **fields):
+        """Update fields and write them to disk."""
+        self.entry.update(fields)
+        os.write(self.fd, (json.dumps(fields) + '\n').encode('utf-8'))
+        os.fsync(self.fd)
+
+    def remove(self):
+        os.remove(self.path)
+        self.close()
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Locks held by this process: maps path of lock file to its descriptor and
+# current operation
+LOCKS = {}
+
+
+@contextmanager
+def file_lock(path, shared=False, description=None):
+    """Hold :func:`fcntl.flock` lock of file at *path*.
+
+    Locks are reentrant: nested calls reuse lock that is already held, and
+    exclusive lock requested inside shared one upgrades it until the block
+    ends.  If the lock is busy, report how long it took to get it.
+    """
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    held = LOCKS.get(path)
+    if held is not None and operation in (held[1], fcntl.LOCK_SH):
+        yield
+        return
+    if held is None:
+        held = LOCKS[path] = [os.open(path, os.O_RDWR | os.O_CREAT, 0o644),
+                              None]
+    fd, previous = held
+    try:
+        acquire_lock(fd, operation, description or path)
+        held[1] = operation
+        yield
+    finally:
+        if previous is None:
+            del LOCKS[path]
+            os.close(fd)
+        else:
+            fcntl.flock(fd, previous)
+            held[1] = previous
+
+
+def detach():
+    """Let go of terminal, locks and journals inherited by forked process.
+
+    Otherwise they stay open until the process is done, so the locks are
+    still held and readers of the output wait for it after the parent
+    exits.
+    """
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(null, fd)
+    os.close(null)
+    LOCKS.clear()
+    os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+
+
+@contextmanager
+def file_locks(locks, shared=False):
+    """Hold locks of several files given as ``(path, description)`` pairs.
+
+    Files are locked in sorted order, so processes that lock several files
+    at once don't deadlock.
+    """
+    locks = sorted(set(locks))
+    if not locks:
+        yield
+        return
+    path, description = locks[0]
+    with file_lock(path, shared, description):
+        with file_locks(locks[1:], shared):
+            yield
+
+
+def acquire_lock(fd, operation, description):
+    try:
+        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+        return
+    except (IOError, OSError) as err:
+        if err.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+    click.echo('Waiting for lock of {}...'.format(description), err=True)
+    start = time.time()
+    with TRACER.span('wait for lock', lock=description):
+        fcntl.flock(fd, operation)
+    click.echo('Waited {:.1f}s for lock of {}'
+               .format(time.time() - start, description), err=True)
+
+
+def confirm(text):
+    """Prompt user to proceed, abort if they don't."""
+    with TRACER.span('prompt'):
+        click.confirm(text, abort=True)
+
+
+def reraise(err):
+    raise err
+
+
+def copy_file(src, dst, mode='copy'):
+    """Copy regular file and its metadata, return copy mode used."""
+    if mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return mode
+        except OSError as err:
+            if err.errno not in UNSUPPORTED:
+                raise
+        mode = 'copy'
+
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            if mode == 'reflink':
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                except (IOError, OSError) as err:
+                    if err.errno not in UNSUPPORTED:
+                        raise
+                    mode = 'copy'
+            if mode == 'copy':
+                copy_data(fsrc, fdst, os.fstat(fsrc.fileno()).st_size)
+    shutil.copystat(src, dst)
+    return mode
+
+
+def sync_file(src, dst, mode, old, checksums=None, rel=None):
+    """Hard link file *old* to *dst* if it's the same as *src*, otherwise
+    copy *src*.  Return copy mode used or ``None`` if file was linked.
+    """
+    try:
+        st = os.stat(src)
+        ost = os.lstat(old)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return copy_file(src, dst, mode)
+    same = (stat.S_ISREG(ost.st_mode) and
+            (ost.st_size, ost.st_mode) == (st.st_size, st.st_mode))
+    if same and checksums is not None:
+        entry = checksums.get(rel)
+        if (entry is None or (entry.size, entry.inode, entry.mtime) !=
+                (ost.st_size, ost.st_ino, ost.st_mtime)):
+            digest = file_digest(old)
+        else:
+            digest = entry.digest
+        same = file_digest(src) == digest
+    elif same:
+        same = ost.st_mtime == st.st_mtime
+    if same:
+        try:
+            os.link(old, dst)
+            return
+        except OSError as err:
+            if err.errno not in UNSUPPORTED:
+                raise
+    return copy_file(src, dst, mode)
+
+
+def copy_data(fsrc, fdst, size):
+    """Copy file contents in kernel if possible."""
+    src, dst = fsrc.fileno(), fdst.fileno()
+    offset = 0
+    for name in ('copy_file_range', 'sendfile'):
+        func = getattr(os, name, None)
+        if func is None:
+            continue
+        try:
+            while offset < size:
+                if name == 'sendfile':
+                    sent = func(dst, src, offset, size - offset)
+                else:
+                    sent = func(src, dst, size - offset)
+                if not sent:
+                    break
+                offset += sent
+            return
+        except OSError as err:
+            if err.errno not in UNSUPPORTED or offset:
+                raise
+    shutil.copyfileobj(fsrc, fdst)
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def dedup_tree(root, objects, jobs=1):
+    """Hard link regular files in *root* against pool of *objects*.
+
+    Files are hashed by a pool of *jobs* threads.  Return number of bytes
+    saved.  Pool keeps one link to every object, so objects with a single
+    link are not used by any version.
+    """
+    with ThreadPoolExecutor(jobs) as executor:
+        futures = [executor.submit(dedup_file, os.path.join(dirpath, name),
+                                   objects)
+                   for dirpath, dirnames, filenames in os.walk(root)
+                   for name in filenames]
+    return sum(future.result() for future in futures)
+
+
+def dedup_file(path, objects):
+    """Replace file with link to object with the same contents and mode.
+
+    Return number of bytes saved.
+    """
+    st = os.lstat(path)
+    if not stat.S_ISREG(st.st_mode):
+        return 0
+    digest = file_digest(path)
+    bucket = os.path.join(objects, digest[:2])
+    obj = os.path.join(bucket, '{}-{:o}'.format(digest[2:],
+                                                stat.S_IMODE(st.st_mode)))
+    try:
+        os.makedirs(bucket)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+    if not os.path.exists(obj):
+        if st.st_nlink > 1:
+            # Don't tie files outside of stow dir to the pool
+            return 0
+        try:
+            os.link(path, obj)
+            return 0
+        except OSError as err:
+            if err.errno in UNSUPPORTED:
+                return 0
+            elif err.errno != errno.EEXIST:
+                raise
+
+    ost = os.stat(obj)
+    if (ost.st_dev, ost.st_ino) == (st.st_dev, st.st_ino):
+        return 0
+    tmp = os.path.join(os.path.dirname(path), '.{}.{}.steeve-tmp'
+                       .format(os.path.basename(path), os.getpid()))
+    try:
+        os.link(obj, tmp)
+    except OSError as err:
+        if err.errno in UNSUPPORTED:
+            return 0
+        raise
+    os.rename(tmp, path)
+    return st.st_size if st.st_nlink == 1 else 0
+
+
+ManifestEntry = namedtuple('ManifestEntry', 'mode size digest inode mtime')
+
+
+def manifest_tree(root, jobs=1, known=None):
+    """Return manifest of files and links in *root*.
+
+    Manifest maps paths relative to *root* to entries with mode, size,
+    SHA-256 digest of file or destination of link, inode and modification
+    time.  Files are hashed by a pool of *jobs* threads, except the ones
+    whose size, modification time and inode match the *known* manifest.
+    """
+    known = known or {}
+    with ThreadPoolExecutor(jobs) as executor:
+        futures = dict((rel, executor.submit(manifest_entry,
+                                             os.path.join(root, rel),
+                                             known.get(rel)))
+                       for rel in walk_files(root))
+    return dict((rel, future.result()) for rel, future in futures.items())
+
+
+def manifest_entry(path, known=None):
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode):
+        digest = os.readlink(path)
+    elif not stat.S_ISREG(st.st_mode):
+        digest = ''
+    elif (known is not None and
+            (known.size, known.inode, known.mtime) ==
+            (st.st_size, st.st_ino, st.st_mtime)):
+        digest = known.digest
+    else:
+        digest = file_digest(path)
+    return ManifestEntry(st.st_mode, st.st_size, digest, st.st_ino,
+                         st.st_mtime)
+
+
+def manifest_problem(old, new):
+    """Describe how file changed since manifest entry *old* was recorded."""
+    if new is None:
+        return 'missing'
+    elif old is None:
+        return 'added'
+    elif stat.S_IFMT(old.mode) != stat.S_IFMT(new.mode):
+        return 'type changed'
+    elif old.digest != new.digest:
+        return 'link changed' if stat.S_ISLNK(new.mode) else 'modified'
+    elif old.mode != new.mode:
+        return 'mode changed'
+
+
+def link_problem(old, new):
+    """Describe change that stowing would make to the target."""
+    if new[0] == 'link':
+        return 'missing link' if old == ABSENT else 'wrong link'
+    elif new[0] in ('hardlink', 'reflink'):
+        return 'missing file' if old == ABSENT else 'wrong file'
+    elif new == DIR and old == ABSENT:
+        return 'missing folder'
+    else:
+        return 'out of date'
+
+
+def write_tar(tar, root, manifest, fs, mtime=0):
+    """Add *manifest* and contents of *root* read from *fs* to *tar* in
+    sorted order.
+
+    Members are owned by root and have modification time *mtime*.
+    """
+    def add(name, type, mode=0o644, size=0, linkname='', fileobj=None):
+        info = tarfile.TarInfo(name)
+        info.type = type
+        info.mode = mode & 0o777
+        info.size = size
+        info.linkname = linkname
+        info.mtime = mtime
+        tar.addfile(info, fileobj)
+
+    # Modes are recorded as extracted, without special bits
+    data = json.dumps(dict((rel, [stat.S_IFMT(entry.mode) |
+                                  entry.mode & 0o777,
+                                  entry.size, entry.digest])
+                           for rel, entry in manifest.items()),
+                      sort_keys=True).encode('utf-8')
+    add(MANIFEST_NAME, tarfile.REGTYPE, size=len(data),
+        fileobj=io.BytesIO(data))
+    for path, st in fs.walk(root):
+        name = os.path.relpath(path, root)
+        if stat.S_ISLNK(st.st_mode):
+            add(name, tarfile.SYMTYPE, st.st_mode,
+                linkname=fs.readlink(path))
+        elif stat.S_ISDIR(st.st_mode):
+            add(name, tarfile.DIRTYPE, st.st_mode)
+        elif stat.S_ISREG(st.st_mode):
+            with closing(fs.open(path)) as fp:
+                add(name, tarfile.REGTYPE, st.st_mode, st.st_size,
+                    fileobj=fp)
+
+
+# Size of blocks of archive that are compressed independently
+GZIP_BLOCK = 1 << 20
+
+
+class GzipWriter(object):
+    """Stream that writes data to *fileobj* as gzip members compressed by
+    a pool of *jobs* threads.
+
+    Every block of data becomes a separate member, which gzip and
+    :func:`open_tar` read as a single stream.
+    """
+
+    def __init__(self, fileobj, jobs=1, level=6):
+        self.fileobj = fileobj
+        self.jobs = jobs
+        self.level = level
+        self.executor = ThreadPoolExecutor(jobs)
+        self.buffer = []
+        self.size = 0
+        self.pending = deque()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= GZIP_BLOCK:
+            self._submit()
+
+    def close(self):
+        try:
+            if self.buffer:
+                self._submit()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+            self.fileobj.flush()
+        finally:
+            self.executor.shutdown()
+
+    def _submit(self):
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        self.pending.append(self.executor.submit(gzip_block, data,
+                                                 self.level))
+        # Keep a few blocks per thread in memory, write the rest in order
+        while len(self.pending) > self.jobs * 2:
+            self.fileobj.write(self.pending.popleft().result())
+
+
+def gzip_block(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def version_key(version):
+    """Key to sort versions so that 2.10 goes after 2.9."""
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part)
+            for part in re.split(r'(\d+)', version)]
+
+
+def format_size(size):
+    for unit in ('', 'K', 'M', 'G', 'T'):
+        if size < 1024 or unit == 'T':
+            break
+        size /= 1024.0
+    if unit and size < 10:
+        return '{:.1f}{}'.format(size, unit)
+    return '{:.0f}{}'.format(size, unit)
+
+
+def disk_usage(root, jobs=1):
+    """Return disk usage of folder in bytes, like ``du -s``.
+
+    Subfolders are scanned by a pool of *jobs* threads.  Files that have
+    several hard links are counted once.
+    """
+    total = 0
+    inodes = set()
+    with ThreadPoolExecutor(jobs) as executor:
+        pending = set([executor.submit(scan_usage, root)])
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                size, linked, dirs = future.result()
+                total += size
+                for inode, size in linked:
+                    if inode not in inodes:
+                        inodes.add(inode)
+                        total += size
+                pending.update(executor.submit(scan_usage, path)
+                               for path in dirs)
+    return total
+
+
+def scan_usage(path):
+    """Return disk usage of folder itself and its files, hard linked files
+    and subfolders."""
+    size = os.lstat(path).st_blocks * 512
+    linked = []
+    dirs = []
+    for entry in scandir(path):
+        st = entry.stat(follow_symlinks=False)
+        if entry.is_dir(follow_symlinks=False):
+            dirs.append(entry.path)
+        elif st.st_nlink > 1:
+            linked.append(((st.st_dev, st.st_ino), st.st_blocks * 512))
+        else:
+            size += st.st_blocks * 512
+    return size, linked, dirs
+
+
+def ignore_missing(func, path, exc_info):
+    """Error handler for :func:`shutil.rmtree` that ignores missing files."""
+    if getattr(exc_info[1], 'errno', None) != errno.ENOENT:
+        raise exc_info[1]
+
+
+def walk_files(root):
+    """Yield paths of files and links in *root* relative to it."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel = os.path.relpath(dirpath, root)
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if name in filenames or os.path.islink(path):
+                yield os.path.normpath(os.path.join(rel, name))
+
+
+class Index(object):
+    """Database of installed files and stowed links kept in stow dir.
+
+    ``links`` table maps every link in target to package and version it
+    belongs to, ``files`` table lists files of every installed version,
+    ``manifests`` table keeps their checksums, ``packages`` table keeps
+    link modes of packages.  Use as a context manager,
+    changes are committed in a single transaction.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS links (
+            path TEXT PRIMARY KEY,
+            package TEXT NOT NULL,
+            version TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS links_package ON links (package);
+        CREATE TABLE IF NOT EXISTS files (
+            package TEXT NOT NULL,
+            version TEXT NOT NULL,
+            path TEXT NOT NULL,
+            PRIMARY KEY (package, version, path)
+        );
+        CREATE TABLE IF NOT EXISTS manifests (
+            package TEXT NOT NULL,
+            version TEXT NOT NULL,
+            path TEXT NOT NULL,
+            mode INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            digest TEXT NOT NULL,
+            inode INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            PRIMARY KEY (package, version, path)
+        );
+        CREATE TABLE IF NOT EXISTS versions (
+            package TEXT NOT NULL,
+            version TEXT NOT NULL,
+            installed REAL,
+            stowed REAL,
+            inode INTEGER,
+            mtime REAL,
+            size INTEGER,
+            PRIMARY KEY (package, version)
+        );
+        CREATE TABLE IF NOT EXISTS downloads (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            modified TEXT,
+            size INTEGER,
+            sha256 TEXT
+        );
+        CREATE TABLE IF NOT EXISTS listings (
+            path TEXT PRIMARY KEY,
+            inode INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            entries TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS packages (
+            package TEXT PRIMARY KEY,
+            link_mode TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.executescript(self.SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.db.commit()
+        else:
+            self.db.rollback()
+        self.db.close()
+
+    def owner(self, path):
+        """Return package and version of link at *path* or its parents."""
+        while True:
+            row = self.db.execute(
+                'SELECT package, version FROM links WHERE path = ?',
+                (path,)).fetchone()
+            if row is not None or path == os.path.dirname(path):
+                return row
+            path = os.path.dirname(path)
+
+    def add_link(self, path, package, version):
+        self.db.execute('INSERT OR REPLACE INTO links VALUES (?, ?, ?)',
+                        (path, package, version))
+
+    def remove_link(self, path):
+        self.db.execute('DELETE FROM links WHERE path = ?', (path,))
+
+    def remove_links(self, package):
+        self.db.execute('DELETE FROM links WHERE package = ?', (package,))
+
+    def links(self, package):
+        return [path for path, in self.db.execute(
+            'SELECT path FROM links WHERE package = ? ORDER BY path',
+            (package,))]
+
+    def link_mode(self, package):
+        row = self.db.execute(
+            'SELECT link_mode FROM packages WHERE package = ?',
+            (package,)).fetchone()
+        return 'symlink' if row is None else row[0]
+
+    def set_link_mode(self, package, mode):
+        self.db.execute('INSERT OR REPLACE INTO packages VALUES (?, ?)',
+                        (package, mode))
+
+    def set_links_version(self, package, version):
+        if version is None:
+            self.remove_links(package)
+        else:
+            self.db.execute('UPDATE links SET version = ? WHERE package = ?',
+                            (version, package))
+
+    def files(self, package, version):
+        return [path for path, in self.db.execute(
+            'SELECT path FROM files WHERE package = ? AND version = ? '
+            'ORDER BY path', (package, version))]
+
+    def set_files(self, package, version, paths):
+        self.remove_files(package, version)
+        self.db.executemany('INSERT INTO files VALUES (?, ?, ?)',
+                            ((package, version, path) for path in paths))
+
+    def manifest(self, package, version):
+        """Return dict that maps paths of version to manifest entries."""
+        return dict((row[0], ManifestEntry(*row[1:])) for row in
+                    self.db.execute(
+                        'SELECT path, mode, size, digest, inode, mtime '
+                        'FROM manifests WHERE package = ? AND version = ?',
+                        (package, version)))
+
+    def set_manifest(self, package, version, manifest):
+        self.db.execute('DELETE FROM manifests '
+                        'WHERE package = ? AND version = ?',
+                        (package, version))
+        self.update_manifest(package, version, manifest)
+
+    def update_manifest(self, package, version, entries):
+        self.db.executemany(
+            'INSERT OR REPLACE INTO manifests VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            ((package, version, path) + tuple(entry)
+             for path, entry in entries.items()))
+
+    def remove_files(self, package, version=None):
+        for table in ('files', 'manifests', 'versions'):
+            if version is None:
+                self.db.execute(
+                    'DELETE FROM {} WHERE package = ?'.format(table),
+                    (package,))
+            else:
+                self.db.execute(
+                    'DELETE FROM {} WHERE package = ? AND version = ?'
+                    .format(table), (package, version))
+        if version is None:
+            self.db.execute('DELETE FROM packages WHERE package = ?',
+                            (package,))
+
+    def _version(self, package, version):
+        self.db.execute('INSERT OR IGNORE INTO versions (package, version) '
+                        'VALUES (?, ?)', (package, version))
+
+    def installed(self, package, version):
+        return self._get('installed', package, version)
+
+    def set_installed(self, package, version, timestamp):
+        self._set('installed', package, version, timestamp)
+
+    def stowed(self, package, version):
+        return self._get('stowed', package, version)
+
+    def set_stowed(self, package, version, timestamp):
+        self._set('stowed', package, version, timestamp)
+
+    def _get(self, column, package, version):
+        row = self.db.execute(
+            'SELECT {} FROM versions WHERE package = ? AND version = ?'
+            .format(column), (package, version)).fetchone()
+        return row and row[0]
+
+    def _set(self, column, package, version, value):
+        self._version(package, version)
+        self.db.execute('UPDATE versions SET {} = ? '
+                        'WHERE package = ? AND version = ?'.format(column),
+                        (value, package, version))
+
+    def size(self, package, version, st):
+        """Return cached size of version if its folder wasn't modified."""
+        row = self.db.execute(
+            'SELECT size FROM versions WHERE package = ? AND version = ? '
+            'AND inode = ? AND mtime = ?',
+            (package, version, st.st_ino, st.st_mtime)).fetchone()
+        return row and row[0]
+
+    def set_size(self, package, version, st, size):
+        self._version(package, version)
+        self.db.execute('UPDATE versions SET inode = ?, mtime = ?, size = ? '
+                        'WHERE package = ? AND version = ?',
+                        (st.st_ino, st.st_mtime, size, package, version))
+
+    def download(self, url):
+        """Return validators, size and checksum of downloaded *url*.
+
+        Checksum is ``None`` until the download is complete.
+        """
+        row = self.db.execute(
+            'SELECT etag, modified, size, sha256 FROM downloads '
+            'WHERE url = ?', (url,)).fetchone()
+        if row is not None:
+            return dict(zip(('etag', 'modified', 'size', 'sha256'), row))
+
+    def set_download(self, url, entry):
+        self.db.execute(
+            'INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?)',
+            (url, entry['etag'], entry['modified'], entry['size'],
+             entry['sha256']))
+
+    def listing(self, path, st):
+        """Return cached entries of target directory if it wasn't modified.
+
+        Entries map names to states returned by :func:`lstate`.
+        """
+        row = self.db.execute(
+            'SELECT entries FROM listings WHERE path = ? AND inode = ? '
+            'AND mtime = ?', (path, st.st_ino, st.st_mtime)).fetchone()
+        if row is not None:
+            return dict((name, tuple(state))
+                        for name, state in json.loads(row[0]).items())
+
+    def listing_paths(self):
+        return [path for path, in self.db.execute(
+            'SELECT path FROM listings ORDER BY path')]
+
+    def set_listing(self, path, st, entries):
+        self.db.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)',
+                        (path, st.st_ino, st.st_mtime, json.dumps(entries)))
+
+
+# Errors from reading broken or unsupported archives
+ARCHIVE_ERRORS = (tarfile.TarError, EOFError, EnvironmentError, zlib.error)
+try:
+    import lzma
+except ImportError:
+    lzma = None
+else:
+    ARCHIVE_ERRORS += (lzma.LZMAError,)
+
+
+class Prefixed(object):
+    """Stream that returns *prefix* before the rest of *fileobj*."""
+
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fileobj.read(size)
+        if size < 0:
+            data = self.prefix + self.fileobj.read()
+        else:
+            data = self.prefix[:size]
+            if len(data) < size:
+                data += self.fileobj.read(size - len(data))
+        self.prefix = self.prefix[len(data):]
+        return data
+
+
+class Decompressing(object):
+    """Stream that decompresses data read from *fileobj*.
+
+    *factory* makes a decompressor for every compressed stream, so data
+    made of several concatenated streams is decompressed as a whole.
+    Unlike :class:`gzip.GzipFile` and :class:`bz2.BZ2File` on Python 2,
+    this only ever calls ``read`` of *fileobj*.
+    """
+
+    def __init__(self, fileobj, factory):
+        self.fileobj = fileobj
+        self.factory = factory
+        self.decompressor = factory()
+        self.buffer = b''
+
+    def _decompress(self, data):
+        while data:
+            try:
+                self.buffer += self.decompressor.decompress(data)
+            except EOFError:
+                # Python 2 bz2 decompressor refuses data after end
+                pass
+            else:
+                data = self.decompressor.unused_data
+                if not data:
+                    return
+            self.decompressor = self.factory()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            data = self.fileobj.read(1 << 16)
+            if not data:
+                break
+            self._decompress(data)
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def open_tar(fileobj):
+    """Open tar archive for streaming, detect compression by magic number.
+
+    Unlike tarfile's own stream mode, this reads archives that consist of
+    several compressed streams, such as the ones made by pigz.
+    """
+    magic = fileobj.read(6)
+    fileobj = Prefixed(magic, fileobj)
+    if magic.startswith(b'\x1f\x8b'):
+        fileobj = Decompressing(
+            fileobj, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+    elif magic.startswith(b'BZh'):
+        fileobj = Decompressing(fileobj, bz2.BZ2Decompressor)
+    elif magic.startswith(b'\xfd7zXZ\x00'):
+        if lzma is None:
+            raise click.ClickException("xz archives are not supported")
+        fileobj = Decompressing(fileobj, lzma.LZMADecompressor)
+    return tarfile.open(fileobj=fileobj, mode='r|')
+
+
+class Digesting(object):
+    """Stream that computes SHA-256 checksum of data read from *fileobj*.
+
+    Data is also written to *copy* unless it's ``None``.
+    """
+
+    def __init__(self, fileobj, copy=None):
+        self.fileobj = fileobj
+        self.copy = copy
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        if self.copy is not None:
+            self.copy.write(data)
+        return data
+
+    def hexdigest(self):
+        """Read the rest of the stream and return its checksum."""
+        while self.read(1 << 20):
+            pass
+        return self.digest.hexdigest()
+
+
+# Size of chunks that large archives are downloaded in
+DOWNLOAD_CHUNK = 16 << 20
+
+
+class DownloadChanged(Exception):
+    """Remote file changed since partial download was started."""
+
+
+def is_url(path):
+    return path.startswith(('http://', 'https://'))
+
+
+def download_parts(downloads, key):
+    """Return partial files of download sorted by their offsets."""
+    parts = [name for name in os.listdir(downloads)
+             if name.startswith(key + '.') and name.endswith('.part')]
+    parts.sort(key=lambda name: int(name.rsplit('.', 2)[1]))
+    return [os.path.join(downloads, name) for name in parts]
+
+
+def entry_validator(entry):
+    """Return strong validator for ``If-Range`` header, if any."""
+    if entry['etag'] and not entry['etag'].startswith('W/'):
+        return entry['etag']
+    return entry['modified']
+
+
+def fetch_range(url, path, start, end, validator):
+    """Append bytes from ``start + size of path`` to *end* to file at *path*.
+
+    Raise :exc:`DownloadChanged` if the server sends a different version of
+    the file.
+    """
+    offset = start + (os.path.getsize(path) if os.path.exists(path) else 0)
+    if end is not None and offset > end:
+        return
+    headers = {
+        'Range': 'bytes={}-{}'.format(offset, '' if end is None else end),
+        'If-Range': validator,
+    }
+    try:
+        response = urlopen(Request(url, headers=headers), timeout=60)
+    except HTTPError as err:
+        # Nothing left to download from open-ended range
+        if err.code == 416 and end is None:
+            return
+        raise
+    try:
+        if response.getcode() != 206:
+            raise DownloadChanged(url)
+        with open(path, 'ab') as fp:
+            shutil.copyfileobj(response, fp)
+    finally:
+        response.close()
+
+
+def member_path(name, strip_components=0):
+    """Return safe relative path of archive member or None if it's stripped.
+
+    Raise error if the member would end up outside of the package.
+    """
+    parts = [part for part in name.split('/') if part not in ('', '.')]
+    if name.startswith('/') or '..' in parts:
+        raise click.ClickException(
+            "archive member '{}' points outside of the package"
+            .format(name))
+    parts = parts[strip_components:]
+    if parts:
+        return os.path.join(*parts)
+
+
+def symlinked(name, links):
+    """Check if any parent folder of *name* is one of *links*."""
+    parent = os.path.dirname(name)
+    while parent:
+        if parent in links:
+            return True
+        parent = os.path.dirname(parent)
+    return False
+
+
+# Archive member with manifest of version written by ``pack``
+MANIFEST_NAME = '.steeve-manifest.json'
+
+
+def extract_tar(tar, dst, strip_components=0):
+    """Extract streamed tar archive into *dst* which must not exist.
+
+    Only regular files, folders and links are extracted.  Members are never
+    written through or over symlinks extracted before them.  Files are
+    hashed while they are extracted, return manifest of extracted files.  If
+    the archive starts with manifest, fail unless the contents match it.
+    """
+    os.mkdir(dst)
+    dirs = []
+    links = set()
+    digests = {}
+    embedded = None
+    for member in tar:
+        name = member_path(member.name, strip_components)
+        if name is None:
+            continue
+        if name == MANIFEST_NAME and member.isfile() and embedded is None:
+            try:
+                embedded = dict(
+                    (rel, ManifestEntry(mode, size, digest, None, None))
+                    for rel, (mode, size, digest) in
+                    json.loads(tar.extractfile(member).read()
+                               .decode('utf-8')).items())
+            except ValueError as err:
+                raise click.ClickException(
+                    "invalid manifest in archive: {}".format(err))
+            continue
+        if name in links or symlinked(name, links):
+            raise click.ClickException(
+                "archive member '{}' points outside of the package"
+                .format(member.name))
+        path = os.path.join(dst, name)
+        parent = os.path.dirname(path)
+        if os.path.lexists(parent) and not os.path.isdir(parent):
+            raise click.ClickException(
+                "cannot extract archive member '{}': parent is not a folder"
+                .format(member.name))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        if os.path.lexists(path) and not member.isdir():
+            if os.path.isdir(path):
+                raise click.ClickException(
+                    "cannot extract archive member '{}' over a folder"
+                    .format(member.name))
+            os.remove(path)
+
+        if member.isdir():
+            try:
+                st = os.lstat(path)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+                os.mkdir(path)
+            else:
+                if not stat.S_ISDIR(st.st_mode):
+                    raise click.ClickException(
+                        "archive member '{}' is not a folder"
+                        .format(member.name))
+            dirs.append((path, member))
+        elif member.issym():
+            os.symlink(member.linkname, path)
+            links.add(name)
+        elif member.islnk():
+            source = member_path(member.linkname, strip_components)
+            if source is None or source in links or symlinked(source, links):
+                raise click.ClickException(
+                    "archive member '{}' points outside of the package"
+                    .format(member.name))
+            if not os.path.isfile(os.path.join(dst, source)):
+                raise click.ClickException(
+                    "cannot extract archive member '{}': '{}' is not a file"
+                    .format(member.name, member.linkname))
+            os.link(os.path.join(dst, source), path)
+            if source in digests:
+                digests[name] = digests[source]
+        elif member.isfile():
+            digest = hashlib.sha256()
+            fsrc = tar.extractfile(member)
+            with open(path, 'wb') as fp:
+                for chunk in iter(lambda: fsrc.read(1 << 20), b''):
+                    digest.update(chunk)
+                    fp.write(chunk)
+            digests[name] = digest.hexdigest()
+            os.chmod(path, member.mode & 0o777)
+            os.utime(path, (member.mtime, member.mtime))
+    for path, member in reversed(dirs):
+        # Never change folders that links point to
+        if os.path.islink(path):
+            raise click.ClickException(
+                "archive member '{}' points outside of the package"
+                .format(member.name))
+        os.chmod(path, member.mode & 0o777)
+        os.utime(path, (member.mtime, member.mtime))
+
+    manifest = {}
+    for name, digest in digests.items():
+        st = os.lstat(os.path.join(dst, name))
+        manifest[name] = ManifestEntry(st.st_mode, st.st_size, digest,
+                                       st.st_ino, st.st_mtime)
+    if embedded is not None:
+        actual = manifest_tree(dst, known=manifest)
+        problems = []
+        for rel in sorted(set(embedded) | set(actual)):
+            problem = manifest_problem(embedded.get(rel), actual.get(rel))
+            if problem is not None:
+                problems.append('  * {}: {}'.format(rel, problem))
+        if problems:
+            raise click.ClickException(
+                "archive doesn't match its manifest:\n{}"
+                .format('\n'.join(problems)))
+    return manifest
+
+
+ABSENT = (None, None)
+DIR = ('dir', None)
+FILE = ('file', None)
+
+
+def lstate(path):
+    """Return kind of node at *path* and destination if it's a symlink."""
+    try:
+        st = os.lstat(path)
+    except OSError as err:
+        if err.errno in (errno.ENOENT, errno.ENOTDIR):
+            return ABSENT
+        raise
+    if stat.S_ISLNK(st.st_mode):
+        return ('link', os.readlink(path))
+    elif stat.S_ISDIR(st.st_mode):
+        return DIR
+    else:
+        return FILE
+
+
+def pending_changes(changes, fs):
+    """Split changes of interrupted plan into ones that are not done yet
+    and paths that were changed by other means since.
+
+    Nodes that were removed but not created again are created from scratch.
+    """
+    pending = []
+    changed = []
+    for path, old, new in changes:
+        state = fs.state(path)
+        if state == new:
+            continue
+        elif (new[0] in ('hardlink', 'reflink') and
+                state not in (ABSENT, DIR, old)):
+            # Hard links and clones look like any other file
+            continue
+        elif state == old:
+            pending.append((path, old, new))
+        elif state == ABSENT:
+            pending.append((path, ABSENT, new))
+        else:
+            changed.append(path)
+    return pending, changed
+
+
+# Listings of target folders kept in memory by `steeve serve`, map paths to
+# inode, modification time and entries
+WARM = {}
+
+
+def listdir_states(path):
+    """Return dict mapping names in directory *path* to their states."""
+    entries = {}
+    for entry in scandir(path):
+        if entry.is_symlink():
+            try:
+                entries[entry.name] = ('link', os.readlink(entry.path))
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+        elif entry.is_dir(follow_symlinks=False):
+            entries[entry.name] = DIR
+        else:
+            entries[entry.name] = FILE
+    return entries
+
+
+class FileSystem(object):
+    """Operations on packages and targets that :class:`Steeve` goes through.
+
+    Backends implement :meth:`lstat`, :meth:`stat`, :meth:`listdir`,
+    :meth:`readlink`, :meth:`symlink`, :meth:`mkdir`, :meth:`rmdir`,
+    :meth:`remove`, :meth:`rename`, :meth:`exchange`, :meth:`copytree`,
+    :meth:`rmtree`, :meth:`mkdtemp`, :meth:`open`, :meth:`digest` and
+    :meth:`index`, the rest is built on them.  Locks, journals, shared
+    files and downloaded archives always live on disk.
+    """
+
+    # Changes are kept in memory, so there is nothing to lock or journal
+    in_memory = False
+
+    def exists(self, path):
+        try:
+            self.stat(path)
+        except OSError:
+            return False
+        return True
+
+    def lexists(self, path):
+        try:
+            self.lstat(path)
+        except OSError:
+            return False
+        return True
+
+    def isdir(self, path):
+        try:
+            return stat.S_ISDIR(self.stat(path).st_mode)
+        except OSError:
+            return False
+
+    def islink(self, path):
+        try:
+            return stat.S_ISLNK(self.lstat(path).st_mode)
+        except OSError:
+            return False
+
+    def makedirs(self, path):
+        parent = os.path.dirname(path)
+        if parent != path and not self.isdir(parent):
+            self.makedirs(parent)
+        self.mkdir(path)
+
+    def state(self, path):
+        """Return state of node at *path*, see :func:`lstate`."""
+        try:
+            st = self.lstat(path)
+        except OSError as err:
+            if err.errno in (errno.ENOENT, errno.ENOTDIR):
+                return ABSENT
+            raise
+        if stat.S_ISLNK(st.st_mode):
+            return ('link', self.readlink(path))
+        elif stat.S_ISDIR(st.st_mode):
+            return DIR
+        else:
+            return FILE
+
+    def states(self, path):
+        """Return dict mapping names in directory *path* to their states."""
+        return dict((name, self.state(os.path.join(path, name)))
+                    for name in self.listdir(path))
+
+    def dirnames(self, path):
+        """Return names of folders and links to folders in *path*."""
+        return [name for name in self.listdir(path)
+                if self.isdir(os.path.join(path, name))]
+
+    def walk_files(self, root):
+        """Yield paths of files and links in *root* relative to it."""
+        for path, st in self.walk(root):
+            if not stat.S_ISDIR(st.st_mode):
+                yield os.path.relpath(path, root)
+
+    def walk(self, root):
+        """Yield paths of nodes in *root* with their stats, top to bottom."""
+        for name in sorted(self.listdir(root)):
+            path = os.path.join(root, name)
+            st = self.lstat(path)
+            yield path, st
+            if stat.S_ISDIR(st.st_mode):
+                for item in self.walk(path):
+                    yield item
+
+    def disk_usage(self, root, jobs=1):
+        """Return size of files in *root*, hard links are counted once."""
+        total = 0
+        inodes = set()
+        for path, st in self.walk(root):
+            if st.st_ino not in inodes:
+                inodes.add(st.st_ino)
+                total += st.st_size
+        return total
+
+    def manifest(self, root, jobs=1, known=None):
+        """Return manifest of files and links in *root*, see
+        :func:`manifest_tree`."""
+        known = known or {}
+        manifest = {}
+        for path, st in self.walk(root):
+            if stat.S_ISDIR(st.st_mode):
+                continue
+            rel = os.path.relpath(path, root)
+            entry = known.get(rel)
+            if stat.S_ISLNK(st.st_mode):
+                digest = self.readlink(path)
+            elif not stat.S_ISREG(st.st_mode):
+                digest = ''
+            elif (entry is not None and
+                    (entry.size, entry.inode, entry.mtime) ==
+                    (st.st_size, st.st_ino, st.st_mtime)):
+                digest = entry.digest
+            else:
+                digest = self.digest(path)
+            manifest[rel] = ManifestEntry(st.st_mode, st.st_size, digest,
+                                          st.st_ino, st.st_mtime)
+        return manifest
+
+
+class PosixFS(FileSystem):
+    """Files on disk."""
+
+    lstat = staticmethod(os.lstat)
+    stat = staticmethod(os.stat)
+    listdir = staticmethod(os.listdir)
+    readlink = staticmethod(os.readlink)
+    mkdir = staticmethod(os.mkdir)
+    makedirs = staticmethod(os.makedirs)
+    rmdir = staticmethod(os.rmdir)
+    remove = staticmethod(os.remove)
+    rename = staticmethod(os.rename)
+    exists = staticmethod(os.path.exists)
+    lexists = staticmethod(os.path.lexists)
+    isdir = staticmethod(os.path.isdir)
+    islink = staticmethod(os.path.islink)
+
+    def symlink(self, dest, path):
+        symlink(dest, path)
+
+    def link_file(self, src, path, mode='hardlink'):
+        link_file(src, path, mode)
+
+    def exchange(self, path, other):
+        exchange(path, other)
+
+    def rmtree(self, path, ignore_errors=False, onerror=None):
+        shutil.rmtree(path, ignore_errors, onerror)
+
+    def copytree(self, src, dst, mode='copy', jobs=1, base=None,
+                 checksums=None):
+        return copy_tree(src, dst, mode, jobs, base, checksums)
+
+    def open(self, path):
+        return open(path, 'rb')
+
+    def digest(self, path):
+        return file_digest(path)
+
+    def state(self, path):
+        return lstate(path)
+
+    def states(self, path):
+        return listdir_states(path)
+
+    def disk_usage(self, root, jobs=1):
+        return disk_usage(root, jobs)
+
+    def manifest(self, root, jobs=1, known=None):
+        return manifest_tree(root, jobs, known)
+
+    def walk_files(self, root):
+        return walk_files(root)
+
+    def dirnames(self, path):
+        return [entry.name for entry in scandir(path) if entry.is_dir()]
+
+    def mkdtemp(self, dir):
+        return tempfile.mkdtemp(dir=dir)
+
+    def index(self, path):
+        return Index(path)
+
+
+POSIX = PosixFS()
+
+
+class MemoryNode(object):
+    """File, folder or link of :class:`MemoryFS`.
+
+    Nodes read from base filesystem remember their *origin* path there, its
+    stat and entries of folders are read when first needed.
+    """
+
+    __slots__ = ('kind', 'dest', 'origin', 'data', 'st', 'entries')
+
+    def __init__(self, kind, dest=None, origin=None, data=b'', st=None):
+        self.kind = kind
+        self.dest = dest
+        self.origin = origin
+        self.data = data
+        self.st = st
+        self.entries = {} if kind == 'dir' and origin is None else None
+
+    @property
+    def state(self):
+        if self.kind == 'link':
+            return ('link', self.dest)
+        return DIR if self.kind == 'dir' else FILE
+
+
+class MemoryFS(FileSystem):
+    """Files kept in memory.
+
+    With *base* filesystem, memory overlays it: nodes are read from *base*
+    when first needed and changes never reach it.  Without it the tree
+    starts empty, which makes simulations of thousands of packages run at
+    memory speed.  Copies of folders from *base* share its files until they
+    are changed.  Index is kept in memory as well.
+    """
+
+    in_memory = True
+
+    MODES = {
+        'dir': stat.S_IFDIR | 0o755,
+        'file': stat.S_IFREG | 0o644,
+        'link': stat.S_IFLNK | 0o777,
+    }
+
+    def __init__(self, base=None):
+        self.base = base
+        self._inodes = itertools.count(1 << 48)
+        self._lock = threading.RLock()
+        self.root = self._new('dir', origin=None if base is None
+                              else os.path.sep)
+        self._indexes = {}
+
+    def lstat(self, path):
+        with self._lock:
+            return self._stat(self._get(path, follow=False))
+
+    def stat(self, path):
+        with self._lock:
+            return self._stat(self._get(path))
+
+    def readlink(self, path):
+        with self._lock:
+            node = self._get(path, follow=False)
+            if node.kind != 'link':
+                raise self._error(errno.EINVAL, path)
+            return node.dest
+
+    def listdir(self, path):
+        with self._lock:
+            return list(self._entries(self._get_dir(path)))
+
+    def state(self, path):
+        with self._lock:
+            try:
+                node = self._lookup(path, follow=False)[2]
+            except OSError as err:
+                if err.errno in (errno.ENOENT, errno.ENOTDIR):
+                    return ABSENT
+                raise
+            return ABSENT if node is None else node.state
+
+    def states(self, path):
+        with self._lock:
+            return dict((name, node.state) for name, node in
+                        self._entries(self._get_dir(path)).items())
+
+    def symlink(self, dest, path):
+        """Create or replace link *path* pointing to *dest*."""
+        with self._lock:
+            parent, name, node = self._lookup(path, follow=False)
+            if node is not None and node.kind == 'dir':
+                raise self._error(errno.EISDIR, path)
+            self._set(parent, name, self._new('link', dest), path)
+
+    def link_file(self, src, path, mode='hardlink'):
+        """Create or replace *path* with hard link or copy of *src*."""
+        with self._lock:
+            node = self._get(src, follow=False)
+            parent, name, old = self._lookup(path, follow=False)
+            if old is not None and old.kind == 'dir':
+                raise self._error(errno.EISDIR, path)
+            self._set(parent, name, self._copy(node, mode == 'hardlink'),
+                      path)
+
+    def write(self, path, data=b''):
+        """Create or replace file *path* with contents *data*."""
+        with self._lock:
+            parent, name, node = self._lookup(path, follow=False)
+            if node is not None and node.kind == 'dir':
+                raise self._error(errno.EISDIR, path)
+            self._set(parent, name, self._new('file', data=data), path)
+
+    def mkdir(self, path):
+        with self._lock:
+            parent, name, node = self._lookup(path, follow=False)
+            if node is not None:
+                raise self._error(errno.EEXIST, path)
+            self._set(parent, name, self._new('dir'), path)
+
+    def rmdir(self, path):
+        with self._lock:
+            parent, name, node = self._lookup(path, follow=False)
+            if node is None:
+                raise self._error(errno.ENOENT, path)
+            elif node.kind != 'dir':
+                raise self._error(errno.ENOTDIR, path)
+            elif self._entries(node):
+                raise self._error(errno.ENOTEMPTY, path)
+            self._set(parent, name, None, path)
+
+    def remove(self, path):
+        with self._lock:
+            parent, name, node = self._lookup(path, follow=False)
+            if node is None:
+                raise self._error(errno.ENOENT, path)
+            elif node.kind == 'dir':
+                raise self._error(errno.EISDIR, path)
+            self._set(parent, name, None, path)
+
+    def rename(self, src, dst):
+        with self._lock:
+            parent, name, node = self._lookup(src, follow=False)
+            dst_parent, dst_name, dst_node = self._lookup(dst, follow=False)
+            if node is None:
+                raise self._error(errno.ENOENT, src)
+            elif dst_node is node:
+                return
+            elif dst_node is not None and dst_node.kind == 'dir':
+                if node.kind != 'dir':
+                    raise self._error(errno.EISDIR, dst)
+                elif self._entries(dst_node):
+                    raise self._error(errno.ENOTEMPTY, dst)
+            elif dst_node is not None and node.kind == 'dir':
+                raise self._error(errno.ENOTDIR, dst)
+            self._set(parent, name, None, src)
+            self._set(dst_parent, dst_name, node, dst)
+
+    def exchange(self, path, other):
+        with self._lock:
+            parent, name, node = self._lookup(path, follow=False)
+            other_parent, other_name, other_node = self._lookup(
+                other, follow=False)
+            if node is None or other_node is None:
+                raise self._error(errno.ENOENT,
+                                  path if node is None else other)
+            self._set(parent, name, other_node, path)
+            self._set(other_parent, other_name, node, other)
+
+    def copytree(self, src, dst, mode='copy', jobs=1, base=None,
+                 checksums=None):
+        """Copy folder *src* to *dst* which must not exist, see
+        :func:`copy_tree`."""
+        with self._lock:
+            parent = os.path.dirname(dst)
+            if not self.isdir(parent):
+                self.makedirs(parent)
+            if mode == 'move':
+                self.rename(src, dst)
+                return set([mode])
+            node = self._get_dir(src)
+            dst_parent, dst_name, dst_node = self._lookup(dst, follow=False)
+            if dst_node is not None:
+                raise self._error(errno.EEXIST, dst)
+            self._set(dst_parent, dst_name,
+                      self._copy(node, mode == 'hardlink'), dst)
+            return set([mode])
+
+    def rmtree(self, path, ignore_errors=False, onerror=None):
+        with self._lock:
+            try:
+                parent, name, node = self._lookup(path, follow=False)
+                if node is None:
+                    raise self._error(errno.ENOENT, path)
+                elif node.kind != 'dir':
+                    raise self._error(errno.ENOTDIR, path)
+            except OSError:
+                if ignore_errors:
+                    return
+                elif onerror is not None:
+                    onerror(self.rmtree, path, sys.exc_info())
+                    return
+                raise
+            self._set(parent, name, None, path)
+
+    def mkdtemp(self, dir):
+        with self._lock:
+            for number in itertools.count():
+                path = os.path.join(dir, 'tmp{}'.format(number))
+                if not self.lexists(path):
+                    self.mkdir(path)
+                    return path
+
+    def open(self, path):
+        with self._lock:
+            node = self._get(path)
+        if node.origin is not None:
+            return self.base.open(node.origin)
+        return io.BytesIO(node.data)
+
+    def digest(self, path):
+        with self._lock:
+            node = self._get(path)
+        if node.origin is not None:
+            return self.base.digest(node.origin)
+        return hashlib.sha256(node.data).hexdigest()
+
+    def index(self, path):
+        """Return index shared by all users of the filesystem.
+
+        Index of base filesystem is copied to memory when first opened.
+        """
+        with self._lock:
+            db = self._indexes.get(path)
+            if db is None:
+                db = sqlite3.connect(':memory:', check_same_thread=False)
+                if self.base is not None and self.base.exists(path):
+                    with closing(sqlite3.connect(path, timeout=60)) as src:
+                        db.executescript('\n'.join(src.iterdump()))
+                self._indexes[path] = db
+            return MemoryIndex(db, self._lock)
+
+    def changes(self, exclude=()):
+        """Yield ``(path, old, new)`` states of nodes that differ from base,
+        sorted from top to bottom.
+
+        Contents of removed folders, copied folders and paths in *exclude*
+        are skipped.
+        """
+        with self._lock:
+            for change in self._changes(os.path.sep, self.root,
+                                        set(exclude)):
+                yield change
+
+    def _changes(self, path, node, exclude, created=False):
+        old = {}
+        if self.base is not None and not created:
+            try:
+                old = self.base.states(path)
+            except OSError as err:
+                if err.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+        entries = self._entries(node)
+        for name in sorted(set(old) | set(entries)):
+            child_path = os.path.join(path, name)
+            child = entries.get(name)
+            if child_path in exclude:
+                continue
+            new = ABSENT if child is None else child.state
+            if new == DIR and old.get(name) == DIR:
+                if child.origin != child_path or child.entries is not None:
+                    for change in self._changes(child_path, child, exclude):
+                        yield change
+            elif new != old.get(name, ABSENT):
+                yield child_path, old.get(name, ABSENT), new
+                # Show what was put into new folders, but not copies
+                if new == DIR and child.origin is None:
+                    for change in self._changes(child_path, child, exclude,
+                                                created=True):
+                        yield change
+
+    def _new(self, kind, dest=None, origin=None, data=b''):
+        node = MemoryNode(kind, dest, origin, data)
+        if origin is None:
+            node.st = self._make_stat(kind, len(data or dest or ''))
+        return node
+
+    def _make_stat(self, kind, size=0, inode=None):
+        now = time.time()
+        if inode is None:
+            inode = next(self._inodes)
+        return os.stat_result((self.MODES[kind], inode, 0, 1, os.getuid(),
+                               os.getgid(), size, now, now, now))
+
+    def _stat(self, node):
+        if node.st is None:
+            node.st = self.base.lstat(node.origin)
+        return node.st
+
+    def _entries(self, node):
+        if node.entries is None:
+            node.entries = dict(
+                (name, MemoryNode(state[0], state[1],
+                                  os.path.join(node.origin, name)))
+                for name, state in self.base.states(node.origin).items())
+        return node.entries
+
+    def _copy(self, node, linked=False):
+        if node.kind == 'dir':
+            copy = MemoryNode('dir', origin=node.origin,
+                              st=self._make_stat('dir'))
+            if node.entries is not None:
+                copy.entries = dict((name, self._copy(child, linked))
+                                    for name, child in node.entries.items())
+            return copy
+        st = self._stat(node)
+        if not linked:
+            st = os.stat_result((st.st_mode, next(self._inodes)) +
+                                tuple(st)[2:])
+        return MemoryNode(node.kind, node.dest, node.origin, node.data, st)
+
+    def _set(self, parent, name, node, path):
+        """Put *node* into folder *parent*, ``None`` removes the entry."""
+        if parent is None:
+            raise self._error(errno.EBUSY, path)
+        entries = self._entries(parent)
+        if node is None:
+            del entries[name]
+        else:
+            entries[name] = node
+        st = self._stat(parent)
+        now = time.time()
+        parent.st = os.stat_result(tuple(st)[:7] + (now, now, now))
+
+    def _get(self, path, follow=True):
+        node = self._lookup(path, follow)[2]
+        if node is None:
+            raise self._error(errno.ENOENT, path)
+        return node
+
+    def _get_dir(self, path):
+        node = self._get(path)
+        if node.kind != 'dir':
+            raise self._error(errno.ENOTDIR, path)
+        return node
+
+    def _lookup(self, path, follow=True):
+        """Return folder that contains *path*, name and node at *path*.
+
+        Node is ``None`` if it doesn't exist, but its folder does.  Links
+        are followed, except the last one unless *follow* is true.
+        """
+        parts = os.path.abspath(path).split(os.path.sep)
+        parent, name, node = None, '', self.root
+        current = os.path.sep
+        links = 0
+        while parts:
+            part = parts.pop(0)
+            if not part:
+                continue
+            if node is None:
+                raise self._error(errno.ENOENT, path)
+            elif node.kind != 'dir':
+                raise self._error(errno.ENOTDIR, path)
+            parent, name = node, part
+            node = self._entries(node).get(part)
+            if node is not None and node.kind == 'link' and (
+                    follow or any(parts)):
+                links += 1
+                if links > 40:
+                    raise self._error(errno.ELOOP, path)
+                parts = os.path.normpath(os.path.join(
+                    current, node.dest)).split(os.path.sep) + parts
+                parent, name, node = None, '', self.root
+                current = os.path.sep
+            else:
+                current = os.path.join(current, part)
+        return parent, name, node
+
+    @staticmethod
+    def _error(code, path):
+        return OSError(code, os.strerror(code), path)
+
+
+class MemoryIndex(Index):
+    """Index of :class:`MemoryFS`, kept open and shared by threads.
+
+    Blocks that use the index are serialized by *lock*.
+    """
+
+    def __init__(self, db, lock):
+        self.db = db
+        self.lock = lock
+        with self.lock:
+            self.db.executescript(self.SCHEMA)
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.db.commit()
+            else:
+                self.db.rollback()
+        finally:
+            self.lock.release()
+
+
+class Plan(object):
+    """Pending changes of target tree.
+
+    Plan overlays the target: nodes that were touched are kept in memory with
+    their final state, the rest of the tree is read from disk on demand.
+    Nothing is modified until :meth:`execute` is called.
+    """
+
+    def __init__(self, target, index=None, fs=POSIX):
+        self.target = target
+        self.index = index
+        self.fs = fs
+        self.conflicts = []
+        self.roots = {}
+        self._nodes = {}
+        self._children = {}
+        self._real = {}
+        self._listings = {}
+
+    def conflict(self, message, *args):
+        self.conflicts.append(message.format(*args))
+
+    def real_state(self, path):
+        """Return state of *path* as it is on disk before the plan runs."""
+        try:
+            return self._real[path]
+        except KeyError:
+            pass
+        parent, name = os.path.split(path)
+        if path == self.target:
+            state = DIR if self.fs.isdir(path) else ABSENT
+        elif self.real_state(parent) != DIR:
+            state = ABSENT
+        else:
+            entries = self._listing(parent, scan=False)
+            if entries is None:
+                state = self.fs.state(path)
+            else:
+                state = entries.get(name, ABSENT)
+        self._real[path] = state
+        return state
+
+    def _listing(self, path, scan=True):
+        """Return entries of directory *path* as it is on disk.
+
+        Listings are cached in *index*, or kept in memory by ``steeve
+        serve``, and reused while inode and modification time of the
+        directory stay the same, so large shared directories are not read on
+        every run.  If *scan* is false, return
+        ``None`` instead of reading a directory that is not cached.
+        """
+        try:
+            entries = self._listings[path]
+        except KeyError:
+            entries = None
+            st = self.fs.stat(path)
+            warm = WARM.get(path)
+            if warm is not None and warm[:2] == (st.st_ino, st.st_mtime):
+                entries = warm[2]
+            elif self.index is not None:
+                entries = self.index.listing(path, st)
+            self._listings[path] = entries
+        if entries is None and scan:
+            st = self.fs.stat(path)
+            entries = self._listings[path] = self.fs.states(path)
+            # Directory modified right after reading could keep the same
+            # mtime, so only listings that are old enough are cached
+            if self.index is not None and time.time() - st.st_mtime > 2:
+                self.index.set_listing(path, st, entries)
+        return entries
+
+    def state(self, path):
+        """Return state of *path* after the plan runs."""
+        try:
+            return self._nodes[path]
+        except KeyError:
+            pass
+        if path != self.target and not self._on_disk(os.path.dirname(path)):
+            return ABSENT
+        return self.real_state(path)
+
+    def _on_disk(self, path):
+        """Check if children of directory *path* are read from disk."""
+        if self._nodes.get(path, DIR) != DIR or self.real_state(path) != DIR:
+            return False
+        return path == self.target or self._on_disk(os.path.dirname(path))
+
+    def listdir(self, path):
+        names = set(self._children.get(path, ()))
+        if self._on_disk(path):
+            names.update(self._listing(path))
+        return sorted(name for name in names
+                      if self.state(os.path.join(path, name)) != ABSENT)
+
+    def link(self, path, dest):
+        self._set(path, ('link', dest))
+
+    def place(self, path, mode, src):
+        """Put hard link or clone of *src* at *path*.
+
+        Node that is already the same as *src* is kept, that is a hard link
+        to it, a file with the same size and modification time if it's a
+        clone, or a link with the same destination if *src* is a link.
+        """
+        old = self.real_state(path)
+        src_st = self.fs.lstat(src)
+        if stat.S_ISLNK(src_st.st_mode):
+            same = old == ('link', self.fs.readlink(src))
+        elif old == FILE:
+            st = self.fs.lstat(path)
+            if mode == 'hardlink':
+                same = (st.st_dev, st.st_ino) == (src_st.st_dev,
+                                                  src_st.st_ino)
+            else:
+                same = ((st.st_mode, st.st_size, st.st_mtime) ==
+                        (src_st.st_mode, src_st.st_size, src_st.st_mtime))
+        else:
+            same = False
+        self._set(path, old if same else (mode, src))
+
+    def mkdir(self, path):
+        self._set(path, DIR)
+
+    def remove(self, path):
+        self._set(path, ABSENT)
+
+    def _set(self, path, state):
+        self.real_state(path)
+        self._nodes[path] = state
+        parent, name = os.path.split(path)
+        self._children.setdefault(parent, set()).add(name)
+
+    def changes(self):
+        """Return list of ``(path, old, new)`` sorted from top to bottom."""
+        changes = []
+        for path, new in self._nodes.items():
+            if (path != self.target and
+                    self.state(os.path.dirname(path)) != DIR):
+                new = ABSENT
+            old = self.real_state(path)
+            if old != new:
+                changes.append((path, old, new))
+        changes.sort(key=lambda change: change[0].split(os.path.sep))
+        return changes
+
+    def execute(self, verbose=0, between=None, dry_run=False):
+        """Apply changes to the target.
+
+        New directories and links are created top to bottom first, then
+        *between* is called, then obsolete nodes are removed bottom to top,
+        so that a folded directory is replaced with a link only after it has
+        been emptied.  Existing links are replaced atomically.  If *dry_run*
+        is true, print the changes instead.
+        """
+        changes = self.changes()
+        self.execute_additions(changes, verbose, dry_run)
+        if between is not None and not dry_run:
+            between()
+        self.execute_removals(changes, verbose, dry_run)
+        return changes
+
+    def execute_additions(self, changes, verbose=0, dry_run=False):
+        """Create new directories and links from top to bottom."""
+        for path, old, new in changes:
+            if new == ABSENT or old == DIR:
+                continue
+            if old != ABSENT and new == DIR:
+                self._remove(path, old, verbose, dry_run)
+            self._create(path, new, verbose, dry_run)
+
+    def execute_removals(self, changes, verbose=0, dry_run=False):
+        """Remove obsolete nodes from bottom to top."""
+        for path, old, new in reversed(changes):
+            if new == ABSENT or old == DIR:
+                self._remove(path, old, verbose, dry_run)
+                if new != ABSENT:
+                    self._create(path, new, verbose, dry_run)
+
+    def undo_additions(self, changes, verbose=0):
+        """Revert additions of *changes* that were made, from bottom to
+        top.
+
+        Hard links and clones that replaced files can't be reverted and are
+        left in place.
+        """
+        for path, old, new in reversed(changes):
+            if new == ABSENT or old == DIR or old == FILE:
+                continue
+            state = self.fs.state(path)
+            if state != new and (new[0] not in ('hardlink', 'reflink') or
+                                 state in (ABSENT, DIR, old)):
+                continue
+            if old == ABSENT or state == DIR:
+                self._remove(path, state, verbose, False)
+            if old != ABSENT:
+                self._create(path, old, verbose, False)
+
+    def _create(self, path, new, verbose, dry_run):
+        kind, dest = new
+        if kind == 'link':
+            self._log(verbose, dry_run, 'LINK: {} => {}', path, dest)
+            if not dry_run:
+                self.fs.symlink(dest, path)
+        elif kind in ('hardlink', 'reflink'):
+            self._log(verbose, dry_run, kind.upper() + ': {} => {}', path,
+                      dest)
+            if not dry_run:
+                self.fs.link_file(dest, path, kind)
+        else:
+            self._log(verbose, dry_run, 'MKDIR: {}', path)
+            if not dry_run:
+                self.fs.mkdir(path)
+
+    def _remove(self, path, old, verbose, dry_run):
+        if old == DIR:
+            self._log(verbose, dry_run, 'RMDIR: {}', path)
+            if not dry_run:
+                self.fs.rmdir(path)
+        else:
+            self._log(verbose, dry_run, 'UNLINK: {}', path)
+            if not dry_run:
+                self.fs.remove(path)
+
+    def _log(self, verbose, dry_run, message, path, *args):
+        if verbose > 0 or dry_run:
+            path = os.path.relpath(path, self.target)
+            click.echo(message.format(path, *args), err=not dry_run)
+
+
+# Files that GNU Stow ignores by default. The first pattern is matched
+# against path relative to package root, the second one against file name.
+IGNORE_TOP = re.compile(r'^(README.*|LICENSE.*|COPYING)$')
+IGNORE = re.compile(r'^(RCS|.+,v|CVS|\.#.+|\.cvsignore|\.svn|_darcs|\.hg|'
+                    r'\.git|\.gitignore|\.gitmodules|.+~|#.*#)$')
+
+
+class Stower(namedtuple('Stower',
+                         'dir target no_folding sources fs modes')):
+    """Plan links between package and target the same way GNU Stow does.
+
+    *source* arguments are paths of package roots that links point to,
+    usually ``current`` link of the package.  Contents are read from *root*
+    which defaults to *source*.  Plan remembers roots, so links of packages
+    that are switched in the same plan are read from right versions.
+    Listings of packages are kept in *sources*, which can be shared by
+    stowers of several targets.  Packages are read through filesystem
+    *fs*.  *modes* maps sources that are stowed with hard links or clones
+    of files instead of symlinks to their link modes, their folders are
+    never folded.
+    """
+
+    def stow(self, plan, source, root=None):
+        plan.roots[source] = root or source
+        self._stow_contents(plan, root or source, source, self.target, True)
+
+    def unstow(self, plan, source, root=None):
+        plan.roots[source] = root or source
+        self._unstow_contents(plan, root or source, source, self.target,
+                              True)
+
+    def owns(self, path):
+        return path.startswith(self.dir + os.path.sep)
+
+    def remove_entries(self, plan, paths):
+        """Remove hard links and clones at *paths* recorded in the index and
+        folders they leave empty."""
+        parents = set()
+        for path in paths:
+            if (path.startswith(self.target + os.path.sep) and
+                    plan.state(path)[0] in ('file', 'link')):
+                plan.remove(path)
+                parents.add(os.path.dirname(path))
+        for path in sorted(parents, reverse=True,
+                           key=lambda path: path.count(os.path.sep)):
+            while path != self.target and not plan.listdir(path):
+                plan.remove(path)
+                path = os.path.dirname(path)
+
+    def stow_path(self, plan, source, root, rel):
+        """Stow node at path *rel* in package that appeared after the
+        package was stowed."""
+        parts = rel.split(os.path.sep)
+        if self._ignored(parts):
+            return
+        for depth in range(1, len(parts) + 1):
+            prefix = os.path.join(*parts[:depth])
+            target = os.path.join(self.target, prefix)
+            kind, dest = plan.state(target)
+            if (kind == 'link' and
+                    self._resolve(target, dest) ==
+                    os.path.join(source, prefix)):
+                # Folded into the package, the node is already there
+                return
+            elif kind != 'dir' or depth == len(parts):
+                self._stow_node(plan, os.path.join(root, prefix),
+                                os.path.join(source, prefix), target)
+                return
+
+    def unstow_path(self, plan, source, rel):
+        """Unstow node at path *rel* in package that disappeared after the
+        package was stowed."""
+        parts = rel.split(os.path.sep)
+        if self._ignored(parts):
+            return
+        for depth in range(1, len(parts) + 1):
+            prefix = os.path.join(*parts[:depth])
+            target = os.path.join(self.target, prefix)
+            kind, dest = plan.state(target)
+            if kind == 'link':
+                if (depth == len(parts) and
+                        self._resolve(target, dest) ==
+                        os.path.join(source, prefix)):
+                    plan.remove(target)
+                return
+            elif kind != 'dir':
+                return
+            elif depth == len(parts):
+                self._unstow_missing(plan, os.path.join(source, prefix),
+                                     target)
+
+    def _unstow_missing(self, plan, source, target):
+        """Remove links into folder *source* that is gone from *target* and
+        folders that become empty."""
+        for name in plan.listdir(target):
+            path = os.path.join(target, name)
+            kind, dest = plan.state(path)
+            if kind == 'link':
+                if self._resolve(path, dest).startswith(source + os.path.sep):
+                    plan.remove(path)
+            elif kind == 'dir':
+                self._unstow_missing(plan, os.path.join(source, name), path)
+        if not plan.listdir(target):
+            plan.remove(target)
+
+    def _ignored(self, parts):
+        return (IGNORE_TOP.match(parts[0]) or
+                any(IGNORE.match(part) for part in parts))
+
+    def _stow_contents(self, plan, root, source, target, top=False):
+        for name in self._listdir(root, top):
+            self._stow_node(plan,
+                            os.path.join(root, name),
+                            os.path.join(source, name),
+                            os.path.join(target, name))
+
+    def _stow_node(self, plan, root, source, target):
+        kind, dest = plan.state(target)
+        if kind == 'link':
+            existing = self._resolve(target, dest)
+            existing_root = self._root(plan, existing)
+            if existing == source:
+                return
+            elif not self.owns(existing):
+                plan.conflict('existing target is not owned by stow: {}',
+                              self._rel(target))
+            elif not self.fs.exists(existing_root):
+                # Replace invalid link into stow directory
+                self._link(plan, root, source, target)
+            elif (self.fs.isdir(existing_root) and
+                    self.fs.isdir(root)):
+                # Unfold tree that belongs to another package
+                plan.remove(target)
+                plan.mkdir(target)
+                self._stow_contents(plan, existing_root, existing, target)
+                self._stow_contents(plan, root, source, target)
+            else:
+                plan.conflict(
+                    'existing target is stowed to a different package: '
+                    '{} => {}', self._rel(target), dest)
+        elif kind == 'dir':
+            if self.fs.isdir(root):
+                self._stow_contents(plan, root, source, target)
+            else:
+                plan.conflict(
+                    'cannot stow non-directory {} over existing directory '
+                    'target {}', self._rel(source, self.dir),
+                    self._rel(target))
+        elif kind is not None:
+            plan.conflict('existing target is neither a link nor a '
+                          'directory: {}', self._rel(target))
+        elif (self.no_folding and self.fs.isdir(root) and
+                not self.fs.islink(root)):
+            plan.mkdir(target)
+            self._stow_contents(plan, root, source, target)
+        else:
+            self._link(plan, root, source, target)
+
+    def _link(self, plan, root, source, target):
+        mode = self._mode(source)
+        if mode == 'symlink':
+            plan.link(target, self._dest(source, target))
+        elif self.fs.isdir(root) and not self.fs.islink(root):
+            plan.mkdir(target)
+            self._stow_contents(plan, root, source, target)
+        else:
+            plan.place(target, mode, root)
+
+    def _mode(self, source):
+        """Return link mode of package that *source* belongs to."""
+        if not self.modes:
+            return 'symlink'
+        parts = os.path.relpath(source, self.dir).split(os.path.sep, 2)
+        return self.modes.get(os.path.join(self.dir, *parts[:2]), 'symlink')
+
+    def _unstow_contents(self, plan, root, source, target, top=False):
+        for name in self._listdir(root, top):
+            self._unstow_node(plan,
+                              os.path.join(root, name),
+                              os.path.join(source, name),
+                              os.path.join(target, name))
+
+        # Remove invalid links that point into this package
+        for name in plan.listdir(target):
+            path = os.path.join(target, name)
+            kind, dest = plan.state(path)
+            if kind != 'link':
+                continue
+            existing = self._resolve(path, dest)
+            if (existing.startswith(source + os.path.sep) and
+                    not self.fs.lexists(root + existing[len(source):])):
+                plan.remove(path)
+
+    def _unstow_node(self, plan, root, source, target):
+        kind, dest = plan.state(target)
+        if kind == 'link':
+            if os.path.isabs(dest):
+                return
+            existing = self._resolve(target, dest)
+            if not self.owns(existing):
+                plan.conflict('existing target is not owned by stow: '
+                              '{} => {}', self._rel(target), dest)
+            elif (existing == source or
+                    not self.fs.exists(self._root(plan, existing))):
+                plan.remove(target)
+        elif kind == 'dir':
+            if not self.fs.isdir(root):
+                return
+            self._unstow_contents(plan, root, source, target)
+            if not plan.listdir(target):
+                plan.remove(target)
+            elif not self.no_folding:
+                parent = self._foldable(plan, target)
+                if parent is not None:
+                    self._fold(plan, target, parent)
+        elif kind is not None:
+            plan.conflict('existing target is neither a link nor a '
+                          'directory: {}', self._rel(target))
+
+    def _foldable(self, plan, target):
+        """Return directory that all links in *target* point into."""
+        parent = None
+        for name in plan.listdir(target):
+            path = os.path.join(target, name)
+            kind, dest = plan.state(path)
+            if kind != 'link' or os.path.isabs(dest):
+                return
+            dirname = os.path.dirname(self._resolve(path, dest))
+            if parent is None:
+                parent = dirname
+            elif parent != dirname:
+                return
+        if parent is not None and self.owns(parent):
+            return parent
+
+    def _fold(self, plan, target, parent):
+        for name in plan.listdir(target):
+            plan.remove(os.path.join(target, name))
+        plan.remove(target)
+        plan.link(target, self._dest(parent, target))
+
+    def _listdir(self, root, top=False):
+        try:
+            return self.sources[root, top]
+        except KeyError:
+            pass
+        names = []
+        for name in sorted(self.fs.listdir(root)):
+            if IGNORE.match(name) or top and IGNORE_TOP.match(name):
+                continue
+            names.append(name)
+        self.sources[root, top] = names
+        return names
+
+    def _root(self, plan, path):
+        """Return path where *path* is read from in the plan."""
+        parts = os.path.relpath(path, self.dir).split(os.path.sep, 2)
+        source = os.path.join(self.dir, *parts[:2])
+        root = plan.roots.get(source)
+        if root is None:
+            return path
+        return os.path.join(root, *parts[2:])
+
+    def _resolve(self, path, dest):
+        return os.path.normpath(os.path.join(os.path.dirname(path), dest))
+
+    def _dest(self, source, target):
+        return os.path.relpath(source, os.path.dirname(target))
+
+    def _rel(self, path, start=None):
+        return os.path.relpath(path, start or self.target)
+
+
+class Inotify(object):
+    """Watch folders for changes with Linux inotify(7) API."""
+
+    IN_ATTRIB = 0x4
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_ISDIR = 0x40000000
+    # Events of nodes that appear in folder or disappear from it
+    ENTRIES = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    CHANGES = ENTRIES | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        self.fd = self._check(self.libc.inotify_init1(os.O_CLOEXEC))
+        self.paths = {}
+
+    def add_watch(self, path, mask=CHANGES | IN_ONLYDIR):
+        wd = self._check(self.libc.inotify_add_watch(
+            self.fd, path.encode(sys.getfilesystemencoding()), mask))
+        self.paths[wd] = path
+        return wd
+
+    def read(self):
+        """Return list of ``(path, mask, name)`` of pending events.
+
+        Path is ``None`` if the queue overflowed.
+        """
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, size = struct.unpack_from('iIII', data, offset)
+            offset += struct.calcsize('iIII')
+            name = data[offset:offset + size].rstrip(b'\0')
+            offset += size
+            path = self.paths.get(wd)
+            if mask & self.IN_IGNORED:
+                self.paths.pop(wd, None)
+            events.append((path, mask, name.decode(
+                sys.getfilesystemencoding())))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+    def _check(self, result):
+        if result < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return result
+
+
+def watch_tree(inotify, root):
+    """Watch folder *root* and its subfolders, but not linked ones."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        try:
+            inotify.add_watch(dirpath)
+        except OSError as err:
+            if err.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+
+
+class Server(object):
+    """Run commands sent by clients over Unix socket.
+
+    Every command runs in a forked process that inherits imported modules
+    and listings of target folders, which are kept up to date with
+    inotify(7), and uses standard streams, working directory and
+    environment of the client.  Commands run concurrently, package locks
+    serialize the ones that touch the same packages.
+
+    Client sends a line with JSON object that has ``argv``, ``cwd``, ``env``
+    and ``umask`` keys, along with descriptors of its standard streams.
+    Server replies with a line with JSON object that has ``status`` key.
+    """
+
+    def __init__(self, steeve, path):
+        self.steeve = steeve
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(path):
+            if is_serving(path):
+                raise click.ClickException(
+                    "steeve is already serving '{}'"
+                    .format(steeve.dir))
+            os.remove(path)
+        umask = os.umask(0o177)
+        try:
+            self.sock.bind(path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(64)
+        try:
+            self.inotify = Inotify()
+        except (AttributeError, OSError):
+            self.inotify = None
+        self.dirty = set()
+        self.children = set()
+
+    def serve_forever(self):
+        def terminate(signum, frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, terminate)
+        try:
+            self.load()
+            while True:
+                fds = [self.sock]
+                if self.inotify is not None:
+                    fds.append(self.inotify.fd)
+                ready = select.select(fds, [], [], 1)[0]
+                if self.inotify is not None and self.inotify.fd in ready:
+                    self.invalidate()
+                if self.sock in ready:
+                    conn = self.sock.accept()[0]
+                    try:
+                        self.handle(conn)
+                    finally:
+                        conn.close()
+                self.reap()
+        finally:
+            os.remove(self.path)
+            self.sock.close()
+
+    def load(self):
+        """Read and watch target folders that are known to the index."""
+        with self.steeve.index() as index:
+            paths = index.listing_paths()
+        for path in paths:
+            if path not in WARM and path not in self.dirty:
+                if self.inotify is not None:
+                    try:
+                        self.inotify.add_watch(path)
+                    except OSError:
+                        continue
+                self.dirty.add(path)
+        self.refresh()
+
+    def invalidate(self):
+        for path, mask, name in self.inotify.read():
+            if path is None:
+                self.dirty.update(WARM)
+                WARM.clear()
+            else:
+                WARM.pop(path, None)
+                self.dirty.add(path)
+
+    def refresh(self):
+        """Read folders that changed unless they were modified just now."""
+        for path in list(self.dirty):
+            try:
+                st = os.stat(path)
+                if time.time() - st.st_mtime <= 2:
+                    continue
+                WARM[path] = (st.st_ino, st.st_mtime, listdir_states(path))
+            except OSError as err:
+                if err.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+            self.dirty.discard(path)
+
+    def handle(self, conn):
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                struct.calcsize('3i'))
+        if struct.unpack('3i', creds)[1] != os.getuid():
+            return
+        fds = array.array('i')
+        data, ancdata, flags, address = conn.recvmsg(
+            64 * 1024, socket.CMSG_LEN(3 * fds.itemsize))
+        for level, kind, cdata in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(cdata[:len(cdata) - len(cdata) % fds.itemsize])
+        try:
+            while not data.endswith(b'\n'):
+                chunk = conn.recv(64 * 1024)
+                if not chunk:
+                    return
+                data += chunk
+            request = json.loads(data.decode('utf-8'))
+            if len(fds) != 3:
+                return
+            self.refresh()
+            pid = os.fork()
+            if not pid:
+                self.run(conn, request, fds)
+            self.children.add(pid)
+            if self.steeve.verbose > 0:
+                click.echo('{}: {}'.format(pid, ' '.join(request['argv'])),
+                           err=True)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def run(self, conn, request, fds):
+        """Run command in forked process and never return."""
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self.sock.close()
+            if self.inotify is not None:
+                self.inotify.close()
+            for target, fd in enumerate(fds):
+                os.dup2(fd, target)
+            os.chdir(request['cwd'])
+            os.umask(request['umask'])
+            os.environ.clear()
+            os.environ.update(request['env'])
+            try:
+                cli.main(args=request['argv'], prog_name='steeve')
+            except SystemExit as exit:
+                if exit.code is None or isinstance(exit.code, int):
+                    status = exit.code or 0
+                else:
+                    click.echo(exit.code, err=True)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                conn.sendall(json.dumps({'status': status}).encode() + b'\n')
+            finally:
+                os._exit(0)
+
+    def reap(self):
+        for pid in list(self.children):
+            if os.waitpid(pid, os.WNOHANG)[0]:
+                self.children.discard(pid)
+                self.load()
+
+
+def socket_path(args):
+    """Return path of socket of packages folder given in command line."""
+    dir = os.environ.get('STEEVE_DIR', '/usr/local/stow')
+    for i, arg in enumerate(args):
+        if arg in ('-d', '--dir') and i + 1 < len(args):
+            dir = args[i + 1]
+        elif arg.startswith('--dir='):
+            dir = arg[len('--dir='):]
+        elif not arg.startswith('-'):
+            break
+    return os.path.join(os.path.abspath(dir), '.steeve', 'serve.sock')
+
+
+def forward(path, args):
+    """Run command in ``steeve serve`` listening at *path*.
+
+    Return exit status or ``None`` if the server is not running.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error as err:
+            if err.errno in (errno.ENOENT, errno.ECONNREFUSED, errno.EACCES):
+                return
+            raise
+        umask = os.umask(0)
+        os.umask(umask)
+        request = json.dumps({'argv': args, 'cwd': os.getcwd(),
+                              'env': dict(os.environ), 'umask': umask})
+        sock.sendmsg([request.encode('utf-8') + b'\n'],
+                      [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                        array.array('i', [0, 1, 2]))])
+        response = b''
+        while not response.endswith(b'\n'):
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise click.ClickException('steeve serve closed connection')
+            response += chunk
+        return json.loads(response.decode('utf-8'))['status']
+    finally:
+        sock.close()
+
+
+def is_serving(path):
+    """Check if ``steeve serve`` listens at *path*."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as err:
+        if err.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            return False
+        raise
+    finally:
+        sock.close()
+    return True
+
+
+def main():
+    """Run command in ``steeve serve`` if it's running, or in process."""
+    args = sys.argv[1:]
+    # Package named 'serve' only makes the command run in process
+    if ('serve' not in args and hasattr(socket, 'CMSG_LEN') and
+            not os.environ.get('STEEVE_NO_SERVE')):
+        status = forward(socket_path(args), args)
+        if status is not None:
+            sys.exit(status)
+    cli()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,18 @@
+import hashlib
 import os
+import tarfile
+import threading
 
 import pytest
 from click.testing import CliRunner
 
 import steeve
 
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
 
 @pytest.yield_fixture
 def runner():
@@ -43,6 +51,15 @@ def foo_release():
     return 'foo'
 
 
+@pytest.fixture
+def foo_archive(foo_release):
+    """Return path of gzipped tarball of a release."""
+    path = os.path.join('releases', 'foo-1.0.tar.gz')
+    with tarfile.open(path, 'w:gz') as tar:
+        tar.add(os.path.join('releases', 'foo-1.0'), 'foo-1.0')
+    return path
+
+
 @pytest.fixture
 def foo_updated_release(foo_release):
     """Return a package with updated single version."""
@@ -66,3 +83,61 @@ def bar_package():
 def stowed_bar_package(runner, bar_package):
     result = runner.invoke(steeve.cli, ['--no-folding', 'stow', 'bar', '1.0'])
     assert result.exit_code == 0
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    """Serve files from ``server.files`` with ETag and Range support.
+
+    Requests are recorded in ``server.requests``.  If ``server.truncate`` is
+    set, the next response is cut after that many bytes.
+    """
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers.items())))
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start, end = 0, len(data) - 1
+        ranges = self.headers.get('Range')
+        if ranges and self.headers.get('If-Range', etag) == etag:
+            first, last = ranges.split('=')[1].split('-')
+            start, end = int(first), int(last or end)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, end, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        data = data[start:end + 1]
+        if self.server.truncate is not None:
+            data = data[:self.server.truncate]
+            self.server.truncate = None
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.yield_fixture
+def http_server():
+    """Run HTTP server in a thread."""
+    server = HTTPServer(('127.0.0.1', 0), FileHandler)
+    server.files = {}
+    server.requests = []
+    server.truncate = None
+    server.url = 'http://127.0.0.1:{}'.format(server.server_port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,71 @@
+import json
+import os
+
+import steeve
+
+
+def write_manifest(packages, path='manifest.json'):
+    with open(path, 'w') as fp:
+        json.dump({'packages': packages}, fp)
+    return path
+
+
+def test_apply(runner, foo_package, stowed_bar_package):
+    """Must stow listed versions and leave up-to-date ones alone."""
+    manifest = write_manifest({'foo': '1.0', 'bar': '2.0'})
+    inode = os.lstat(os.path.join('bin', 'bar')).st_ino
+
+    result = runner.invoke(steeve.cli, ['--no-folding', 'apply', manifest])
+    assert result.exit_code == 0
+    assert os.path.exists(os.path.join('bin', 'foo'))
+    assert os.lstat(os.path.join('bin', 'bar')).st_ino == inode
+    assert (os.readlink(os.path.join('stow', 'bar', 'current')) ==
+            os.path.abspath(os.path.join('stow', 'bar', '2.0')))
+
+    result = runner.invoke(steeve.cli, ['--no-folding', '-v',
+                                        'apply', manifest])
+    assert result.exit_code == 0
+    assert result.output == ''
+
+
+def test_apply_unstow(runner, stowed_foo_package, stowed_bar_package):
+    """Must unstow packages with null version."""
+    manifest = write_manifest({'foo': None})
+    result = runner.invoke(steeve.cli, ['apply', manifest])
+    assert result.exit_code == 0
+    assert not os.path.exists(os.path.join('bin', 'foo'))
+    assert not os.path.exists(os.path.join('stow', 'foo', 'current'))
+    assert os.path.exists(os.path.join('bin', 'bar'))
+
+
+def test_apply_toml(runner, foo_package, bar_package):
+    """Must read TOML manifests."""
+    with open('manifest.toml', 'w') as fp:
+        fp.write('[packages]\nfoo = "1.0"\nbar = false\n')
+    result = runner.invoke(steeve.cli, ['apply', 'manifest.toml'])
+    assert result.exit_code == 0
+    assert os.path.exists(os.path.join('bin', 'foo'))
+
+
+def test_apply_not_installed(runner, foo_package):
+    """Must not change anything if some version is not installed."""
+    manifest = write_manifest({'foo': '1.0', 'bar': '1.0'})
+    result = runner.invoke(steeve.cli, ['apply', manifest])
+    assert result.exit_code == 1
+    assert "'bar/1.0' is not installed" in result.output
+    assert not os.path.exists(os.path.join('bin', 'foo'))
+
+
+def test_apply_conflict(runner, foo_package, bar_package):
+    """Must check conflicts of all packages before changing anything."""
+    os.makedirs(os.path.join('stow', 'foo', '1.0', 'share'))
+    os.mkdir('share')
+    with open(os.path.join('stow', 'bar', '1.0', 'bin', 'foo'), 'w'):
+        pass
+
+    manifest = write_manifest({'foo': '1.0', 'bar': '1.0'})
+    result = runner.invoke(steeve.cli, ['apply', manifest])
+    assert result.exit_code == 1
+    assert 'stowed to a different package' in result.output
+    assert not os.path.exists('bin')
+    assert not os.path.exists(os.path.join('stow', 'foo', 'current'))
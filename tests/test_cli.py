@@ -7,6 +7,7 @@ def test_no_stow(runner, foo_release, foo_package):
     """Must not do anything unless GNU stow is installed."""
     # Clean PATH so 'stow' won't be found
     runner.env['PATH'] = ''
+    runner.env['STEEVE_GNU_STOW'] = '1'
     require_stow = [
         ['install', 'foo', '1.0', 'releases/foo-1.0'],
         ['uninstall', 'foo', '1.0'],
@@ -23,6 +24,14 @@ def test_no_stow(runner, foo_release, foo_package):
     assert 'GNU Stow is not installed' not in result.output
 
 
+def test_builtin_stow(runner, foo_package):
+    """Must not require GNU stow unless asked to."""
+    runner.env['PATH'] = ''
+    result = runner.invoke(steeve.cli, ['stow', 'foo', '1.0'])
+    assert result.exit_code == 0
+    assert os.path.exists(os.path.join('bin', 'foo'))
+
+
 def test_valid_version(runner):
     """Must fail when given version is 'current'."""
     result = runner.invoke(steeve.cli, ['stow', 'foo', 'current'])
@@ -44,3 +53,10 @@ def test_target_not_set(runner, foo_package):
     result = runner.invoke(steeve.cli, ['stow', 'foo', '1.0'])
     assert result.exit_code == 0
     assert os.path.exists('../bin/foo')
+
+
+def test_hidden_name(runner):
+    """Must fail when package name starts with a dot."""
+    result = runner.invoke(steeve.cli, ['stow', '.steeve', '1.0'])
+    assert result.exit_code == 2
+    assert "must not start with '.'" in result.output
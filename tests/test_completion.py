@@ -0,0 +1,36 @@
+import os
+
+import steeve
+
+
+def read_cache():
+    with open(os.path.join('stow', '.steeve', 'completion')) as fp:
+        return fp.read().splitlines()
+
+
+def test_completion_cache(runner, foo_release):
+    """Must list packages and versions after changing state."""
+    result = runner.invoke(steeve.cli,
+                           ['install', 'foo', '1.0', 'releases/foo-1.0'])
+    assert result.exit_code == 0
+    assert read_cache() == ['foo 1.0']
+
+    result = runner.invoke(steeve.cli,
+                           ['install', 'foo', '2.0', 'releases/foo-1.0'])
+    assert result.exit_code == 0
+    assert read_cache() == ['foo 1.0 2.0']
+
+    result = runner.invoke(steeve.cli, ['uninstall', '-y', 'foo', '1.0'])
+    assert result.exit_code == 0
+    assert read_cache() == ['foo 2.0']
+
+    result = runner.invoke(steeve.cli, ['uninstall', '-y', 'foo'])
+    assert result.exit_code == 0
+    assert read_cache() == []
+
+
+def test_completion_cache_stow(runner, foo_package):
+    """Must list versions that were not installed by steeve once stowed."""
+    result = runner.invoke(steeve.cli, ['stow', 'foo', '1.0'])
+    assert result.exit_code == 0
+    assert read_cache() == ['foo 1.0']
@@ -0,0 +1,73 @@
+import os
+
+import steeve
+
+
+def write_bar(version, data=b'bar' * 1000):
+    with open(os.path.join('stow', 'bar', version, 'bin', 'bar'), 'wb') as fp:
+        fp.write(data)
+
+
+def count_objects():
+    objects = os.path.join('stow', '.steeve', 'objects')
+    return sum(len(files) for _, _, files in os.walk(objects))
+
+
+def test_dedup(runner, bar_package):
+    """Must hard link identical files of different versions."""
+    write_bar('1.0')
+    write_bar('2.0')
+
+    result = runner.invoke(steeve.cli, ['dedup'])
+    assert result.exit_code == 0
+    assert 'Saved 2.9K (3000 bytes)' in result.output
+    assert os.path.samefile(os.path.join('stow', 'bar', '1.0', 'bin', 'bar'),
+                            os.path.join('stow', 'bar', '2.0', 'bin', 'bar'))
+
+    result = runner.invoke(steeve.cli, ['dedup', 'bar'])
+    assert result.exit_code == 0
+    assert '(0 bytes)' in result.output
+
+
+def test_dedup_different(runner, bar_package):
+    """Must not link files with different contents or modes."""
+    write_bar('1.0')
+    write_bar('2.0', b'baz')
+    os.chmod(os.path.join('stow', 'bar', '1.0', 'bin', 'bar'), 0o755)
+
+    result = runner.invoke(steeve.cli, ['dedup', 'bar'])
+    assert result.exit_code == 0
+    assert '(0 bytes)' in result.output
+
+
+def test_install_dedup(runner, bar_package, foo_release):
+    """Must link installed files against other versions."""
+    result = runner.invoke(steeve.cli, ['dedup'])
+    assert result.exit_code == 0
+
+    result = runner.invoke(steeve.cli, ['install', '--dedup',
+                                        'foo', '1.0', 'releases/foo-1.0'])
+    assert result.exit_code == 0
+    assert os.path.samefile(os.path.join('stow', 'foo', '1.0', 'bin', 'foo'),
+                            os.path.join('stow', 'bar', '2.0', 'bin', 'bar'))
+
+
+def test_uninstall_frees_objects(runner, bar_package):
+    """Must remove shared files when no version uses them."""
+    write_bar('1.0')
+    write_bar('2.0', b'baz')
+    result = runner.invoke(steeve.cli, ['dedup'])
+    assert result.exit_code == 0
+    assert count_objects() == 2
+
+    result = runner.invoke(steeve.cli, ['uninstall', '-y', 'bar', '1.0'])
+    assert result.exit_code == 0
+    result = runner.invoke(steeve.cli, ['gc'])
+    assert result.exit_code == 0
+    assert count_objects() == 1
+
+    result = runner.invoke(steeve.cli, ['uninstall', '-y', 'bar'])
+    assert result.exit_code == 0
+    result = runner.invoke(steeve.cli, ['gc'])
+    assert result.exit_code == 0
+    assert count_objects() == 0
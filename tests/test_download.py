@@ -0,0 +1,127 @@
+import hashlib
+import io
+import os
+import tarfile
+
+import steeve
+
+
+def make_archive(size=0):
+    """Return gzipped tarball of a release with file of given size."""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        info = tarfile.TarInfo('foo-1.0/bin/foo')
+        data = os.urandom(size)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def test_install_url(runner, http_server):
+    """Must download archive once and revalidate it afterwards."""
+    archive = make_archive()
+    http_server.files['/foo.tar.gz'] = archive
+    url = http_server.url + '/foo.tar.gz'
+    result = runner.invoke(steeve.cli, ['install', '--strip-components=1',
+                                        'foo', '1.0', url])
+    assert result.exit_code == 0
+    assert os.path.islink('bin')
+    digest = hashlib.sha256(archive).hexdigest()
+    assert os.listdir(os.path.join('stow', '.steeve', 'downloads')) == [
+        digest]
+
+    result = runner.invoke(steeve.cli, ['install', '--strip-components=1',
+                                        'foo', '2.0', url])
+    assert result.exit_code == 0
+    assert os.path.exists(os.path.join('stow', 'foo', '2.0', 'bin', 'foo'))
+    headers = http_server.requests[-1][1]
+    assert headers['If-None-Match'] == '"{}"'.format(
+        hashlib.sha1(archive).hexdigest())
+
+
+def test_install_url_sha256(runner, http_server):
+    """Must not request archive with known checksum, fail on mismatch."""
+    archive = make_archive()
+    http_server.files['/foo.tar.gz'] = archive
+    url = http_server.url + '/foo.tar.gz'
+    digest = hashlib.sha256(archive).hexdigest()
+    result = runner.invoke(steeve.cli, ['install', '--sha256', digest,
+                                        'foo', '1.0', url])
+    assert result.exit_code == 0
+    result = runner.invoke(steeve.cli, ['install', '--sha256', digest,
+                                        'foo', '2.0', url])
+    assert result.exit_code == 0
+    assert len(http_server.requests) == 1
+
+    http_server.files['/bar.tar.gz'] = make_archive()
+    result = runner.invoke(steeve.cli, ['install', '--sha256', '0' * 64,
+                                        'bar', '1.0',
+                                        http_server.url + '/bar.tar.gz'])
+    assert result.exit_code == 1
+    assert "checksum of '{}/bar.tar.gz' doesn't match".format(
+        http_server.url) in result.output
+    assert not os.path.exists(os.path.join('stow', 'bar'))
+
+
+def test_install_url_resume(runner, http_server):
+    """Must resume interrupted download."""
+    archive = make_archive(4096)
+    http_server.files['/foo.tar.gz'] = archive
+    http_server.truncate = 1000
+    url = http_server.url + '/foo.tar.gz'
+    result = runner.invoke(steeve.cli, ['install', 'foo', '1.0', url])
+    assert result.exit_code == 1
+    assert not os.path.exists(os.path.join('stow', 'foo'))
+
+    result = runner.invoke(steeve.cli, ['install', 'foo', '1.0', url])
+    assert result.exit_code == 0
+    assert http_server.requests[-1][1]['Range'] == 'bytes=1000-{}'.format(
+        len(archive) - 1)
+    digest = hashlib.sha256(archive).hexdigest()
+    assert os.path.exists(os.path.join('stow', '.steeve', 'downloads',
+                                       digest))
+
+
+def test_install_url_chunks(runner, http_server, monkeypatch):
+    """Must download large archive in parallel chunks."""
+    monkeypatch.setattr(steeve, 'DOWNLOAD_CHUNK', 1024)
+    archive = make_archive(8192)
+    http_server.files['/foo.tar.gz'] = archive
+    url = http_server.url + '/foo.tar.gz'
+    result = runner.invoke(steeve.cli, ['-j', '4', 'install', 'foo', '1.0',
+                                        url])
+    assert result.exit_code == 0
+    ranges = sorted(headers['Range'] for path, headers
+                    in http_server.requests if 'Range' in headers)
+    assert len(ranges) == (len(archive) + 1023) // 1024
+    digest = hashlib.sha256(archive).hexdigest()
+    assert os.listdir(os.path.join('stow', '.steeve', 'downloads')) == [
+        digest]
+
+
+def test_install_url_chunks_changed(runner, http_server, monkeypatch):
+    """Must fail and remove partial files when archive changes while its
+    chunks are downloaded."""
+    monkeypatch.setattr(steeve, 'DOWNLOAD_CHUNK', 1024)
+    http_server.files['/foo.tar.gz'] = make_archive(8192)
+    url = http_server.url + '/foo.tar.gz'
+    fetch_range = steeve.fetch_range
+
+    def change_and_fetch(*args):
+        http_server.files['/foo.tar.gz'] = make_archive(8192)
+        fetch_range(*args)
+
+    monkeypatch.setattr(steeve, 'fetch_range', change_and_fetch)
+    result = runner.invoke(steeve.cli, ['-j', '4', 'install', 'foo', '1.0',
+                                        url])
+    assert result.exit_code == 1
+    assert "'{}' changed while downloading it".format(url) in result.output
+    assert os.listdir(os.path.join('stow', '.steeve', 'downloads')) == []
+
+
+def test_install_url_not_found(runner, http_server):
+    """Must fail when archive can't be downloaded."""
+    result = runner.invoke(steeve.cli, ['install', 'foo', '1.0',
+                                        http_server.url + '/foo.tar.gz'])
+    assert result.exit_code == 1
+    assert 'cannot download' in result.output
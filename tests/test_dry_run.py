@@ -0,0 +1,119 @@
+import io
+import os
+import tarfile
+
+import steeve
+
+
+def test_dry_run_stow(runner, foo_package):
+    """Must print changes without making them."""
+    result = runner.invoke(steeve.cli, ['--dry-run', '--no-folding', 'stow',
+                                        'foo', '1.0'])
+    assert result.exit_code == 0
+    assert result.output == (
+        'MKDIR: bin\n'
+        'LINK: bin/foo => ../stow/foo/current/bin/foo\n'
+        'LINK: stow/foo/current => {}\n'
+        .format(os.path.abspath(os.path.join('stow', 'foo', '1.0'))))
+    assert not os.path.lexists('bin')
+    assert not os.path.lexists(os.path.join('stow', 'foo', 'current'))
+
+
+def test_dry_run_unstow(runner, stowed_foo_package):
+    result = runner.invoke(steeve.cli, ['-n', 'unstow', 'foo'])
+    assert result.exit_code == 0
+    assert result.output == ('RMDIR: bin\n'
+                             'UNLINK: stow/foo/current\n')
+    assert os.path.islink(os.path.join('bin', 'foo'))
+
+
+def test_dry_run_install(runner, foo_release):
+    result = runner.invoke(steeve.cli, ['-n', 'install', 'foo', '1.0',
+                                        'releases/foo-1.0'])
+    assert result.exit_code == 0
+    assert result.output.splitlines()[:3] == [
+        'LINK: bin => stow/foo/current/bin',
+        'MKDIR: stow/foo',
+        'MKDIR: stow/foo/1.0',
+    ]
+    assert os.listdir('stow') == []
+    result = runner.invoke(steeve.cli, ['files', 'foo', '1.0'])
+    assert result.exit_code == 1
+
+
+def test_dry_run_uninstall(runner, stowed_foo_package):
+    result = runner.invoke(steeve.cli, ['-n', 'uninstall', '-y', 'foo'])
+    assert result.exit_code == 0
+    assert result.output == ('RMDIR: bin\n'
+                             'RMDIR: stow/foo\n')
+    assert os.path.isdir(os.path.join('stow', 'foo', '1.0'))
+    assert not os.path.exists(os.path.join('stow', '.steeve', 'trash'))
+
+
+def test_dry_run_archive(runner, foo_archive):
+    result = runner.invoke(steeve.cli, ['-n', 'install', 'foo', '1.0',
+                                        foo_archive])
+    assert result.exit_code == 1
+    assert "doesn't support --dry-run" in result.output
+    assert not os.path.exists(os.path.join('stow', 'foo'))
+
+
+def test_memory_fs():
+    """Must stow packages that exist only in memory."""
+    fs = steeve.MemoryFS()
+    for number in range(100):
+        for version in ('1.0', '2.0'):
+            path = '/stow/pkg{}/{}/bin'.format(number, version)
+            fs.makedirs(path)
+            fs.write('{}/pkg{}-{}'.format(path, number, version), b'data')
+    fs.mkdir('/bin')
+    instance = steeve.Steeve('/stow', ('/',), True, 0, False, 1, fs)
+    for number in range(100):
+        instance.stow('pkg{}'.format(number), '1.0')
+    instance.apply(dict(('pkg{}'.format(number), '2.0')
+                        for number in range(100)))
+    assert len(fs.listdir('/bin')) == 100
+    assert (fs.readlink('/bin/pkg5-2.0') ==
+            '../stow/pkg5/current/bin/pkg5-2.0')
+    assert not fs.lexists('/bin/pkg5-1.0')
+    with instance.index() as index:
+        assert index.owner('/bin/pkg5-2.0') == ('pkg5', '2.0')
+
+
+def test_memory_fs_overlay(tmpdir):
+    """Must read base filesystem and leave it alone."""
+    tmpdir.join('dir', 'file').write('data', ensure=True)
+    fs = steeve.MemoryFS(steeve.POSIX)
+    root = str(tmpdir)
+    fs.copytree(os.path.join(root, 'dir'), os.path.join(root, 'copy'))
+    fs.symlink('copy', os.path.join(root, 'link'))
+    fs.remove(os.path.join(root, 'dir', 'file'))
+    assert fs.listdir(os.path.join(root, 'link')) == ['file']
+    assert fs.digest(os.path.join(root, 'link', 'file')) == \
+        steeve.file_digest(os.path.join(root, 'dir', 'file'))
+    assert sorted(tmpdir.listdir()) == [tmpdir.join('dir')]
+    assert tmpdir.join('dir', 'file').check()
+    assert list(fs.changes()) == [
+        (os.path.join(root, 'copy'), steeve.ABSENT, steeve.DIR),
+        (os.path.join(root, 'dir', 'file'), steeve.FILE, steeve.ABSENT),
+        (os.path.join(root, 'link'), steeve.ABSENT, ('link', 'copy')),
+    ]
+
+
+def test_memory_fs_pack(capsys):
+    """Must list and pack versions that exist only in memory."""
+    fs = steeve.MemoryFS()
+    fs.makedirs('/stow/foo/1.0/bin')
+    fs.write('/stow/foo/1.0/bin/foo', b'data')
+    fs.symlink('foo', '/stow/foo/1.0/bin/f')
+    instance = steeve.Steeve('/stow', ('/',), True, 0, False, 1, fs)
+    instance.files('foo', '1.0')
+    assert capsys.readouterr()[0].splitlines() == ['bin/f', 'bin/foo']
+
+    output = io.BytesIO()
+    instance.pack('foo', '1.0', output)
+    output.seek(0)
+    with tarfile.open(fileobj=output) as tar:
+        assert tar.getnames() == [steeve.MANIFEST_NAME, 'bin', 'bin/f',
+                                  'bin/foo']
+        assert tar.extractfile('bin/foo').read() == b'data'
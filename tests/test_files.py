@@ -0,0 +1,34 @@
+import os
+
+import steeve
+
+
+def test_files(runner, foo_updated_release):
+    """Must list files of installed version."""
+    result = runner.invoke(steeve.cli,
+                           ['install', 'foo', '1.0', 'releases/foo-1.0'])
+    assert result.exit_code == 0
+    os.remove(os.path.join('stow', 'foo', '1.0', 'bin', 'foo-1.0'))
+
+    result = runner.invoke(steeve.cli, ['files', 'foo'])
+    assert result.exit_code == 0
+    assert result.output.splitlines() == [os.path.join('bin', 'foo'),
+                                          os.path.join('bin', 'foo-1.0')]
+
+
+def test_files_not_recorded(runner, bar_package):
+    """Must list files of versions that were not installed by steeve."""
+    result = runner.invoke(steeve.cli, ['files', 'bar', '2.0'])
+    assert result.exit_code == 0
+    assert result.output.splitlines() == [os.path.join('bin', 'bar')]
+
+
+def test_files_uninstalled(runner, foo_package):
+    """Must fail when version is not installed or package is not stowed."""
+    result = runner.invoke(steeve.cli, ['files', 'foo', '2.0'])
+    assert result.exit_code == 1
+    assert 'not installed' in result.output
+
+    result = runner.invoke(steeve.cli, ['files', 'foo'])
+    assert result.exit_code == 1
+    assert 'not stowed' in result.output
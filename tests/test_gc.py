@@ -0,0 +1,74 @@
+import os
+
+import steeve
+
+
+def stow_versions(runner, *versions):
+    for version in versions:
+        path = os.path.join('stow', 'bar', version, 'bin')
+        if not os.path.exists(path):
+            os.makedirs(path)
+        result = runner.invoke(steeve.cli, ['stow', 'bar', version])
+        assert result.exit_code == 0
+
+
+def installed_versions():
+    return sorted(name for name in os.listdir(os.path.join('stow', 'bar'))
+                  if name != 'current')
+
+
+def test_gc_trash(runner, bar_package):
+    """Must delete uninstalled versions."""
+    result = runner.invoke(steeve.cli, ['uninstall', '-y', 'bar', '1.0'])
+    assert result.exit_code == 0
+    assert not os.path.exists(os.path.join('stow', 'bar', '1.0'))
+
+    result = runner.invoke(steeve.cli, ['gc'])
+    assert result.exit_code == 0
+    assert os.listdir(os.path.join('stow', '.steeve', 'trash')) == []
+    assert installed_versions() == ['2.0']
+
+
+def test_gc_keep(runner, bar_package):
+    """Must keep given number of recently stowed versions and current."""
+    stow_versions(runner, '1.0', '3.0', '2.0')
+
+    result = runner.invoke(steeve.cli, ['gc', '--keep', '2'], input='y\n')
+    assert result.exit_code == 0
+    assert 'bar/1.0' in result.output
+    assert installed_versions() == ['2.0', '3.0']
+
+    result = runner.invoke(steeve.cli, ['gc', '-y', '--keep', '1', 'bar'])
+    assert result.exit_code == 0
+    assert installed_versions() == ['2.0']
+    assert os.path.exists(os.path.join('bin', 'bar'))
+
+
+def test_gc_max_size(runner, bar_package):
+    """Must remove least recently stowed versions until they fit."""
+    stow_versions(runner, '3.0', '1.0', '2.0')
+    for version in ('1.0', '2.0', '3.0'):
+        path = os.path.join('stow', 'bar', version, 'bin', 'bar')
+        with open(path, 'wb') as fp:
+            fp.write(b'\1' * 1024 * 1024)
+
+    result = runner.invoke(steeve.cli, ['gc', '-y', '--max-size', '2.5M'])
+    assert result.exit_code == 0
+    assert installed_versions() == ['1.0', '2.0']
+
+    result = runner.invoke(steeve.cli, ['gc', '-y', '--max-size', '0'])
+    assert result.exit_code == 0
+    assert installed_versions() == ['2.0']
+
+
+def test_gc_abort(runner, bar_package):
+    """Must not remove anything unless user inputs 'y'."""
+    result = runner.invoke(steeve.cli, ['gc', '--keep', '1'], input='n\n')
+    assert result.exit_code == 1
+    assert installed_versions() == ['1.0', '2.0']
+
+
+def test_gc_invalid_size(runner):
+    result = runner.invoke(steeve.cli, ['gc', '--max-size', 'lots'])
+    assert result.exit_code == 2
+    assert 'must be a size' in result.output
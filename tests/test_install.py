@@ -1,4 +1,7 @@
+import bz2
+import io
 import os
+import tarfile
 
 import steeve
 
@@ -21,6 +24,64 @@ def test_install_over_existing(runner, foo_package, foo_updated_release):
     assert os.path.exists(os.path.join('bin', 'foo-1.0'))
 
 
+def test_reinstall_unchanged(runner, foo_release):
+    """Must keep unchanged files and change only links that differ."""
+    result = runner.invoke(steeve.cli,
+                           ['--no-folding', 'install', 'foo', '1.0',
+                            'releases/foo-1.0'])
+    assert result.exit_code == 0
+    installed = os.path.join('stow', 'foo', '1.0', 'bin')
+    st = os.stat(os.path.join(installed, 'foo'))
+    os.remove(os.path.join('releases', 'foo-1.0', 'bin', 'foo'))
+    with open(os.path.join('releases', 'foo-1.0', 'bin', 'bar'), 'w'):
+        pass
+    with open(os.path.join('releases', 'foo-1.0', 'bin', 'foo'), 'w'):
+        pass
+    os.utime(os.path.join('releases', 'foo-1.0', 'bin', 'foo'),
+             (st.st_atime, st.st_mtime))
+    link = os.lstat(os.path.join('bin', 'foo'))
+
+    result = runner.invoke(steeve.cli,
+                           ['--no-folding', '-v', 'install', '-y', 'foo',
+                            '1.0', 'releases/foo-1.0'])
+    assert result.exit_code == 0
+    assert os.stat(os.path.join(installed, 'foo')).st_ino == st.st_ino
+    assert os.path.exists(os.path.join(installed, 'bar'))
+    assert os.lstat(os.path.join('bin', 'foo')) == link
+    assert result.output.splitlines()[1:] == [
+        'LINK: bin/bar => ../stow/foo/current/bin/bar',
+    ]
+
+
+def test_reinstall_checksum(runner, foo_release):
+    """Must compare contents of files with --checksum."""
+    path = os.path.join('releases', 'foo-1.0', 'bin', 'foo')
+    with open(path, 'w') as fp:
+        fp.write('a')
+    result = runner.invoke(steeve.cli,
+                           ['install', 'foo', '1.0', 'releases/foo-1.0'])
+    assert result.exit_code == 0
+    st = os.stat(path)
+    with open(path, 'w') as fp:
+        fp.write('b')
+    os.utime(path, (st.st_atime, st.st_mtime))
+
+    installed = os.path.join('stow', 'foo', '1.0', 'bin', 'foo')
+    result = runner.invoke(steeve.cli,
+                           ['install', '-y', 'foo', '1.0',
+                            'releases/foo-1.0'])
+    assert result.exit_code == 0
+    with open(installed) as fp:
+        assert fp.read() == 'a'
+
+    result = runner.invoke(steeve.cli,
+                           ['install', '-y', '--checksum', 'foo', '1.0',
+                            'releases/foo-1.0'])
+    assert result.exit_code == 0
+    with open(installed) as fp:
+        assert fp.read() == 'b'
+
+
 def test_install_package(runner, foo_release):
     """Must copy release to package directory and stow it."""
     assert not os.path.exists(os.path.join('stow', 'foo', '1.0', 'bin', 'foo'))
@@ -31,3 +92,186 @@ def test_install_package(runner, foo_release):
     assert result.exit_code == 0
     assert os.path.exists(os.path.join('stow', 'foo', '1.0', 'bin', 'foo'))
     assert os.path.exists(os.path.join('bin', 'foo'))
+
+
+def test_copy_modes(runner, foo_release):
+    """Must hard link files when asked to."""
+    result = runner.invoke(steeve.cli,
+                           ['-v', 'install', '--copy-mode', 'hardlink',
+                            'foo', '1.0', 'releases/foo-1.0'])
+    assert result.exit_code == 0
+    assert 'copy mode: hardlink' in result.output
+    assert (os.stat(os.path.join('stow', 'foo', '1.0', 'bin', 'foo')) ==
+            os.stat(os.path.join('releases', 'foo-1.0', 'bin', 'foo')))
+
+
+def test_copy_mode_move(runner, foo_release):
+    """Must move release folder to package directory."""
+    result = runner.invoke(steeve.cli,
+                           ['install', '--copy-mode', 'move',
+                            'foo', '1.0', 'releases/foo-1.0'])
+    assert result.exit_code == 0
+    assert os.path.exists(os.path.join('stow', 'foo', '1.0', 'bin', 'foo'))
+    assert not os.path.exists(os.path.join('releases', 'foo-1.0'))
+
+
+def test_copy_mode_move_failed(runner, foo_release):
+    """Must move release folder back when install fails."""
+    result = runner.invoke(steeve.cli,
+                           ['install', 'foo', '1.0', 'releases/foo-1.0'])
+    assert result.exit_code == 0
+    os.mkdir(os.path.join('releases', 'foo-1.0', 'share'))
+    with open(os.path.join('releases', 'foo-1.0', 'share', 'foo'), 'w'):
+        pass
+    with open('share', 'w'):
+        pass
+
+    result = runner.invoke(steeve.cli,
+                           ['install', '-y', '--copy-mode', 'move',
+                            'foo', '1.0', 'releases/foo-1.0'])
+    assert result.exit_code == 1
+    assert os.path.exists(os.path.join('releases', 'foo-1.0', 'share',
+                                       'foo'))
+    assert not os.path.exists(os.path.join('stow', 'foo', '1.0', 'share'))
+
+
+def test_copy_contents(runner, foo_release):
+    """Must copy contents, modes and symlinks of release."""
+    path = os.path.join('releases', 'foo-1.0', 'bin', 'foo')
+    with open(path, 'w') as fp:
+        fp.write('#!/bin/sh\n' * 1000)
+    os.chmod(path, 0o755)
+    os.symlink('foo', os.path.join('releases', 'foo-1.0', 'bin', 'f'))
+
+    for copy_mode in ('copy', 'reflink'):
+        result = runner.invoke(steeve.cli,
+                               ['install', '-y', '--copy-mode', copy_mode,
+                                'foo', '1.0', 'releases/foo-1.0'])
+        assert result.exit_code == 0
+        installed = os.path.join('stow', 'foo', '1.0', 'bin')
+        with open(os.path.join(installed, 'foo')) as fp:
+            assert fp.read() == '#!/bin/sh\n' * 1000
+        mode = os.stat(os.path.join(installed, 'foo')).st_mode
+        assert mode & 0o777 == 0o755
+        assert os.readlink(os.path.join(installed, 'f')) == 'foo'
+
+
+def test_install_archive(runner, foo_archive):
+    """Must extract archive to package directory and stow it."""
+    result = runner.invoke(steeve.cli,
+                           ['install', '--strip-components', '1',
+                            'foo', '1.0', foo_archive])
+    assert result.exit_code == 0
+    assert os.path.exists(os.path.join('stow', 'foo', '1.0', 'bin', 'foo'))
+    assert os.path.exists(os.path.join('bin', 'foo'))
+
+
+def test_install_stdin(runner, foo_release):
+    """Must read archive from standard input."""
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w:xz') as tar:
+        tar.add(os.path.join('releases', 'foo-1.0'), '.')
+
+    result = runner.invoke(steeve.cli, ['install', 'foo', '1.0', '-'],
+                           input=data.getvalue())
+    assert result.exit_code == 0
+    assert os.path.exists(os.path.join('stow', 'foo', '1.0', 'bin', 'foo'))
+
+
+def test_install_concatenated(runner, foo_release):
+    """Must read archives that consist of several compressed streams."""
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w') as tar:
+        tar.add(os.path.join('releases', 'foo-1.0'), '.')
+    data = data.getvalue()
+    half = len(data) // 2
+    for name, compress in (('foo.tar.gz', steeve.gzip_block),
+                           ('foo.tar.bz2', bz2.compress)):
+        with open(name, 'wb') as fp:
+            fp.write(compress(data[:half]) + compress(data[half:]))
+
+        result = runner.invoke(steeve.cli, ['install', '-y', 'foo', '1.0',
+                                            name])
+        assert result.exit_code == 0
+        assert os.path.exists(os.path.join('stow', 'foo', '1.0', 'bin',
+                                           'foo'))
+
+
+def test_install_path_traversal(runner):
+    """Must not extract files outside of package directory."""
+    with tarfile.open('parent.tar', 'w') as tar:
+        tar.addfile(tarfile.TarInfo('bin/../../evil'), io.BytesIO())
+    with tarfile.open('symlink.tar', 'w') as tar:
+        info = tarfile.TarInfo('lib')
+        info.type = tarfile.SYMTYPE
+        info.linkname = os.getcwd()
+        tar.addfile(info)
+        tar.addfile(tarfile.TarInfo('lib/evil'), io.BytesIO())
+    os.mkdir('outside')
+    mode = os.stat('outside').st_mode
+    with tarfile.open('folder.tar', 'w') as tar:
+        info = tarfile.TarInfo('lib')
+        info.type = tarfile.SYMTYPE
+        info.linkname = os.path.abspath('outside')
+        tar.addfile(info)
+        info = tarfile.TarInfo('lib')
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o777
+        info.mtime = 12345
+        tar.addfile(info)
+
+    for archive in ('parent.tar', 'symlink.tar', 'folder.tar'):
+        result = runner.invoke(steeve.cli, ['install', 'foo', '1.0', archive])
+        assert result.exit_code == 1
+        assert 'outside of the package' in result.output
+        assert not os.path.exists('evil')
+        assert not os.path.exists(os.path.join('stow', 'evil'))
+        assert not os.path.exists(os.path.join('stow', 'foo'))
+    assert os.stat('outside').st_mode == mode
+    assert os.stat('outside').st_mtime != 12345
+
+
+def test_install_conflicting_archive(runner):
+    """Must fail when archive members can't be extracted."""
+    with tarfile.open('folder.tar', 'w') as tar:
+        info = tarfile.TarInfo('bin')
+        info.type = tarfile.DIRTYPE
+        tar.addfile(info)
+        tar.addfile(tarfile.TarInfo('bin'), io.BytesIO())
+    with tarfile.open('parent.tar', 'w') as tar:
+        tar.addfile(tarfile.TarInfo('bin'), io.BytesIO())
+        tar.addfile(tarfile.TarInfo('bin/foo'), io.BytesIO())
+    with tarfile.open('missing.tar', 'w') as tar:
+        info = tarfile.TarInfo('bin/foo')
+        info.type = tarfile.LNKTYPE
+        info.linkname = 'bin/bar'
+        tar.addfile(info)
+    with tarfile.open('link-folder.tar', 'w') as tar:
+        info = tarfile.TarInfo('bin')
+        info.type = tarfile.DIRTYPE
+        tar.addfile(info)
+        info = tarfile.TarInfo('lib')
+        info.type = tarfile.LNKTYPE
+        info.linkname = 'bin'
+        tar.addfile(info)
+
+    for archive in ('folder.tar', 'parent.tar', 'missing.tar',
+                    'link-folder.tar'):
+        result = runner.invoke(steeve.cli, ['install', 'foo', '1.0', archive])
+        assert result.exit_code == 1
+        assert 'Error: cannot extract archive member' in result.output
+        assert not os.path.exists(os.path.join('stow', 'foo'))
+
+
+def test_install_broken_archive(runner, foo_archive):
+    """Must not leave anything behind when extraction fails."""
+    with open(foo_archive, 'rb') as fp:
+        data = fp.read()
+    with open(foo_archive, 'wb') as fp:
+        fp.write(data[:len(data) // 2])
+
+    result = runner.invoke(steeve.cli,
+                           ['install', 'foo', '1.0', foo_archive])
+    assert result.exit_code == 1
+    assert 'cannot extract' in result.output
+    assert not os.path.exists(os.path.join('stow', 'foo'))
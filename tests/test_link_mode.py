@@ -0,0 +1,91 @@
+import os
+
+import steeve
+
+
+def test_stow_hardlink(runner, bar_package):
+    """Must hard link files into target and remember the mode."""
+    result = runner.invoke(steeve.cli, ['stow', '--link-mode', 'hardlink',
+                                        'bar', '1.0'])
+    assert result.exit_code == 0
+    assert not os.path.islink('bin')
+    assert not os.path.islink(os.path.join('bin', 'bar'))
+    assert os.path.samefile(os.path.join('bin', 'bar'),
+                            os.path.join('stow', 'bar', '1.0', 'bin', 'bar'))
+    result = runner.invoke(steeve.cli, ['owns', 'bin/bar'])
+    assert result.output.endswith(' is owned by bar/1.0\n')
+
+    result = runner.invoke(steeve.cli, ['stow', 'bar', '2.0'])
+    assert result.exit_code == 0
+    assert os.path.samefile(os.path.join('bin', 'bar'),
+                            os.path.join('stow', 'bar', '2.0', 'bin', 'bar'))
+
+    result = runner.invoke(steeve.cli, ['unstow', 'bar'])
+    assert result.exit_code == 0
+    assert not os.path.lexists('bin')
+
+
+def test_stow_reflink(runner):
+    """Must copy links of the package as they are and keep entries that
+    didn't change."""
+    libpath = os.path.join('stow', 'baz', '1.0', 'lib')
+    os.makedirs(libpath)
+    with open(os.path.join(libpath, 'libbaz.so.1'), 'w') as fp:
+        fp.write('baz')
+    os.symlink('libbaz.so.1', os.path.join(libpath, 'libbaz.so'))
+
+    result = runner.invoke(steeve.cli, ['-v', 'stow', '--link-mode',
+                                        'reflink', 'baz', '1.0'])
+    assert result.exit_code == 0
+    assert os.readlink(os.path.join('lib', 'libbaz.so')) == 'libbaz.so.1'
+    with open(os.path.join('lib', 'libbaz.so.1')) as fp:
+        assert fp.read() == 'baz'
+    assert 'REFLINK: lib/libbaz.so.1' in result.output
+
+    result = runner.invoke(steeve.cli, ['-v', 'stow', 'baz', '1.0'])
+    assert result.exit_code == 0
+    assert 'REFLINK' not in result.output
+
+
+def test_switch_link_mode(runner, bar_package, stowed_foo_package):
+    """Must replace hard links with symlinks and leave other packages
+    alone."""
+    result = runner.invoke(steeve.cli, ['stow', '--link-mode', 'hardlink',
+                                        'bar', '1.0'])
+    assert result.exit_code == 0
+    result = runner.invoke(steeve.cli, ['stow', '--link-mode', 'symlink',
+                                        'bar', '1.0'])
+    assert result.exit_code == 0
+    assert (os.readlink(os.path.join('bin', 'bar')) ==
+            os.path.join('..', 'stow', 'bar', 'current', 'bin', 'bar'))
+
+    result = runner.invoke(steeve.cli, ['stow', '--link-mode', 'hardlink',
+                                        'bar', '2.0'])
+    assert result.exit_code == 0
+    result = runner.invoke(steeve.cli, ['unstow', 'bar'])
+    assert result.exit_code == 0
+    assert os.listdir('bin') == ['foo']
+
+
+def test_verify_hardlink(runner, foo_release):
+    result = runner.invoke(steeve.cli,
+                           ['install', 'foo', '1.0', 'releases/foo-1.0'])
+    assert result.exit_code == 0
+    result = runner.invoke(steeve.cli, ['stow', '--link-mode', 'hardlink',
+                                        'foo', '1.0'])
+    assert result.exit_code == 0
+    result = runner.invoke(steeve.cli, ['verify'])
+    assert result.exit_code == 0
+    assert result.output == ''
+
+    path = os.path.join(os.getcwd(), 'bin', 'foo')
+    os.remove(path)
+    with open(path, 'w'):
+        pass
+    result = runner.invoke(steeve.cli, ['verify'])
+    assert result.exit_code == 1
+    assert result.output.splitlines() == [
+        path + ': wrong file',
+        'Error: found 1 problem',
+    ]
+
@@ -0,0 +1,49 @@
+import fcntl
+import os
+import threading
+
+import steeve
+
+
+def hold_lock(path, seconds):
+    """Lock file from another descriptor and release it later."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    timer = threading.Timer(seconds, os.close, [fd])
+    timer.start()
+    return timer
+
+
+def test_wait_for_package(runner, foo_package):
+    """Must wait until other process releases the package."""
+    os.makedirs(os.path.join('stow', '.steeve', 'locks'))
+    timer = hold_lock(os.path.join('stow', '.steeve', 'locks', 'foo'), 0.2)
+    result = runner.invoke(steeve.cli, ['stow', 'foo', '1.0'])
+    timer.join()
+    assert result.exit_code == 0
+    assert "Waiting for lock of package 'foo'..." in result.output
+    assert "for lock of package 'foo'" in result.output.splitlines()[-1]
+    assert os.path.islink('bin')
+
+
+def test_other_package_not_locked(runner, foo_package, bar_package):
+    """Must not wait for packages that are not used."""
+    os.makedirs(os.path.join('stow', '.steeve', 'locks'))
+    timer = hold_lock(os.path.join('stow', '.steeve', 'locks', 'bar'), 0.2)
+    result = runner.invoke(steeve.cli, ['stow', 'foo', '1.0'])
+    timer.join()
+    assert result.exit_code == 0
+    assert 'Waiting' not in result.output
+
+
+def test_reentrant(tmpdir):
+    """Must reuse held lock and upgrade shared lock to exclusive."""
+    path = str(tmpdir.join('lock'))
+    with steeve.file_lock(path, shared=True):
+        fd = steeve.LOCKS[path][0]
+        with steeve.file_lock(path):
+            assert steeve.LOCKS[path] == [fd, fcntl.LOCK_EX]
+            with steeve.file_lock(path, shared=True):
+                assert steeve.LOCKS[path] == [fd, fcntl.LOCK_EX]
+        assert steeve.LOCKS[path] == [fd, fcntl.LOCK_SH]
+    assert path not in steeve.LOCKS
@@ -0,0 +1,67 @@
+import json
+import os
+
+import steeve
+
+
+def test_ls(runner, stowed_foo_package, bar_package):
+    """Must list packages and versions in order."""
+    os.mkdir(os.path.join('stow', 'bar', '10.0'))
+
+    result = runner.invoke(steeve.cli, ['ls'])
+    assert result.exit_code == 0
+    assert result.output == 'bar\nfoo\n'
+
+    result = runner.invoke(steeve.cli, ['ls', 'bar'])
+    assert result.exit_code == 0
+    assert result.output == '  1.0\n  2.0\n  10.0\n'
+
+    result = runner.invoke(steeve.cli, ['ls', 'foo'])
+    assert result.exit_code == 0
+    assert result.output == '* 1.0\n'
+
+
+def test_ls_nonexistent(runner):
+    """Must fail when listing versions of missing package."""
+    result = runner.invoke(steeve.cli, ['ls', 'foo'])
+    assert result.exit_code == 1
+    assert "no such package 'foo'" in result.output
+
+
+def test_ls_long(runner, stowed_bar_package):
+    """Must show current version and disk usage."""
+    with open(os.path.join('stow', 'bar', '2.0', 'bin', 'bar'), 'wb') as fp:
+        fp.write(b'\0' * 65536)
+
+    result = runner.invoke(steeve.cli, ['ls', '--json', 'bar'])
+    assert result.exit_code == 0
+    entries = [json.loads(line) for line in result.output.splitlines()]
+    assert [entry['version'] for entry in entries] == ['1.0', '2.0']
+    assert [entry['current'] for entry in entries] == [True, False]
+    assert entries[1]['size'] >= 65536 > entries[0]['size']
+
+    result = runner.invoke(steeve.cli, ['ls', '--long', '--sort', 'size'])
+    assert result.exit_code == 0
+    assert result.output.split()[:3] == ['bar', '1.0', '2']
+
+    result = runner.invoke(steeve.cli, ['ls', '-l', '--sort', 'size', 'bar'])
+    assert result.exit_code == 0
+    assert result.output.split('\n')[1].startswith('* 1.0')
+
+
+def test_ls_size_cache(runner, monkeypatch, bar_package):
+    """Must not walk versions that were not modified since last time."""
+    result = runner.invoke(steeve.cli, ['ls', '--json'])
+    assert result.exit_code == 0
+    size = json.loads(result.output)['size']
+
+    def disk_usage(root, jobs):
+        raise AssertionError('cache was not used')
+    monkeypatch.setattr(steeve, 'disk_usage', disk_usage)
+    result = runner.invoke(steeve.cli, ['ls', '--json'])
+    assert result.exit_code == 0
+    assert json.loads(result.output)['size'] == size
+
+    os.mkdir(os.path.join('stow', 'bar', '2.0', 'lib'))
+    result = runner.invoke(steeve.cli, ['ls', '--json'])
+    assert result.exit_code == -1
@@ -0,0 +1,37 @@
+import os
+
+import steeve
+
+
+def test_owns(runner, foo_package):
+    """Must show package that owns a path."""
+    result = runner.invoke(steeve.cli, ['stow', 'foo', '1.0'])
+    assert result.exit_code == 0
+
+    result = runner.invoke(steeve.cli, ['owns', os.path.join('bin', 'foo')])
+    assert result.exit_code == 0
+    assert 'is owned by foo/1.0' in result.output
+
+
+def test_owns_unfolded(runner, stowed_bar_package, foo_package):
+    """Must follow links that were unfolded by another package."""
+    result = runner.invoke(steeve.cli, ['stow', 'foo', '1.0'])
+    assert result.exit_code == 0
+    result = runner.invoke(steeve.cli, ['stow', 'bar', '2.0'])
+    assert result.exit_code == 0
+
+    result = runner.invoke(steeve.cli, ['owns', os.path.join('bin', 'bar')])
+    assert result.exit_code == 0
+    assert 'is owned by bar/2.0' in result.output
+
+
+def test_owns_unknown(runner, stowed_foo_package):
+    """Must fail when path doesn't belong to any package."""
+    result = runner.invoke(steeve.cli, ['owns', 'stow'])
+    assert result.exit_code == 1
+    assert 'no package owns' in result.output
+
+    result = runner.invoke(steeve.cli, ['unstow', 'foo'])
+    assert result.exit_code == 0
+    result = runner.invoke(steeve.cli, ['owns', os.path.join('bin', 'foo')])
+    assert result.exit_code == 1
@@ -0,0 +1,89 @@
+import io
+import json
+import os
+import tarfile
+
+import steeve
+
+
+def test_pack(runner, foo_release):
+    """Must write reproducible archive of version with its manifest."""
+    path = os.path.join('releases', 'foo-1.0', 'bin', 'foo')
+    with open(path, 'w') as fp:
+        fp.write('foo')
+    os.symlink('foo', os.path.join('releases', 'foo-1.0', 'bin', 'f'))
+    result = runner.invoke(steeve.cli,
+                           ['install', 'foo', '1.0', 'releases/foo-1.0'])
+    assert result.exit_code == 0
+
+    result = runner.invoke(steeve.cli, ['pack', 'foo', '1.0', '-o', 'a.tgz'])
+    assert result.exit_code == 0
+    os.utime(os.path.join('stow', 'foo', '1.0', 'bin', 'foo'), (1, 1))
+    result = runner.invoke(steeve.cli, ['pack', 'foo', '1.0'])
+    assert result.exit_code == 0
+    with open('a.tgz', 'rb') as fp:
+        assert fp.read() == result.output_bytes
+
+    with tarfile.open('a.tgz') as tar:
+        members = tar.getmembers()
+        assert [member.name for member in members] == [
+            steeve.MANIFEST_NAME, 'bin', 'bin/f', 'bin/foo']
+        assert all(member.mtime == 0 and member.uid == 0
+                   for member in members)
+        manifest = json.loads(tar.extractfile(members[0]).read().decode())
+    assert sorted(manifest) == ['bin/f', 'bin/foo']
+    assert manifest['bin/foo'][1:] == [
+        3, '2c26b46b68ffc68ff99b453c1d30413413422d706483bfa0f98a5e886266e7ae']
+
+
+def test_install_packed(runner, foo_release, monkeypatch):
+    """Must install archive compressed in several blocks and record its
+    manifest without hashing files again."""
+    with open(os.path.join('releases', 'foo-1.0', 'bin', 'big'), 'wb') as fp:
+        fp.write(os.urandom(100000))
+    result = runner.invoke(steeve.cli,
+                           ['install', 'foo', '1.0', 'releases/foo-1.0'])
+    assert result.exit_code == 0
+    monkeypatch.setattr(steeve, 'GZIP_BLOCK', 16384)
+    result = runner.invoke(steeve.cli, ['-j', '4', 'pack', 'foo', '1.0',
+                                        '-o', 'foo.tar.gz'])
+    assert result.exit_code == 0
+    with open('foo.tar.gz', 'rb') as fp:
+        assert fp.read().count(b'\x1f\x8b\x08') > 1
+
+    def file_digest(path):
+        raise AssertionError('file is hashed again')
+
+    monkeypatch.setattr(steeve, 'file_digest', file_digest)
+    result = runner.invoke(steeve.cli, ['unstow', 'foo'])
+    assert result.exit_code == 0
+    result = runner.invoke(steeve.cli, ['install', 'bar', '1.0',
+                                        'foo.tar.gz'])
+    assert result.exit_code == 0
+    with open(os.path.join('stow', 'bar', '1.0', 'bin', 'big'), 'rb') as fp:
+        with open(os.path.join('releases', 'foo-1.0', 'bin', 'big'),
+                  'rb') as orig:
+            assert fp.read() == orig.read()
+    result = runner.invoke(steeve.cli, ['verify', 'bar'])
+    assert result.exit_code == 0
+
+
+def test_install_packed_mismatch(runner):
+    """Must fail to install archive that doesn't match its manifest."""
+    data = json.dumps({'bin/foo': [0o100644, 3, '0' * 64],
+                       'bin/bar': [0o100644, 0, '0' * 64]}).encode()
+    with tarfile.open('foo.tar.gz', mode='w:gz') as tar:
+        for name, contents in [(steeve.MANIFEST_NAME, data),
+                               ('bin/foo', b'foo')]:
+            info = tarfile.TarInfo(name)
+            info.size = len(contents)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(contents))
+
+    result = runner.invoke(steeve.cli, ['install', 'foo', '1.0',
+                                        'foo.tar.gz'])
+    assert result.exit_code == 1
+    assert "archive doesn't match its manifest" in result.output
+    assert 'bin/bar: missing' in result.output
+    assert 'bin/foo: modified' in result.output
+    assert not os.path.exists(os.path.join('stow', 'foo'))
@@ -0,0 +1,183 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+import steeve
+
+
+@pytest.fixture
+def foo_versions():
+    """Return a package with two versions that have different files."""
+    for version, name in (('1.0', 'foo'), ('2.0', 'foo2')):
+        binpath = os.path.join('stow', 'foo', version, 'bin')
+        os.makedirs(binpath)
+        with open(os.path.join(binpath, name), 'w'):
+            pass
+    return 'foo'
+
+
+def interrupt(*args, **kwargs):
+    raise RuntimeError('interrupted')
+
+
+def journals():
+    folder = os.path.join('stow', '.steeve', 'journal')
+    return os.listdir(folder) if os.path.isdir(folder) else []
+
+
+def test_recover_switch(runner, foo_versions, monkeypatch):
+    """Must finish switch that was interrupted after new links were
+    created."""
+    result = runner.invoke(steeve.cli, ['--no-folding', 'stow', 'foo', '1.0'])
+    assert result.exit_code == 0
+    with monkeypatch.context() as patch:
+        patch.setattr(steeve.Steeve, 'set_currents', interrupt)
+        result = runner.invoke(steeve.cli,
+                               ['--no-folding', 'stow', 'foo', '2.0'])
+    assert isinstance(result.exception, RuntimeError)
+    assert os.path.islink(os.path.join('bin', 'foo2'))
+    assert os.path.islink(os.path.join('bin', 'foo'))
+    assert len(journals()) == 1
+
+    result = runner.invoke(steeve.cli, ['recover'])
+    assert result.exit_code == 0
+    assert "Recovering interrupted stowing 'foo/2.0'" in result.output
+    assert os.path.exists(os.path.join('bin', 'foo2'))
+    assert not os.path.lexists(os.path.join('bin', 'foo'))
+    assert journals() == []
+    result = runner.invoke(steeve.cli, ['owns', 'bin/foo2'])
+    assert 'foo/2.0' in result.output
+
+    result = runner.invoke(steeve.cli, ['recover'])
+    assert result.exit_code == 0
+    assert result.output == 'Nothing to recover\n'
+
+
+def test_recover_next_invocation(runner, foo_versions, monkeypatch):
+    """Must recover interrupted operations before changing anything."""
+    with monkeypatch.context() as patch:
+        patch.setattr(steeve.Steeve, 'set_currents', interrupt)
+        result = runner.invoke(steeve.cli,
+                               ['--no-folding', 'stow', 'foo', '1.0'])
+    assert isinstance(result.exception, RuntimeError)
+
+    result = runner.invoke(steeve.cli, ['ls', 'foo'])
+    assert result.output == '  1.0\n  2.0\n'
+    result = runner.invoke(steeve.cli, ['--no-folding', 'stow', 'foo', '2.0'])
+    assert result.exit_code == 0
+    assert "Recovering interrupted stowing 'foo/1.0'" in result.output
+    assert os.path.exists(os.path.join('bin', 'foo2'))
+    assert not os.path.lexists(os.path.join('bin', 'foo'))
+
+
+def test_recover_install_copy(runner, foo_updated_release, monkeypatch):
+    """Must resume copying from files that were already copied."""
+    copy_file = steeve.copy_file
+    copied = []
+
+    def copy_one(src, dst, mode='copy'):
+        if copied:
+            raise RuntimeError('interrupted')
+        copied.append(dst)
+        return copy_file(src, dst, mode)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(steeve, 'copy_file', copy_one)
+        patch.setattr(shutil, 'rmtree', lambda *args, **kwargs: None)
+        result = runner.invoke(steeve.cli, ['-j', '1', 'install', 'foo',
+                                            '1.0', 'releases/foo-1.0'])
+    assert isinstance(result.exception, RuntimeError)
+    assert not os.path.exists(os.path.join('stow', 'foo', '1.0'))
+    partial = os.stat(copied[0])
+
+    with monkeypatch.context() as patch:
+        patch.setattr(steeve, 'copy_file', copy_one)
+        del copied[:]
+        result = runner.invoke(steeve.cli, ['recover'])
+    assert result.exit_code == 0
+    assert sorted(os.listdir(os.path.join('stow', 'foo'))) == ['1.0',
+                                                              'current']
+    assert len(copied) == 1
+    installed = os.path.join('stow', 'foo', '1.0', 'bin',
+                             os.path.basename(copied[0]))
+    assert os.stat(installed).st_ino != partial.st_ino
+    assert os.path.exists(os.path.join('bin', 'foo'))
+    assert os.path.exists(os.path.join('bin', 'foo-1.0'))
+    assert journals() == []
+
+
+def test_recover_install_stdin(runner, monkeypatch):
+    """Must roll back install from standard input."""
+    with monkeypatch.context() as patch:
+        patch.setattr(steeve, 'open_tar', interrupt)
+        patch.setattr(shutil, 'rmtree', lambda *args, **kwargs: None)
+        result = runner.invoke(steeve.cli, ['install', 'foo', '1.0', '-'],
+                               input='')
+    assert isinstance(result.exception, RuntimeError)
+    assert len(journals()) == 1
+
+    result = runner.invoke(steeve.cli, ['recover'])
+    assert result.exit_code == 0
+    assert "Rolled back installing 'foo/1.0'" in result.output
+    assert not os.path.exists(os.path.join('stow', 'foo'))
+    assert journals() == []
+
+
+def test_recover_install_move(runner, foo_release, monkeypatch):
+    """Must move folder back to its source instead of deleting it."""
+    with monkeypatch.context() as patch:
+        # Process is killed before it moves the folder back
+        patch.setattr(steeve, 'dedup_tree', interrupt)
+        patch.setattr(steeve.POSIX, 'rename', interrupt)
+        result = runner.invoke(steeve.cli, ['install', '--copy-mode', 'move',
+                                            '--dedup', 'foo', '1.0',
+                                            'releases/foo-1.0'])
+    assert isinstance(result.exception, RuntimeError)
+    assert not os.path.exists(os.path.join('releases', 'foo-1.0'))
+
+    result = runner.invoke(steeve.cli, ['recover'])
+    assert result.exit_code == 0
+    assert "Rolled back installing 'foo/1.0'" in result.output
+    assert os.path.exists(os.path.join('releases', 'foo-1.0', 'bin', 'foo'))
+    assert not os.path.exists(os.path.join('stow', 'foo'))
+    assert journals() == []
+
+
+def test_recover_install_stow(runner, foo_release, monkeypatch):
+    """Must record and stow version that was installed before
+    interruption."""
+    with monkeypatch.context() as patch:
+        patch.setattr(steeve, 'manifest_tree', interrupt)
+        result = runner.invoke(steeve.cli, ['install', 'foo', '1.0',
+                                            'releases/foo-1.0'])
+    assert isinstance(result.exception, RuntimeError)
+    assert os.path.isdir(os.path.join('stow', 'foo', '1.0'))
+    assert not os.path.exists(os.path.join('bin', 'foo'))
+
+    result = runner.invoke(steeve.cli, ['recover'])
+    assert result.exit_code == 0
+    assert os.path.exists(os.path.join('bin', 'foo'))
+    result = runner.invoke(steeve.cli, ['files', 'foo'])
+    assert result.output == os.path.join('bin', 'foo') + '\n'
+
+
+def test_recover_journal_created(runner, monkeypatch):
+    """Must not remove journal that is being created."""
+    folder = os.path.join('stow', '.steeve', 'journal')
+    mkstemp = tempfile.mkstemp
+    found = []
+
+    def mkstemp_and_recover(*args, **kwargs):
+        result = mkstemp(*args, **kwargs)
+        found.extend(steeve.Journal.interrupted(folder))
+        return result
+
+    with monkeypatch.context() as patch:
+        patch.setattr(tempfile, 'mkstemp', mkstemp_and_recover)
+        journal = steeve.Journal.create(folder, {'operation': 'switch'})
+    assert found == []
+    assert journals() == [os.path.basename(journal.path)]
+    journal.remove()
+    assert journals() == []
@@ -0,0 +1,76 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import steeve
+
+
+@pytest.yield_fixture
+def server(runner):
+    """Run ``steeve serve`` in background."""
+    env = dict(os.environ, **runner.env)
+    env.pop('STEEVE_NO_SERVE', None)
+    path = os.path.join('stow', '.steeve', 'serve.sock')
+    with open('serve.log', 'w') as log:
+        process = subprocess.Popen([sys.executable, steeve.__file__, '-v',
+                                    'serve'], env=env, stderr=log)
+    for _ in range(100):
+        if os.path.exists(path):
+            break
+        time.sleep(0.05)
+    process.env = env
+    yield process
+    process.terminate()
+    process.wait()
+    assert not os.path.exists(path)
+
+
+def run(server, *args):
+    process = subprocess.Popen([sys.executable, steeve.__file__] +
+                               list(args), env=server.env,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    return process.returncode, stdout.decode(), stderr.decode()
+
+
+def test_serve(runner, foo_package, server):
+    """Must run commands of clients in their folder and streams."""
+    status, stdout, stderr = run(server, 'stow', 'foo', '1.0')
+    assert status == 0
+    assert os.path.islink('bin')
+
+    status, stdout, stderr = run(server, 'ls', 'foo')
+    assert status == 0
+    assert stdout == '* 1.0\n'
+
+    status, stdout, stderr = run(server, 'stow', 'foo', '2.0')
+    assert status == 1
+    assert "package 'foo/2.0' is not installed" in stderr
+
+    with open('serve.log') as log:
+        assert log.read().splitlines()[0].endswith(': stow foo 1.0')
+
+
+def test_already_serving(runner, server):
+    """Must refuse to serve the same folder twice."""
+    status, stdout, stderr = run(server, 'serve')
+    assert status == 1
+    assert 'already serving' in stderr
+
+
+def test_inotify(tmpdir):
+    """Must report changes in watched folder."""
+    inotify = steeve.Inotify()
+    try:
+        inotify.add_watch(str(tmpdir))
+        tmpdir.join('foo').write('')
+        events = inotify.read()
+        assert events[0][0] == str(tmpdir)
+        assert events[0][1] & steeve.Inotify.IN_CREATE
+        assert events[0][2] == 'foo'
+    finally:
+        inotify.close()
@@ -48,3 +48,255 @@ def test_restow(runner, stowed_foo_package):
     result = runner.invoke(steeve.cli, ['stow', 'foo', '1.0'])
     assert result.exit_code == 0
     assert os.path.exists(os.path.join('bin', 'bar'))
+
+
+def test_unfolding(runner, stowed_bar_package, foo_package):
+    """Must unfold a folder that belongs to another package."""
+    result = runner.invoke(steeve.cli, ['unstow', 'bar'])
+    assert result.exit_code == 0
+    result = runner.invoke(steeve.cli, ['stow', 'bar', '1.0'])
+    assert result.exit_code == 0
+    assert os.path.islink('bin')
+
+    result = runner.invoke(steeve.cli, ['stow', 'foo', '1.0'])
+    assert result.exit_code == 0
+    assert not os.path.islink('bin')
+    assert os.path.islink(os.path.join('bin', 'foo'))
+    assert os.path.islink(os.path.join('bin', 'bar'))
+    assert (os.readlink(os.path.join('bin', 'bar')) ==
+            os.path.join('..', 'stow', 'bar', 'current', 'bin', 'bar'))
+
+
+def test_conflict(runner, foo_package):
+    """Must report conflicts and not change anything."""
+    os.mkdir('bin')
+    with open(os.path.join('bin', 'foo'), 'w'):
+        pass
+    os.makedirs(os.path.join('stow', 'foo', '1.0', 'bin', 'sub'))
+
+    result = runner.invoke(steeve.cli, ['stow', 'foo', '1.0'])
+    assert result.exit_code == 1
+    assert ('existing target is neither a link nor a directory: '
+            + os.path.join('bin', 'foo')) in result.output
+    assert not os.path.lexists(os.path.join('bin', 'sub'))
+
+
+def test_not_owned(runner, foo_package):
+    """Must not replace links that point outside of stow dir."""
+    os.mkdir('bin')
+    os.symlink('/dev/null', os.path.join('bin', 'foo'))
+
+    result = runner.invoke(steeve.cli, ['stow', 'foo', '1.0'])
+    assert result.exit_code == 1
+    assert 'not owned by stow' in result.output
+    assert os.readlink(os.path.join('bin', 'foo')) == '/dev/null'
+
+
+def test_ignore(runner, foo_package):
+    """Must not link files that GNU Stow ignores."""
+    with open(os.path.join('stow', 'foo', '1.0', 'README.md'), 'w'):
+        pass
+
+    result = runner.invoke(steeve.cli, ['stow', 'foo', '1.0'])
+    assert result.exit_code == 0
+    assert not os.path.lexists('README.md')
+
+
+def test_switch_version(runner, stowed_bar_package):
+    """Must touch only links that differ between versions."""
+    with open(os.path.join('stow', 'bar', '1.0', 'bin', 'bar-1.0'), 'w'):
+        pass
+    os.makedirs(os.path.join('stow', 'bar', '2.0', 'share'))
+    result = runner.invoke(steeve.cli, ['--no-folding', 'stow', 'bar', '1.0'])
+    assert result.exit_code == 0
+    inode = os.lstat(os.path.join('bin', 'bar')).st_ino
+
+    result = runner.invoke(steeve.cli, ['--no-folding', 'stow', 'bar', '2.0'])
+    assert result.exit_code == 0
+    assert os.lstat(os.path.join('bin', 'bar')).st_ino == inode
+    assert not os.path.lexists(os.path.join('bin', 'bar-1.0'))
+    assert os.path.isdir('share')
+    assert (os.readlink(os.path.join('stow', 'bar', 'current')) ==
+            os.path.abspath(os.path.join('stow', 'bar', '2.0')))
+
+
+def test_switch_conflict(runner, stowed_bar_package):
+    """Must keep current version stowed when new one conflicts."""
+    with open(os.path.join('stow', 'bar', '2.0', 'bin', 'baz'), 'w'):
+        pass
+    with open(os.path.join('bin', 'baz'), 'w'):
+        pass
+
+    result = runner.invoke(steeve.cli, ['--no-folding', 'stow', 'bar', '2.0'])
+    assert result.exit_code == 1
+    assert os.path.exists(os.path.join('bin', 'bar'))
+    assert (os.readlink(os.path.join('stow', 'bar', 'current')) ==
+            os.path.abspath(os.path.join('stow', 'bar', '1.0')))
+
+
+def test_plan(runner, bar_package, foo_package):
+    """Must print changes without modifying target."""
+    result = runner.invoke(steeve.cli, ['stow', 'bar', '1.0'])
+    assert result.exit_code == 0
+    result = runner.invoke(steeve.cli, ['stow', '--plan', 'foo', '1.0'])
+    assert result.exit_code == 0
+    assert result.output.splitlines() == [
+        'UNLINK: bin',
+        'MKDIR: bin',
+        'LINK: {} => {}'.format(
+            os.path.join('bin', 'bar'),
+            os.path.join('..', 'stow', 'bar', 'current', 'bin', 'bar')),
+        'LINK: {} => {}'.format(
+            os.path.join('bin', 'foo'),
+            os.path.join('..', 'stow', 'foo', 'current', 'bin', 'foo')),
+    ]
+    assert os.path.islink('bin')
+    assert not os.path.exists(os.path.join('stow', 'foo', 'current'))
+
+
+def test_plan_conflict(runner, foo_package):
+    """Must print conflicts along with changes."""
+    os.mkdir('bin')
+    with open(os.path.join('bin', 'foo'), 'w'):
+        pass
+    os.makedirs(os.path.join('stow', 'foo', '1.0', 'lib'))
+
+    result = runner.invoke(steeve.cli, ['stow', '--plan', 'foo', '1.0'])
+    assert result.exit_code == 1
+    assert 'LINK: lib => ' in result.output
+    assert ('existing target is neither a link nor a directory: '
+            + os.path.join('bin', 'foo')) in result.output
+    assert not os.path.exists('lib')
+
+
+def test_cached_listing(runner, stowed_foo_package, bar_package):
+    """Must reuse listing of unmodified folder and notice modified one."""
+    os.utime('bin', (0, 0))
+    result = runner.invoke(steeve.cli, ['stow', '--plan', 'foo', '1.0'])
+    assert result.exit_code == 0
+    path = os.path.join('stow', '.steeve', 'index.sqlite')
+    with steeve.Index(path) as index:
+        assert index.listing(os.path.abspath('bin'), os.stat('bin')) == {
+            'foo': ('link', os.path.join('..', 'stow', 'foo', 'current',
+                                         'bin', 'foo')),
+        }
+
+    with open(os.path.join('bin', 'bar'), 'w'):
+        pass
+    result = runner.invoke(steeve.cli, ['stow', 'bar', '2.0'])
+    assert result.exit_code == 1
+    assert 'neither a link nor a directory' in result.output
+
+
+def test_several_targets(runner, foo_package):
+    """Must stow into every target and print summary."""
+    os.mkdir('one')
+    os.mkdir('two')
+    result = runner.invoke(steeve.cli, ['-t', 'one', '-t', 'two',
+                                        'stow', 'foo', '1.0'])
+    assert result.exit_code == 0
+    assert result.output.splitlines() == [
+        '{}: ok'.format(os.path.abspath('one')),
+        '{}: ok'.format(os.path.abspath('two')),
+    ]
+    for target in ('one', 'two'):
+        assert (os.readlink(os.path.join(target, 'bin')) ==
+                os.path.join('..', 'stow', 'foo', 'current', 'bin'))
+
+    with open('targets', 'w') as fp:
+        fp.write('# comment\none\n\ntwo\n')
+    result = runner.invoke(steeve.cli, ['--targets-file', 'targets',
+                                        'unstow', 'foo'])
+    assert result.exit_code == 0
+    assert not os.path.lexists(os.path.join('one', 'bin'))
+    assert not os.path.lexists(os.path.join('two', 'bin'))
+
+
+def test_several_targets_conflict(runner, foo_package):
+    """Must not change any target if one of them has conflicts."""
+    os.makedirs(os.path.join('one'))
+    os.makedirs(os.path.join('two', 'bin'))
+    with open(os.path.join('two', 'bin', 'foo'), 'w'):
+        pass
+    result = runner.invoke(steeve.cli, ['-t', 'one', '-t', 'two',
+                                        'stow', 'foo', '1.0'])
+    assert result.exit_code == 1
+    assert ('{}: existing target is neither a link nor a directory: {}'
+            .format(os.path.abspath('two'), os.path.join('bin', 'foo'))
+            in result.output)
+    assert not os.path.lexists(os.path.join('one', 'bin'))
+    assert not os.path.lexists(os.path.join('stow', 'foo', 'current'))
+
+
+def test_several_targets_failed(runner, foo_package, monkeypatch):
+    """Must remove links created in other targets if one of them fails."""
+    os.mkdir('one')
+    os.mkdir('two')
+    symlink = steeve.POSIX.symlink
+
+    def fail_in_two(dest, path):
+        if path.startswith(os.path.abspath('two')):
+            raise OSError('disk is full')
+        symlink(dest, path)
+
+    monkeypatch.setattr(steeve.POSIX, 'symlink', fail_in_two)
+    result = runner.invoke(steeve.cli, ['--no-folding', '-t', 'one', '-t',
+                                        'two', 'stow', 'foo', '1.0'])
+    assert result.exit_code == 1
+    assert result.output.splitlines() == [
+        '{}: aborted'.format(os.path.abspath('one')),
+        '{}: failed: disk is full'.format(os.path.abspath('two')),
+        "Error: stowing 'foo/1.0' failed in 1 of 2 targets, all operations "
+        "aborted",
+    ]
+    assert os.listdir('one') == []
+    assert os.listdir('two') == []
+    assert not os.path.lexists(os.path.join('stow', 'foo', 'current'))
+
+
+def test_several_targets_rollback_failed(runner, foo_package, monkeypatch):
+    """Must keep journal of targets that couldn't be rolled back."""
+    os.mkdir('one')
+    os.mkdir('two')
+    symlink = steeve.POSIX.symlink
+
+    def fail_in_two(dest, path):
+        if path.startswith(os.path.abspath('two')):
+            raise OSError('disk is full')
+        symlink(dest, path)
+
+    def fail(path):
+        raise OSError('disk is gone')
+
+    monkeypatch.setattr(steeve.POSIX, 'symlink', fail_in_two)
+    monkeypatch.setattr(steeve.POSIX, 'remove', fail)
+    result = runner.invoke(steeve.cli, ['-t', 'one', '-t', 'two',
+                                        'stow', 'foo', '1.0'])
+    assert result.exit_code == 1
+    assert ('{}: changed, rollback failed: disk is gone'
+            .format(os.path.abspath('one')) in result.output)
+    assert "run 'steeve recover' to finish" in result.output
+    assert os.path.islink(os.path.join('one', 'bin'))
+    assert len(os.listdir(os.path.join('stow', '.steeve', 'journal'))) == 1
+
+
+def test_single_target_failed(runner, foo_package, monkeypatch):
+    """Must remove links that were created before failure."""
+    def fail(dest, path):
+        if path.endswith('foo'):
+            raise OSError('disk is full')
+        symlink(dest, path)
+
+    symlink = steeve.POSIX.symlink
+    monkeypatch.setattr(steeve.POSIX, 'symlink', fail)
+    result = runner.invoke(steeve.cli, ['--no-folding', 'stow', 'foo',
+                                        '1.0'])
+    assert result.exit_code == 1
+    assert result.output.splitlines() == [
+        '{}: failed: disk is full'.format(os.getcwd()),
+        "Error: stowing 'foo/1.0' failed in 1 of 1 targets, all operations "
+        "aborted",
+    ]
+    assert not os.path.lexists('bin')
+    assert not os.path.lexists(os.path.join('stow', 'foo', 'current'))
+    assert not os.listdir(os.path.join('stow', '.steeve', 'journal'))
@@ -0,0 +1,62 @@
+import json
+import os
+
+import steeve
+
+
+def test_timings(runner, foo_release):
+    """Must print how long steps of command took."""
+    result = runner.invoke(steeve.cli, ['--timings', 'install', 'foo', '1.0',
+                                        'releases/foo-1.0'])
+    assert result.exit_code == 0
+    names = [line.split()[0] for line in result.output.splitlines()]
+    assert names[:3] == ['steeve', 'install', 'copy']
+    assert 'package=foo version=1.0' in result.output
+    assert 'files=1' in result.output
+    assert result.output.splitlines()[2].split()[2:] == [
+        'bytes=0', 'files=1', 'modes=copy']
+
+
+def test_trace(runner, foo_package):
+    """Must write spans in Chrome trace format to STEEVE_TRACE."""
+    runner.env['STEEVE_TRACE'] = 'trace.json'
+    result = runner.invoke(steeve.cli, ['stow', 'foo', '1.0'])
+    assert result.exit_code == 0
+    with open('trace.json') as fp:
+        events = json.load(fp)['traceEvents']
+    assert [event['name'] for event in events] == [
+        'steeve stow', 'stow', 'plan', 'execute']
+    assert all(event['ph'] == 'X' and event['pid'] == os.getpid()
+               for event in events)
+    assert events[0]['dur'] >= events[1]['dur']
+    assert events[3]['args'] == {'changes': 1}
+
+
+def test_trace_error(runner):
+    """Must write trace when command fails."""
+    result = runner.invoke(steeve.cli, ['--trace', 'trace.json',
+                                        'stow', 'foo', '1.0'])
+    assert result.exit_code == 1
+    with open('trace.json') as fp:
+        events = json.load(fp)['traceEvents']
+    assert [event['name'] for event in events] == ['steeve stow', 'stow']
+
+
+def test_trace_threads(runner, foo_package):
+    """Must record spans of worker threads under the span that started
+    them."""
+    os.makedirs(os.path.join('stow', '.steeve'))
+    os.mkdir('a')
+    os.mkdir('b')
+    with open(os.path.join('stow', '.steeve', 'triggers'), 'w') as fp:
+        fp.write('bin true\n')
+    runner.env['STEEVE_TRACE'] = 'trace.json'
+    result = runner.invoke(steeve.cli, ['-t', 'a', '-t', 'b',
+                                        'stow', 'foo', '1.0'])
+    assert result.exit_code == 0
+    with open('trace.json') as fp:
+        events = json.load(fp)['traceEvents']
+    names = [event['name'] for event in events]
+    assert names.count('trigger') == 2
+    assert all(event['args']['status'] == 0 for event in events
+               if event['name'] == 'trigger')
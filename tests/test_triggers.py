@@ -0,0 +1,75 @@
+import os
+
+import steeve
+
+
+def write_triggers(*lines):
+    meta = os.path.join('stow', '.steeve')
+    if not os.path.isdir(meta):
+        os.makedirs(meta)
+    with open(os.path.join(meta, 'triggers'), 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
+
+
+def read_log():
+    try:
+        with open('triggered') as fp:
+            return fp.read().splitlines()
+    except IOError:
+        return []
+
+
+def test_triggers(runner, foo_package, bar_package):
+    """Must run every matching trigger once after links changed."""
+    write_triggers('# pattern  command',
+                   'bin/*      echo bin >> triggered',
+                   'lib/*      echo lib >> triggered')
+    result = runner.invoke(steeve.cli, ['--no-folding', 'stow', 'foo',
+                                        '1.0'])
+    assert result.exit_code == 0
+    assert read_log() == ['bin']
+
+    result = runner.invoke(steeve.cli, ['--no-folding', 'stow', 'foo',
+                                        '1.0'])
+    assert result.exit_code == 0
+    assert read_log() == ['bin']
+
+    result = runner.invoke(steeve.cli, ['stow', 'bar', '1.0'])
+    assert result.exit_code == 0
+    result = runner.invoke(steeve.cli, ['unstow', 'foo', 'bar'])
+    assert result.exit_code == 0
+    assert read_log() == ['bin', 'bin', 'bin']
+
+
+def test_triggers_reinstall(runner, foo_release):
+    """Must run triggers when files behind links change."""
+    write_triggers('bin/foo echo foo >> triggered')
+    result = runner.invoke(steeve.cli,
+                           ['install', 'foo', '1.0', 'releases/foo-1.0'])
+    assert result.exit_code == 0
+    assert read_log() == ['foo']
+
+    with open(os.path.join('releases', 'foo-1.0', 'bin', 'foo'), 'w') as fp:
+        fp.write('modified')
+    result = runner.invoke(steeve.cli, ['install', '-y', 'foo', '1.0',
+                                        'releases/foo-1.0'])
+    assert result.exit_code == 0
+    assert read_log() == ['foo', 'foo']
+
+
+def test_trigger_failed(runner, foo_package):
+    write_triggers('bin exit 3')
+    result = runner.invoke(steeve.cli, ['stow', 'foo', '1.0'])
+    assert result.exit_code == 1
+    assert result.output.splitlines() == [
+        "Trigger 'exit 3' returned code 3 in {}".format(os.getcwd()),
+        'Error: 1 trigger failed',
+    ]
+
+
+def test_dry_run_triggers(runner, foo_package):
+    write_triggers('bin echo bin >> triggered')
+    result = runner.invoke(steeve.cli, ['-n', 'stow', 'foo', '1.0'])
+    assert result.exit_code == 0
+    assert result.output.splitlines()[-1] == 'TRIGGER: echo bin >> triggered'
+    assert read_log() == []
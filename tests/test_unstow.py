@@ -30,3 +30,25 @@ def test_unstow_multiple(runner, stowed_foo_package, stowed_bar_package):
     assert result.exit_code == 0
     assert not os.path.exists(os.path.join('bin', 'foo'))
     assert not os.path.exists(os.path.join('bin', 'bar'))
+
+
+def test_refolding(runner, foo_package, bar_package):
+    """Must fold a folder back when only one package is left in it."""
+    for package in ('foo', 'bar'):
+        result = runner.invoke(steeve.cli, ['stow', package, '1.0'])
+        assert result.exit_code == 0
+    assert not os.path.islink('bin')
+
+    result = runner.invoke(steeve.cli, ['unstow', 'foo'])
+    assert result.exit_code == 0
+    assert os.path.islink('bin')
+    assert os.path.exists(os.path.join('bin', 'bar'))
+    assert not os.path.exists(os.path.join('bin', 'foo'))
+
+
+def test_remove_empty_folders(runner, stowed_foo_package):
+    """Must remove folders that were left empty after unstowing."""
+    result = runner.invoke(steeve.cli, ['unstow', 'foo'])
+    assert result.exit_code == 0
+    assert not os.path.exists('bin')
+    assert os.path.exists('stow')
@@ -0,0 +1,97 @@
+import os
+
+import steeve
+
+
+def install_foo(runner):
+    result = runner.invoke(steeve.cli,
+                           ['install', 'foo', '1.0', 'releases/foo-1.0'])
+    assert result.exit_code == 0
+
+
+def test_verify(runner, foo_updated_release):
+    """Must report files that changed since install."""
+    install_foo(runner)
+    result = runner.invoke(steeve.cli, ['verify'])
+    assert result.exit_code == 0
+    assert result.output == ''
+
+    binpath = os.path.join(os.getcwd(), 'stow', 'foo', '1.0', 'bin')
+    with open(os.path.join(binpath, 'foo'), 'w') as fp:
+        fp.write('modified')
+    os.remove(os.path.join(binpath, 'foo-1.0'))
+    with open(os.path.join(binpath, 'bar'), 'w'):
+        pass
+
+    result = runner.invoke(steeve.cli, ['verify', 'foo'])
+    assert result.exit_code == 1
+    assert result.output.splitlines() == [
+        os.path.join(binpath, 'bar') + ': added',
+        os.path.join(binpath, 'foo') + ': modified',
+        os.path.join(binpath, 'foo-1.0') + ': missing',
+        'Error: found 3 problems',
+    ]
+
+
+def test_verify_unchanged_stat(runner, foo_release):
+    """Must not hash files whose size, modification time and inode match
+    unless asked to."""
+    path = os.path.join('releases', 'foo-1.0', 'bin', 'foo')
+    with open(path, 'w') as fp:
+        fp.write('a')
+    install_foo(runner)
+    path = os.path.join('stow', 'foo', '1.0', 'bin', 'foo')
+    st = os.stat(path)
+    with open(path, 'w') as fp:
+        fp.write('b')
+    os.utime(path, (st.st_atime, st.st_mtime))
+
+    result = runner.invoke(steeve.cli, ['verify', 'foo', '1.0'])
+    assert result.exit_code == 0
+
+    result = runner.invoke(steeve.cli, ['verify', '--full', 'foo', '1.0'])
+    assert result.exit_code == 1
+    assert result.output.splitlines()[0].endswith(': modified')
+
+    os.chmod(path, 0o700)
+    result = runner.invoke(steeve.cli, ['verify', 'foo', '1.0'])
+    assert result.exit_code == 1
+    assert result.output.splitlines() == [
+        os.path.join(os.getcwd(), path) + ': mode changed',
+        'Error: found 1 problem',
+    ]
+
+
+def test_verify_links(runner, foo_release):
+    """Must report links in target that stowing would change."""
+    install_foo(runner)
+    os.remove('bin')
+    result = runner.invoke(steeve.cli, ['verify'])
+    assert result.exit_code == 1
+    assert result.output.splitlines()[0] == (
+        os.path.join(os.getcwd(), 'bin') + ': missing link')
+
+    with open('bin', 'w'):
+        pass
+    result = runner.invoke(steeve.cli, ['verify'])
+    assert result.exit_code == 1
+    assert 'existing target is neither a link nor a directory: bin' in \
+        result.output
+
+
+def test_verify_not_recorded(runner, bar_package):
+    """Must record manifest of versions installed by other means."""
+    result = runner.invoke(steeve.cli, ['verify', 'bar'])
+    assert result.exit_code == 0
+    assert "No manifest of 'bar/1.0'" in result.output
+
+    result = runner.invoke(steeve.cli, ['verify', 'bar'])
+    assert result.exit_code == 0
+    assert result.output == ''
+
+
+def test_verify_uninstalled(runner, foo_package):
+    """Must fail when version is not installed."""
+    result = runner.invoke(steeve.cli, ['verify', 'foo', '2.0'])
+    assert result.exit_code == 1
+    assert "package 'foo/2.0' is not installed" in result.output
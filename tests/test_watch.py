@@ -0,0 +1,102 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import steeve
+
+
+@pytest.yield_fixture
+def watcher(runner, stowed_foo_package):
+    """Run ``steeve watch foo`` in background."""
+    env = dict(os.environ, **runner.env)
+    with open('watch.log', 'w') as log:
+        process = subprocess.Popen([sys.executable, steeve.__file__,
+                                    'watch', 'foo', '--delay', '0.05'],
+                                   env=env, stderr=log)
+    wait_for(lambda: 'Watching' in read_log())
+    yield process
+    process.terminate()
+    process.wait()
+
+
+def read_log():
+    with open('watch.log') as log:
+        return log.read()
+
+
+def wait_for(predicate):
+    for _ in range(100):
+        if predicate():
+            return
+        time.sleep(0.05)
+    raise AssertionError('timed out, log:\n' + read_log())
+
+
+def test_watch(watcher):
+    """Must add and remove links of files that appear and disappear."""
+    binpath = os.path.join('stow', 'foo', '1.0', 'bin')
+    with open(os.path.join(binpath, 'bar'), 'w'):
+        pass
+    wait_for(lambda: os.path.islink(os.path.join('bin', 'bar')))
+    assert (os.readlink(os.path.join('bin', 'bar')) ==
+            os.path.join('..', 'stow', 'foo', 'current', 'bin', 'bar'))
+
+    os.remove(os.path.join(binpath, 'foo'))
+    wait_for(lambda: not os.path.lexists(os.path.join('bin', 'foo')))
+    assert 'Linked 1, unlinked 0 in' in read_log()
+    assert 'Linked 0, unlinked 1 in' in read_log()
+
+
+def test_watch_not_stowed(runner, foo_package):
+    result = runner.invoke(steeve.cli, ['watch', 'foo'])
+    assert result.exit_code == 1
+    assert "package 'foo' is not stowed" in result.output
+
+
+@pytest.fixture
+def memory_steeve():
+    """Return steeve with package stowed in memory."""
+    fs = steeve.MemoryFS()
+    fs.makedirs('/stow/foo/dev/bin')
+    fs.write('/stow/foo/dev/bin/foo')
+    fs.makedirs('/share/doc')
+    instance = steeve.Steeve('/stow', ('/',), False, 0, False, 1, fs)
+    instance.stow('foo', 'dev')
+    return instance
+
+
+def test_update_links(memory_steeve):
+    """Must link only nodes that appeared."""
+    fs = memory_steeve.fs
+    fs.makedirs('/stow/foo/dev/share/doc/foo')
+    fs.write('/stow/foo/dev/share/doc/foo/README')
+    fs.write('/stow/foo/dev/bin/bar')
+    changes = memory_steeve.update_links('foo', 'dev', [
+        'share', 'share/doc', 'share/doc/foo', 'share/doc/foo/README',
+        'bin/bar'])
+    assert changes == [('/share/doc/foo', steeve.ABSENT,
+                        ('link', '../../stow/foo/current/share/doc/foo'))]
+    assert fs.exists('/bin/bar')
+
+    fs.rmtree('/stow/foo/dev/share')
+    changes = memory_steeve.update_links('foo', 'dev', ['share'])
+    assert [path for path, old, new in changes] == [
+        '/share', '/share/doc', '/share/doc/foo']
+    assert not fs.lexists('/share')
+
+
+def test_update_links_unfold(memory_steeve):
+    """Must unfold folders of other packages that become shared."""
+    fs = memory_steeve.fs
+    fs.makedirs('/stow/bar/1.0/lib')
+    fs.write('/stow/bar/1.0/lib/bar.so')
+    memory_steeve.stow('bar', '1.0')
+    assert fs.islink('/lib')
+    fs.makedirs('/stow/foo/dev/lib')
+    fs.write('/stow/foo/dev/lib/foo.so')
+    memory_steeve.update_links('foo', 'dev', ['lib', 'lib/foo.so'])
+    assert not fs.islink('/lib')
+    assert sorted(fs.listdir('/lib')) == ['bar.so', 'foo.so']